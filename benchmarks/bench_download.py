@@ -0,0 +1,309 @@
+"""
+jmcomic下载性能基准测试
+
+使用离线的禁漫替身服务器（tests/jm_standin.py），端到端地测量 download_album、download_photo、download_batch 的吞吐，
+覆盖 threading.image / threading.photo、图片解密开关、图片格式转换的组合矩阵。
+
+每个场景记录：
+- albums_per_second / images_per_second
+- image_latency_p50 / image_latency_p99：单张图片从开始下载到保存完成的耗时（秒）
+- peak_rss：进程常驻内存峰值（字节）
+- peak_threads：线程数峰值
+
+结果保存为JSON，可以用 --baseline 与之前版本的结果对比，吞吐下降超过阈值时以非0状态码退出，便于在CI中发现性能回退。
+发布版本时，可以把该版本的结果提交到 benchmarks/results/ 作为之后版本的基线。
+
+用法：
+    python benchmarks/bench_download.py                         # 完整矩阵，结果写入 benchmarks/results/{版本号}.json
+    python benchmarks/bench_download.py --quick                 # 缩小矩阵和数据量
+    python benchmarks/bench_download.py --baseline old.json     # 与基线对比
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from itertools import product
+from typing import Dict, List, Optional
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'tests'))
+
+import jmcomic
+from jmcomic import *
+from jm_standin import JmStandinServer
+
+
+class BenchDownloader(JmDownloader):
+    """
+    记录每张图片从 before_image 到 after_image 的耗时
+    """
+    latency_list: List[float] = []
+    latency_lock = threading.Lock()
+
+    def __init__(self, option):
+        super().__init__(option)
+        self.begin_dict: Dict[str, float] = {}
+
+    def before_image(self, image, img_save_path):
+        self.begin_dict[img_save_path] = time.perf_counter()
+
+    def after_image(self, image, img_save_path):
+        begin = self.begin_dict.pop(img_save_path, None)
+        if begin is not None:
+            with self.latency_lock:
+                self.latency_list.append(time.perf_counter() - begin)
+
+    def before_album(self, album):
+        pass
+
+    def after_album(self, album):
+        pass
+
+    def before_photo(self, photo):
+        pass
+
+    def after_photo(self, photo):
+        pass
+
+
+class ResourceSampler:
+    """
+    在后台线程定时采样进程内存和线程数，记录峰值
+    """
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    @staticmethod
+    def current_rss() -> int:
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss
+        except ImportError:
+            pass
+
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            pass
+
+        try:
+            import resource
+            # linux为KB，macOS为字节；这里只能取到进程生命周期内的峰值
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return rss if sys.platform == 'darwin' else rss * 1024
+        except ImportError:
+            return 0
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.current_rss())
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def run_scenario(server: JmStandinServer, args, mode: str, image_threads: int, photo_threads: int,
+                 decode: bool, suffix: Optional[str]) -> dict:
+    base_dir = tempfile.mkdtemp(prefix='jmcomic-bench-')
+    option = server.new_option(
+        base_dir,
+        impl=args.impl,
+        threading={'image': image_threads, 'photo': photo_threads},
+        image={'decode': decode, 'suffix': suffix, 'decode_backend': args.decode_backend, 'profile': args.profile},
+    )
+
+    album_id_list = [args.album_id + i * 1000 for i in range(args.albums)]
+    if mode == 'download_album':
+        album_count, image_count = 1, args.photos * args.images
+        func = lambda: download_album(album_id_list[0], option, BenchDownloader)
+    elif mode == 'download_photo':
+        album_count, image_count = 0, args.images
+        func = lambda: download_photo(album_id_list[0], option, BenchDownloader)
+    else:
+        album_count, image_count = len(album_id_list), len(album_id_list) * args.photos * args.images
+        func = lambda: download_batch(download_album, album_id_list, option, BenchDownloader)
+
+    BenchDownloader.latency_list = []
+    server.stats.clear()
+    try:
+        with ResourceSampler() as sampler:
+            begin = time.perf_counter()
+            func()
+            cost = time.perf_counter() - begin
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+        JmModuleConfig.SCRAMBLE_CACHE.clear()
+
+    latency = BenchDownloader.latency_list
+    return {
+        'name': f'{mode}[image={image_threads},photo={photo_threads},decode={decode},suffix={suffix}]',
+        'mode': mode,
+        'params': {
+            'threading.image': image_threads,
+            'threading.photo': photo_threads,
+            'decode': decode,
+            'suffix': suffix,
+        },
+        'metrics': {
+            'seconds': cost,
+            'images': len(latency),
+            'expected_images': image_count,
+            'albums_per_second': album_count / cost if album_count else None,
+            'images_per_second': len(latency) / cost,
+            'image_latency_p50': percentile(latency, 0.5),
+            'image_latency_p99': percentile(latency, 0.99),
+            'peak_rss': sampler.peak_rss,
+            'peak_threads': sampler.peak_threads,
+            'server_requests': server.stats.get('request', 0),
+            'server_errors_injected': server.stats.get('error_injected', 0),
+        },
+    }
+
+
+def build_matrix(args):
+    if args.quick:
+        return list(product(
+            ['download_album', 'download_photo', 'download_batch'],
+            [8],
+            [2],
+            [True, False],
+            [None],
+        ))
+
+    return list(product(
+        ['download_album', 'download_photo', 'download_batch'],
+        [4, 16, 32],
+        [1, 4],
+        [True, False],
+        [None, '.jpg'],
+    ))
+
+
+def compare_with_baseline(results: List[dict], baseline_path: str, threshold: float) -> List[str]:
+    """
+    与基线结果对比 images_per_second，返回吞吐下降超过阈值的场景描述
+    """
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+
+    regressions = []
+    for r in results:
+        base = baseline.get(r['name'], None)
+        if base is None:
+            continue
+
+        old, new = base['metrics']['images_per_second'], r['metrics']['images_per_second']
+        if not old:
+            continue
+
+        change = (new - old) / old
+        line = f'{r["name"]}: {old:.1f} → {new:.1f} images/s ({change:+.1%})'
+        print(line)
+        if change < -threshold:
+            regressions.append(line)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='jmcomic下载性能基准测试')
+    parser.add_argument('--quick', action='store_true', help='缩小矩阵和数据量')
+    parser.add_argument('--impl', default='api', help='客户端实现，api 或 html')
+    parser.add_argument('--decode-backend', default='pil', help='图片解密的实现，pil 或 numpy')
+    parser.add_argument('--profile', default=None, help='图片编码配置，fast、balanced 或 archival')
+    parser.add_argument('--albums', type=int, default=None, help='download_batch的本子数')
+    parser.add_argument('--photos', type=int, default=None, help='每个本子的章节数')
+    parser.add_argument('--images', type=int, default=None, help='每个章节的图片数')
+    parser.add_argument('--album-id', type=int, default=500000, help='起始本子id')
+    parser.add_argument('--latency', type=float, default=0.005, help='API请求的延迟（秒）')
+    parser.add_argument('--image-latency', type=float, nargs=2, default=(0.01, 0.05), help='图片请求的延迟区间（秒）')
+    parser.add_argument('--error-rate', type=float, default=0, help='错误注入概率')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=None, help='每个场景的重复次数，取中位数')
+    parser.add_argument('--output', default=None, help='结果JSON路径，默认 benchmarks/results/{版本号}.json')
+    parser.add_argument('--baseline', default=None, help='基线结果JSON路径')
+    parser.add_argument('--threshold', type=float, default=0.2, help='吞吐下降超过该比例视为回退')
+    args = parser.parse_args()
+
+    args.albums = args.albums or (2 if args.quick else 4)
+    args.photos = args.photos or (2 if args.quick else 4)
+    args.images = args.images or (8 if args.quick else 20)
+    args.repeat = args.repeat or (1 if args.quick else 3)
+
+    disable_jm_log()
+    server = JmStandinServer(latency=args.latency,
+                             image_latency=tuple(args.image_latency),
+                             error_rate=args.error_rate,
+                             seed=args.seed,
+                             )
+    results = []
+    with server:
+        for i in range(args.albums):
+            server.add_album(args.album_id + i * 1000, photo_count=args.photos, image_count=args.images)
+
+        for scenario in build_matrix(args):
+            # 重复多次，取吞吐为中位数的一次，减少波动
+            runs = sorted((run_scenario(server, args, *scenario) for _ in range(args.repeat)),
+                          key=lambda r: r['metrics']['images_per_second'])
+            result = runs[len(runs) // 2]
+            m = result['metrics']
+            print(f'{result["name"]}: {m["images_per_second"]:.1f} images/s, '
+                  f'p50={m["image_latency_p50"]:.3f}s, p99={m["image_latency_p99"]:.3f}s, '
+                  f'rss={m["peak_rss"] / 1024 / 1024:.0f}MB, threads={m["peak_threads"]}')
+            results.append(result)
+
+    output = args.output or os.path.join(bench_dir, 'results', f'{jmcomic.__version__}.json')
+    mkdir_if_not_exists(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'meta': {
+                'jmcomic_version': jmcomic.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+            },
+            'results': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+
+    if args.baseline is not None:
+        regressions = compare_with_baseline(results, args.baseline, args.threshold)
+        if regressions:
+            print(f'吞吐下降超过{args.threshold:.0%}的场景:\n' + '\n'.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 # 模块依赖关系如下:
 # 被依赖方 <--- 使用方
-# config <--- entity <--- toolkit <--- client <--- option <--- downloader
+# config <--- entity <--- toolkit <--- metrics <--- client <--- option <--- downloader
 
 __version__ = '2.6.10'
 
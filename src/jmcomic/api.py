@@ -98,6 +98,48 @@ def download_photo(jm_photo_id,
         return photo, dler
 
 
+async def download_album_async(jm_album_id,
+                               option=None,
+                               downloader=None,
+                               callback=None,
+                               check_exception=True,
+                               ):
+    """
+    下载一个本子（album）的协程版本，参数同 download_album，不支持批量下载
+
+    图片在事件循环上并发下载，downloader需为 AsyncJmDownloader 或其子类
+
+    :return: 本子实体类，下载器
+    """
+    async with new_downloader(option, downloader or AsyncJmDownloader) as dler:
+        album = await dler.download_album_async(jm_album_id)
+
+        if callback is not None:
+            callback(album, dler)
+        if check_exception:
+            dler.raise_if_has_exception()
+        return album, dler
+
+
+async def download_photo_async(jm_photo_id,
+                               option=None,
+                               downloader=None,
+                               callback=None,
+                               check_exception=True,
+                               ):
+    """
+    下载一个章节（photo）的协程版本，参数同 download_album_async
+    """
+    async with new_downloader(option, downloader or AsyncJmDownloader) as dler:
+        photo = await dler.download_photo_async(jm_photo_id)
+
+        if callback is not None:
+            callback(photo, dler)
+        if check_exception:
+            dler.raise_if_has_exception()
+        return photo, dler
+
+
 def new_downloader(option=None, downloader=None) -> JmDownloader:
     if option is None:
         option = JmModuleConfig.option_class().default()
@@ -5,6 +5,9 @@ for example, download album 123 456, photo 333:
 
 $ jmcomic 123 456 p333 --option="D:/option.yml"
 
+restore images downloaded with `download.image.defer_decode`:
+
+$ jmcomic descramble "D:/jmcomic" --option="D:/option.yml"
 
 """
 import os.path
@@ -117,5 +120,96 @@ class JmcomicUI:
             launcher.wait_finish()
 
 
+class JmDescrambleUI:
+    """
+    还原延迟解密（download.image.defer_decode）保存的原始图片，可以重复执行、中断后重新执行
+    """
+
+    def __init__(self) -> None:
+        self.option_path: Optional[str] = None
+        self.dir_list: List[str] = []
+        self.workers: int = 1
+
+    def parse_arg(self, argv: List[str]):
+        import argparse
+        parser = argparse.ArgumentParser(prog='jmcomic descramble',
+                                         description='restore images downloaded with `download.image.defer_decode`')
+        parser.add_argument(
+            'dir_list',
+            nargs='+',
+            help='directories to search for scrambled images recursively',
+        )
+
+        parser.add_argument(
+            '--option',
+            help='path to the option file, used for `download.image.decode_backend` and `download.image.profile`. '
+                 'You can also specify it by env `JM_OPTION_PATH`',
+            type=str,
+            default=get_env('JM_OPTION_PATH', ''),
+        )
+
+        parser.add_argument(
+            '--workers',
+            help='number of threads, default to the cpu count',
+            type=int,
+            default=os.cpu_count() or 1,
+        )
+
+        args = parser.parse_args(argv)
+        option = args.option
+        if len(option) == 0 or option == "''":
+            self.option_path = None
+        else:
+            self.option_path = os.path.abspath(option)
+
+        self.dir_list = [os.path.abspath(d) for d in args.dir_list]
+        self.workers = max(1, args.workers)
+
+    def main(self, argv: List[str]):
+        self.parse_arg(argv)
+
+        from .api import create_option, JmOption
+        if self.option_path is not None:
+            option = create_option(self.option_path)
+        else:
+            option = JmOption.default()
+
+        self.run(option)
+
+    def run(self, option):
+        from .api import jm_log
+        from .jm_toolkit import JmImageTool
+        from concurrent.futures import ThreadPoolExecutor
+
+        backend = option.decide_image_decode_backend()
+        profile = option.decide_image_encode_profile()
+        filepath_list = [f for d in self.dir_list for f in JmImageTool.find_deferred(d)]
+        jm_log('command_line',
+               f'start descrambling...\n'
+               f'- dir: {self.dir_list}\n'
+               f'- images: {len(filepath_list)}, workers: {self.workers}')
+
+        def decode(filepath):
+            try:
+                JmImageTool.decode_deferred(filepath, backend, profile)
+                return True
+            except Exception as e:
+                jm_log('command_line', f'descramble failed: [{filepath}], {e}')
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            result = list(executor.map(decode, filepath_list))
+
+        failed = result.count(False)
+        jm_log('command_line', f'descramble finished, success: {len(result) - failed}, failed: {failed}')
+        if failed != 0:
+            exit(1)
+
+
 def main():
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'descramble':
+        JmDescrambleUI().main(sys.argv[2:])
+        return
+
     JmcomicUI().main()
@@ -1,8 +1,803 @@
-from threading import Lock
+import asyncio
+import heapq
+import itertools
+from random import uniform
+from threading import Condition, Lock, Semaphore, Thread
+from time import monotonic
 
 from .jm_client_interface import *
 
 
+class JmAsyncPostman:
+    """
+    基于 curl_cffi AsyncSession 的异步postman，供 AsyncJmDownloader 下载图片使用。
+
+    请求参数的合并规则与同步的postman一致：以client的postman元数据（headers、cookies、proxies等）为底，
+    被单次请求的参数覆盖。必须在事件循环内创建。
+    """
+
+    def __init__(self, meta_data: dict, max_clients: int):
+        from curl_cffi.requests import AsyncSession
+        self.meta_data = meta_data
+        self.session = AsyncSession(max_clients=max_clients)
+
+    def merge_kwargs(self, kwargs: dict) -> dict:
+        ret = self.meta_data.copy()
+        for k, v in kwargs.items():
+            if v is None:
+                continue
+            ret[k] = v
+        return ret
+
+    async def get(self, url, **kwargs):
+        return await self.session.get(url, **self.merge_kwargs(kwargs))
+
+    async def post(self, url, **kwargs):
+        return await self.session.post(url, **self.merge_kwargs(kwargs))
+
+    async def close(self):
+        await self.session.close()
+
+
+class JmSessionPoolPostman(AbstractPostman):
+    """
+    复用连接的postman，配置 client.postman.type = curl_cffi_pool 启用。
+
+    默认的 curl_cffi postman 每次请求都新建连接（TCP + TLS握手），本postman按域名（host）复用 curl_cffi Session：
+    - meta_data.pool_size 为空时，每个线程对每个域名持有一个session（thread-local）
+    - meta_data.pool_size = N 时，每个域名最多N个session，线程借出使用、用完归还，用尽时等待
+
+    https请求通过ALPN协商HTTP/2（也可以用 meta_data.http_version 指定）。
+    新建连接和复用连接的次数记录在 opened / reused，设置了metrics时同时计入
+    connections_opened_total / connections_reused_total
+    """
+    postman_key = 'curl_cffi_pool'
+
+    def __init__(self, kwargs: dict) -> None:
+        from threading import local
+        self.pool_size: Optional[int] = kwargs.pop('pool_size', None)
+        super().__init__(kwargs)
+        self.thread_local = local()
+        self.host_pools: Dict[str, Tuple[Semaphore, list]] = {}
+        self.lock = Lock()
+        self.opened = 0
+        self.reused = 0
+        self.metrics: Optional[JmDownloadMetrics] = None
+
+    def new_session(self):
+        from curl_cffi import requests, CurlInfo
+        # session不会被多个线程同时使用，不需要curl_cffi为每个线程再创建curl
+        return requests.Session(
+            impersonate=self.meta_data.get('impersonate', None),
+            use_thread_local_curl=False,
+            # 每次请求后读取curl新建的连接数，见 record_connection
+            curl_infos=[CurlInfo.NUM_CONNECTS],
+        )
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, kwargs)
+
+    def request(self, method: str, url: str, kwargs: dict):
+        kwargs = self.before_request(kwargs)
+        host = JmHostLimiter.parse_host(url)
+
+        if self.pool_size is None:
+            resp = self.thread_session(host).request(method, url, **kwargs)
+            self.record_connection(host, resp)
+            return resp
+
+        session = self.borrow_session(host)
+        try:
+            resp = session.request(method, url, **kwargs)
+        except BaseException:
+            self.return_session(host, session)
+            raise
+
+        self.record_connection(host, resp)
+        if kwargs.get('stream', False) is True:
+            # 流式响应读完之前还占用着连接，关闭响应时才归还session
+            close = resp.close
+
+            def close_and_return():
+                try:
+                    close()
+                finally:
+                    self.return_session(host, session)
+
+            resp.close = close_and_return
+        else:
+            self.return_session(host, session)
+
+        return resp
+
+    def thread_session(self, host: str):
+        sessions = getattr(self.thread_local, 'sessions', None)
+        if sessions is None:
+            sessions = self.thread_local.sessions = {}
+
+        session = sessions.get(host, None)
+        if session is None:
+            session = sessions[host] = self.new_session()
+
+        return session
+
+    def borrow_session(self, host: str):
+        pool = self.host_pools.get(host, None)
+        if pool is None:
+            with self.lock:
+                pool = self.host_pools.setdefault(host, (Semaphore(self.pool_size), []))
+
+        semaphore, idle = pool
+        semaphore.acquire()
+        with self.lock:
+            if idle:
+                return idle.pop()
+
+        return self.new_session()
+
+    def return_session(self, host: str, session):
+        semaphore, idle = self.host_pools[host]
+        with self.lock:
+            idle.append(session)
+        semaphore.release()
+
+    def record_connection(self, host: str, resp):
+        """
+        根据curl的 NUM_CONNECTS（本次请求新建的连接数），判断本次请求是新建连接还是复用连接
+        """
+        from curl_cffi import CurlInfo
+        num_connects = getattr(resp, 'infos', {}).get(CurlInfo.NUM_CONNECTS, None)
+        if num_connects is None:
+            return
+
+        reused = num_connects == 0
+        with self.lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.opened += num_connects
+
+        if self.metrics is None:
+            return
+
+        if reused:
+            self.metrics.inc('connections_reused_total', host=host)
+        else:
+            self.metrics.inc('connections_opened_total', num_connects, host=host)
+
+    def copy(self):
+        return self.__class__({**self.meta_data, 'pool_size': self.pool_size})
+
+
+ComponentRegistry.register_component(Postman, 'postman_key', [JmSessionPoolPostman])
+
+
+class JmTokenBucket:
+    """
+    令牌桶，限制每秒请求数，允许最多burst个请求的突发
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        ExceptionTool.require_true(rate > 0, f'每秒请求数必须大于0: {rate}')
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.last_time = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            sleep(wait)
+
+
+class JmHostLimiter:
+    """
+    按域名（host）限制请求：同时进行中的请求数 + 令牌桶限速
+
+    配置见 option 的 client.limit，同一个option创建的所有client共用一个limiter
+    """
+
+    def __init__(self,
+                 concurrency: Optional[int] = None,
+                 rate: Optional[float] = None,
+                 burst: Optional[float] = None,
+                 hosts: Optional[Dict[str, dict]] = None,
+                 ):
+        """
+        :param concurrency: 每个域名同时进行中的请求数上限，None表示不限制
+        :param rate: 每个域名每秒的请求数上限，None表示不限制
+        :param burst: 令牌桶容量，None表示取 max(1, rate)
+        :param hosts: 单独配置某些域名，{host: {concurrency, rate, burst}}，未配置的项沿用上面的值
+        """
+        self.default_conf = {'concurrency': concurrency, 'rate': rate, 'burst': burst}
+        self.host_conf: Dict[str, dict] = hosts or {}
+        self.host_limits: Dict[str, Tuple[Optional[Semaphore], Optional[JmTokenBucket]]] = {}
+        self.lock = Lock()
+
+    def get_host_limit(self, host: str):
+        limit = self.host_limits.get(host, None)
+        if limit is not None:
+            return limit
+
+        with self.lock:
+            limit = self.host_limits.get(host, None)
+            if limit is None:
+                conf = {**self.default_conf, **(self.host_conf.get(host, None) or {})}
+                concurrency, rate = conf['concurrency'], conf['rate']
+                limit = (
+                    Semaphore(concurrency) if concurrency else None,
+                    JmTokenBucket(rate, conf['burst']) if rate else None,
+                )
+                self.host_limits[host] = limit
+                jm_log('req.limit', f'域名限流: [{host}], 并发上限: [{concurrency}], 每秒请求数: [{rate}]')
+
+        return limit
+
+    def limit(self, request: Callable) -> Callable:
+        """
+        包装请求方法，每次请求都按url的域名限流。
+        流式请求（stream=True）返回时响应体还没有接收，并发许可要保留到响应被关闭，见 hold_until_closed
+        """
+
+        def limited_request(url, **kwargs):
+            semaphore, bucket = self.get_host_limit(self.parse_host(url))
+
+            if semaphore is not None:
+                semaphore.acquire()
+            resp = None
+            try:
+                if bucket is not None:
+                    bucket.acquire()
+                resp = request(url, **kwargs)
+                return resp
+            finally:
+                if semaphore is not None:
+                    if resp is not None and kwargs.get('stream', False) is True:
+                        self.hold_until_closed(resp, semaphore)
+                    else:
+                        semaphore.release()
+
+        return limited_request
+
+    @staticmethod
+    def hold_until_closed(resp, semaphore: Semaphore):
+        """
+        流式响应关闭时（接收完毕或被丢弃，见 JmImageResp.stream_to_file、JmImageHedge.discard）才释放并发许可。
+        响应没有被关闭就被回收时，也会释放
+        """
+        import weakref
+        # finalize最多执行一次，主动关闭和被回收不会重复释放
+        release = weakref.finalize(resp, semaphore.release)
+        close = resp.close
+
+        def close_and_release(*args, **kwargs):
+            try:
+                return close(*args, **kwargs)
+            finally:
+                release()
+
+        resp.close = close_and_release
+
+    @classmethod
+    def parse_host(cls, url: str) -> str:
+        from urllib.parse import urlparse
+        return urlparse(url).netloc
+
+    @classmethod
+    def from_conf(cls, conf: Optional[dict]) -> Optional['JmHostLimiter']:
+        """
+        根据 client.limit 配置创建limiter，没有配置任何限制时返回None
+        """
+        if not conf:
+            return None
+
+        hosts = conf.get('hosts', None) or {}
+        if not conf.get('concurrency', None) and not conf.get('rate', None) and len(hosts) == 0:
+            return None
+
+        return cls(conf.get('concurrency', None), conf.get('rate', None), conf.get('burst', None), hosts)
+
+
+class JmRetryPolicy:
+    """
+    重试策略：每次重试前的退避等待、单次请求（含所有重试）的总耗时上限、以及哪些异常不再重试
+
+    配置见 option 的 client.retry，默认不等待、不限时、所有异常都重试，与之前的行为一致
+    """
+
+    BACKOFF_EXPONENTIAL = 'exponential'
+    BACKOFF_DECORRELATED = 'decorrelated'
+
+    def __init__(self,
+                 backoff: Optional[str] = None,
+                 base: float = 0.5,
+                 cap: float = 10.0,
+                 deadline: Optional[float] = None,
+                 no_retry_status: Optional[List[int]] = None,
+                 no_retry_exceptions: Optional[List[str]] = None,
+                 ):
+        """
+        :param backoff: 退避策略，None表示不等待，
+                        exponential: 指数退避 + 全抖动，等待 uniform(0, min(cap, base * 2^n)) 秒，
+                        decorrelated: 去相关抖动，等待 min(cap, uniform(base, 上次等待 * 3)) 秒
+        :param base: 退避的初始等待秒数
+        :param cap: 单次等待的秒数上限
+        :param deadline: 单次请求（含所有重试和等待）的总耗时上限，单位秒，None表示不限制。
+                         只在两次尝试之间检查，不会中断进行中的请求
+        :param no_retry_status: 响应的HTTP状态码在此列表中时，不再重试，直接抛出异常
+        :param no_retry_exceptions: 异常类名（含父类）在此列表中时，不再重试，直接抛出异常
+        """
+        ExceptionTool.require_true(
+            backoff in (None, self.BACKOFF_EXPONENTIAL, self.BACKOFF_DECORRELATED),
+            f'不支持的退避策略: {backoff}',
+        )
+        self.backoff = backoff
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.no_retry_status = set(no_retry_status or [])
+        self.no_retry_exceptions = set(no_retry_exceptions or [])
+
+    def should_retry(self, e: Exception, no_retry_status: Iterable[int] = ()) -> bool:
+        """
+        :param no_retry_status: 本次请求额外不重试的HTTP状态码，由调用方传入，
+                                例如断点续传时Range已失效（416），重试也不会成功，由调用方重新下载完整数据
+        """
+        if self.no_retry_exceptions and any(t.__name__ in self.no_retry_exceptions for t in type(e).__mro__):
+            return False
+
+        if isinstance(e, JmcomicException):
+            resp = e.context.get(ExceptionTool.CONTEXT_KEY_RESP, None)
+            code = getattr(resp, 'http_code', None) if isinstance(resp, JmResp) else getattr(resp, 'status_code', None)
+            if code in self.no_retry_status or code in no_retry_status:
+                return False
+
+        return True
+
+    def compute_delay(self, attempt: int, last_delay: float) -> float:
+        """
+        :param attempt: 第几次重试，从1开始
+        :param last_delay: 上一次的等待秒数
+        """
+        if self.backoff == self.BACKOFF_EXPONENTIAL:
+            return uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+        if self.backoff == self.BACKOFF_DECORRELATED:
+            return min(self.cap, uniform(self.base, max(self.base, last_delay) * 3))
+
+        return 0
+
+    def start(self) -> 'JmRetryState':
+        return JmRetryState(self)
+
+    @classmethod
+    def from_conf(cls, conf: Optional[dict]) -> 'JmRetryPolicy':
+        """
+        根据 client.retry 配置创建重试策略
+        """
+        conf = {k: v for k, v in (conf or {}).items() if v is not None}
+        return cls(**conf)
+
+
+class JmRetryState:
+    """
+    一次请求的重试状态，由 JmRetryPolicy.start() 创建
+    """
+
+    def __init__(self, policy: JmRetryPolicy):
+        self.policy = policy
+        self.attempt = 0
+        self.delay = 0.0
+        self.deadline = monotonic() + policy.deadline if policy.deadline is not None else None
+
+    def next_delay(self) -> Optional[float]:
+        """
+        计算下一次重试前需要等待的秒数，
+        如果等待之后会超过总耗时上限，返回None，表示不再重试
+        """
+        self.attempt += 1
+        self.delay = self.policy.compute_delay(self.attempt, self.delay)
+
+        if self.deadline is not None and monotonic() + self.delay >= self.deadline:
+            return None
+
+        return self.delay
+
+
+class JmDomainHealth:
+    """
+    域名健康度：按域名（host）记录请求耗时和失败率的指数加权移动平均（EWMA），
+    请求前按健康度对域名列表排序，优先使用当前最快的健康域名。
+
+    API、网页、图片CDN的域名都会记录，同一个option创建的所有client共用。配置见 option 的 client.health
+    """
+
+    def __init__(self, alpha: float = 0.3, max_error_rate: float = 0.5):
+        """
+        :param alpha: EWMA的平滑系数，越大越看重最近的请求
+        :param max_error_rate: 失败率超过该值的域名视为不健康，排到最后
+        """
+        ExceptionTool.require_true(0 < alpha <= 1, f'alpha必须在(0, 1]之间: {alpha}')
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        # host -> [latency, error_rate, samples]，latency只统计成功的请求，没有成功过时为None
+        self.stats: Dict[str, list] = {}
+        self.lock = Lock()
+
+    def record(self, host: str, latency: float, ok: bool):
+        with self.lock:
+            stat = self.stats.get(host, None)
+            if stat is None:
+                self.stats[host] = [latency if ok else None, 0.0 if ok else 1.0, 1]
+                return
+
+            if ok:
+                stat[0] = latency if stat[0] is None else stat[0] + self.alpha * (latency - stat[0])
+            stat[1] += self.alpha * ((0.0 if ok else 1.0) - stat[1])
+            stat[2] += 1
+
+    def score(self, host: str) -> Tuple[bool, float]:
+        """
+        排序用的分数，越小越好：(是否不健康, 预期拿到一次成功响应的耗时)
+
+        没有请求过的域名耗时记为无穷大，排在请求过的健康域名之后、不健康的域名之前，彼此保持配置的顺序；
+        请求过但从未成功的域名视为不健康
+        """
+        stat = self.stats.get(host, None)
+        if stat is None:
+            return False, float('inf')
+
+        latency, error_rate, _ = stat
+        if latency is None:
+            return True, float('inf')
+
+        return error_rate > self.max_error_rate, latency / max(1e-3, 1 - error_rate)
+
+    def sort(self, domain_list: List[str]) -> List[str]:
+        """
+        按健康度排序，分数相同时保持原顺序
+        """
+        return sorted(domain_list, key=self.score)
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                host: {'latency': latency, 'error_rate': error_rate, 'samples': samples}
+                for host, (latency, error_rate, samples) in self.stats.items()
+            }
+
+    @classmethod
+    def from_conf(cls, conf: Optional[dict]) -> Optional['JmDomainHealth']:
+        """
+        根据 client.health 配置创建，enable为false时返回None
+        """
+        if not conf or not conf.get('enable', False):
+            return None
+
+        return cls(conf.get('alpha', None) or 0.3, conf.get('max_error_rate', None) or 0.5)
+
+
+class JmCircuitBreaker:
+    """
+    按域名（host）熔断：连续失败达到阈值后熔断（open），冷却期内所有请求直接跳过该域名；
+    冷却期结束后进入半开（half-open）状态，放行少量探测请求，成功则恢复（closed），失败则再次熔断。
+
+    配置见 option 的 client.circuit_breaker，配置相同的client共用同一个熔断器，即进程内所有线程、所有client共享熔断状态
+    """
+
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half-open'
+
+    REGISTRY: Dict[tuple, 'JmCircuitBreaker'] = {}
+    REGISTRY_LOCK = Lock()
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30, half_open_max: int = 1):
+        """
+        :param failure_threshold: 连续失败多少次后熔断
+        :param cooldown: 熔断的冷却秒数
+        :param half_open_max: 半开状态下同时放行的探测请求数
+        """
+        ExceptionTool.require_true(failure_threshold >= 1, f'failure_threshold必须大于0: {failure_threshold}')
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.half_open_max = half_open_max
+        # host -> [state, 连续失败次数, 熔断时间, 进行中的探测请求数]
+        self.circuits: Dict[str, list] = {}
+        self.lock = Lock()
+
+    def transition(self, host: str, circuit: list, state: str):
+        jm_log('req.circuit', f'域名熔断状态变化: [{host}] {circuit[0]} → {state}, 连续失败次数: [{circuit[1]}]')
+        circuit[0] = state
+        circuit[3] = 0
+        if state == self.STATE_OPEN:
+            circuit[2] = monotonic()
+        elif state == self.STATE_CLOSED:
+            circuit[1] = 0
+
+    def allow(self, host: str) -> bool:
+        """
+        是否允许向该域名发请求，允许时调用方必须在请求结束后调用 record
+        """
+        with self.lock:
+            circuit = self.circuits.get(host, None)
+            if circuit is None or circuit[0] == self.STATE_CLOSED:
+                return True
+
+            if circuit[0] == self.STATE_OPEN:
+                if monotonic() - circuit[2] < self.cooldown:
+                    return False
+                self.transition(host, circuit, self.STATE_HALF_OPEN)
+
+            # half-open
+            if circuit[3] >= self.half_open_max:
+                return False
+            circuit[3] += 1
+            return True
+
+    def record(self, host: str, ok: bool):
+        with self.lock:
+            circuit = self.circuits.setdefault(host, [self.STATE_CLOSED, 0, 0.0, 0])
+            state = circuit[0]
+
+            if ok:
+                if state != self.STATE_CLOSED:
+                    self.transition(host, circuit, self.STATE_CLOSED)
+                circuit[1] = 0
+                return
+
+            circuit[1] += 1
+            if state == self.STATE_HALF_OPEN or (state == self.STATE_CLOSED and circuit[1] >= self.failure_threshold):
+                self.transition(host, circuit, self.STATE_OPEN)
+
+    def state_of(self, host: str) -> str:
+        circuit = self.circuits.get(host, None)
+        return circuit[0] if circuit is not None else self.STATE_CLOSED
+
+    @classmethod
+    def of(cls, failure_threshold: int, cooldown: float, half_open_max: int) -> 'JmCircuitBreaker':
+        key = (failure_threshold, cooldown, half_open_max)
+        with cls.REGISTRY_LOCK:
+            breaker = cls.REGISTRY.get(key, None)
+            if breaker is None:
+                breaker = cls(failure_threshold, cooldown, half_open_max)
+                cls.REGISTRY[key] = breaker
+
+        return breaker
+
+    @classmethod
+    def from_conf(cls, conf: Optional[dict]) -> Optional['JmCircuitBreaker']:
+        """
+        根据 client.circuit_breaker 配置获取熔断器，enable为false时返回None
+        """
+        if not conf or not conf.get('enable', False):
+            return None
+
+        return cls.of(
+            conf.get('failure_threshold', None) or 5,
+            conf.get('cooldown', None) or 30,
+            conf.get('half_open_max', None) or 1,
+        )
+
+
+class JmImageHedge:
+    """
+    图片对冲请求：图片请求超过一定时间（按历史请求耗时的分位数估算）仍未返回时，
+    向备用图片域名再发一个相同的请求，取先成功的那个，避免个别卡住的请求拖慢整个章节。
+
+    配置见 option 的 download.image.hedge，同一个option创建的所有client共用
+    """
+
+    def __init__(self,
+                 quantile: float = 0.95,
+                 min_delay: float = 1.0,
+                 max_delay: float = 10.0,
+                 alternate: bool = True,
+                 max_workers: int = 32,
+                 ):
+        """
+        :param quantile: 按 image_fetch_seconds 的哪个分位数决定等待时间
+        :param min_delay: 等待时间的下限，单位秒
+        :param max_delay: 等待时间的上限，单位秒，没有历史数据时也使用该值
+        :param alternate: 对冲请求是否换用 JmModuleConfig.DOMAIN_IMAGE_LIST 中的其他域名，否则请求同一个域名
+        :param max_workers: 执行对冲请求的线程数，主请求在调用方线程执行，不经过该线程池
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.alternate = alternate
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='jm-hedge')
+        # 等待发起对冲请求的定时任务，[到期时间, 序号, 方法]，方法为None表示已取消
+        self.timer_heap: List[list] = []
+        self.timer_seq = itertools.count()
+        self.timer_cond = Condition()
+        self.timer_thread: Optional[Thread] = None
+
+    def decide_delay(self, metrics: Optional[JmDownloadMetrics]) -> float:
+        delay = metrics.percentile('image_fetch_seconds', self.quantile) if metrics is not None else None
+        if delay is None or delay == float('inf'):
+            delay = self.max_delay
+
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def alternate_url(self, url: str, domain_health: Optional[JmDomainHealth] = None) -> str:
+        """
+        对冲请求的url，优先选择健康度最好的其他图片域名
+        """
+        if not self.alternate:
+            return url
+
+        host = JmHostLimiter.parse_host(url)
+        candidates = [domain for domain in JmModuleConfig.DOMAIN_IMAGE_LIST if domain != host]
+        if len(candidates) == 0:
+            return url
+
+        if domain_health is not None:
+            domain = domain_health.sort(candidates)[0]
+        else:
+            import random
+            domain = random.choice(candidates)
+
+        return url.replace(host, domain, 1)
+
+    def execute(self, request: Callable, url: str, delay: float, hedge_url: str):
+        """
+        主请求在调用方线程执行，超过delay仍未返回时，由定时线程把对冲请求提交到线程池。
+
+        同步请求无法中途放弃，调用方总要等主请求返回（或失败）后才能拿到结果：
+        主请求失败时直接使用对冲请求的结果，不用再从头重试；
+        主请求返回时对冲请求已经成功，则使用先完成的对冲请求的结果。
+
+        :returns: (响应, 对冲结果)，对冲结果为None表示没有发起对冲请求，True表示对冲请求先成功返回
+        """
+        from concurrent.futures import Future
+        hedge = Future()
+
+        def run_hedge():
+            try:
+                hedge.set_result(request(hedge_url))
+            except BaseException as e:
+                hedge.set_exception(e)
+
+        def start_hedge():
+            # 主请求已经返回时，hedge已被取消
+            if not hedge.set_running_or_notify_cancel():
+                return
+            jm_log('image.hedge', f'图片请求超过{delay:.2f}s未返回，发起对冲请求: [{hedge_url}]')
+            self.executor.submit(run_hedge)
+
+        timer = self.schedule(delay, start_hedge)
+        try:
+            resp, error = request(url), None
+        except Exception as e:
+            resp, error = None, e
+        finally:
+            self.cancel(timer)
+
+        if hedge.cancel():
+            if error is not None:
+                raise error
+            return resp, None
+
+        if error is None:
+            if hedge.done() and hedge.exception() is None:
+                self.close_resp(resp)
+                return hedge.result(), True
+
+            self.discard(hedge)
+            return resp, False
+
+        try:
+            return hedge.result(), True
+        except Exception:
+            raise error
+
+    def schedule(self, delay: float, func: Callable) -> list:
+        """
+        delay秒后在定时线程上执行func，所有请求共用一个定时线程，不会为每个请求创建线程
+        """
+        with self.timer_cond:
+            entry = [monotonic() + delay, next(self.timer_seq), func]
+            heapq.heappush(self.timer_heap, entry)
+
+            if self.timer_thread is None:
+                self.timer_thread = Thread(target=self.run_timer, name='jm-hedge-timer', daemon=True)
+                self.timer_thread.start()
+
+            self.timer_cond.notify()
+        return entry
+
+    def cancel(self, entry: list):
+        with self.timer_cond:
+            entry[2] = None
+
+    def run_timer(self):
+        while True:
+            with self.timer_cond:
+                while len(self.timer_heap) == 0:
+                    self.timer_cond.wait()
+
+                remain = self.timer_heap[0][0] - monotonic()
+                if remain > 0:
+                    self.timer_cond.wait(remain)
+                    continue
+
+                func = heapq.heappop(self.timer_heap)[2]
+
+            if func is not None:
+                func()
+
+    async def execute_async(self, request: Callable, url: str, delay: float, hedge_url: str):
+        """
+        execute 的协程版本，request为返回协程的方法，落后的请求会被取消
+        """
+        primary = asyncio.ensure_future(request(url))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result(), None
+
+        jm_log('image.hedge', f'图片请求超过{delay:.2f}s未返回，发起对冲请求: [{hedge_url}]')
+        hedge = asyncio.ensure_future(request(hedge_url))
+
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return future.result(), future is hedge
+
+                error = future.exception()
+
+        raise error
+
+    @classmethod
+    def discard(cls, future):
+        """
+        丢弃落后的请求。同步请求无法中途取消，只能等它完成后关闭流式响应，释放连接
+        """
+        if future.cancel():
+            return
+
+        def close(f):
+            if f.exception() is None:
+                cls.close_resp(f.result())
+
+        future.add_done_callback(close)
+
+    @staticmethod
+    def close_resp(resp):
+        if isinstance(resp, JmImageResp) and resp.is_stream:
+            resp.resp.close()
+
+    @classmethod
+    def from_conf(cls, conf: Optional[dict]) -> Optional['JmImageHedge']:
+        """
+        根据 download.image.hedge 配置创建，enable为false时返回None
+        """
+        if not conf or not conf.get('enable', False):
+            return None
+
+        conf = {k: v for k, v in conf.items() if k != 'enable' and v is not None}
+        return cls(**conf)
+
+
 # 抽象基类，实现了域名管理，发请求，重试机制，log，缓存等功能
 class AbstractJmClient(
     JmcomicClient,
@@ -29,6 +824,11 @@ class AbstractJmClient(
         self.domain_list = domain_list
         self.domain_retry_strategy = domain_retry_strategy
         self.CLIENT_CACHE = None
+        self.limiter: Optional[JmHostLimiter] = None
+        self.retry_policy = JmRetryPolicy()
+        self.domain_health: Optional[JmDomainHealth] = None
+        self.circuit_breaker: Optional[JmCircuitBreaker] = None
+        self.metrics: Optional[JmDownloadMetrics] = None
         self._username = None  # help for favorite_folder method
         if domain_retry_strategy:
             domain_retry_strategy(self)
@@ -39,16 +839,112 @@ class AbstractJmClient(
         pass
 
     def get(self, url, **kwargs):
-        return self.request_with_retry(self.postman.get, url, **kwargs)
+        return self.request_with_retry(self.limit_request(self.postman.get), url, **kwargs)
 
     def post(self, url, **kwargs):
-        return self.request_with_retry(self.postman.post, url, **kwargs)
+        return self.request_with_retry(self.limit_request(self.postman.post), url, **kwargs)
+
+    def limit_request(self, request):
+        if self.limiter is None:
+            return request
+
+        return self.limiter.limit(request)
+
+    def set_limiter(self, limiter: Optional[JmHostLimiter]):
+        self.limiter = limiter
+
+    def set_retry_policy(self, retry_policy: JmRetryPolicy):
+        self.retry_policy = retry_policy
+
+    def set_image_hedge(self, image_hedge: Optional[JmImageHedge]):
+        self.image_hedge = image_hedge
+
+    def set_decode_backend(self, decode_backend: str):
+        self.decode_backend = decode_backend
+
+    def set_encode_profile(self, encode_profile: Optional[dict]):
+        self.encode_profile = encode_profile
+
+    def set_defer_decode(self, defer_decode: bool):
+        self.defer_decode = defer_decode
+
+    def set_domain_health(self, domain_health: Optional[JmDomainHealth]):
+        self.domain_health = domain_health
+
+    def get_request_domain_list(self) -> List[str]:
+        """
+        本次请求使用的域名顺序，启用了域名健康度时，按健康度排序
+        """
+        if self.domain_health is None:
+            return self.domain_list
+
+        return self.domain_health.sort(self.domain_list)
+
+    def rerank_domain_list(self, domain_list: List[str], domain_index: int) -> List[str]:
+        """
+        切换域名时，按最新的健康度重新排序还没尝试过的域名（其他线程的请求可能已经更新了健康度）
+        """
+        if self.domain_health is None or domain_index >= len(domain_list):
+            return domain_list
+
+        return domain_list[:domain_index] + self.domain_health.sort(domain_list[domain_index:])
+
+    def set_circuit_breaker(self, circuit_breaker: Optional[JmCircuitBreaker]):
+        self.circuit_breaker = circuit_breaker
+
+    def allow_request_to(self, url: str, domain: str) -> bool:
+        """
+        熔断中的域名直接跳过，不发请求
+        """
+        if self.circuit_breaker is None:
+            return True
+
+        if url.startswith('/'):
+            url = self.of_api_url(url, domain)
+
+        return self.circuit_breaker.allow(JmHostLimiter.parse_host(url))
+
+    def record_request_result(self,
+                              url: str,
+                              begin: float,
+                              e: Optional[Exception] = None,
+                              no_retry_status: Iterable[int] = (),
+                              ):
+        """
+        记录一次请求的结果，用于域名健康度和熔断。
+        不需要重试的异常（见 client.retry 和 JmRetryPolicy.should_retry）说明域名本身是正常的，不计入熔断的失败次数
+        """
+        host = JmHostLimiter.parse_host(url)
+
+        if self.domain_health is not None:
+            self.domain_health.record(host, monotonic() - begin, e is None)
+
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(host, e is None or not self.retry_policy.should_retry(e, no_retry_status))
+
+    def set_metrics(self, metrics: Optional[JmDownloadMetrics]):
+        self.metrics = metrics
+
+        postman = self.get_root_postman()
+        if isinstance(postman, JmSessionPoolPostman):
+            postman.metrics = metrics
 
     def of_api_url(self, api_path, domain):
         return JmcomicText.format_url(api_path, domain)
 
-    def get_jm_image(self, img_url) -> JmImageResp:
-        return self.get(img_url, is_image=True, headers=JmModuleConfig.new_html_headers())
+    def get_jm_image(self, img_url, stream=False, offset=0) -> JmImageResp:
+        headers = JmModuleConfig.new_html_headers()
+        if offset != 0:
+            # 断点续传，从已接收的字节数继续
+            headers['Range'] = f'bytes={offset}-'
+
+        # 断点续传的Range已失效（416）时不重试，由 download_image 删除临时文件后重新下载完整图片
+        no_retry_status = (416,) if offset != 0 else ()
+
+        if stream is True:
+            return self.get(img_url, is_image=True, headers=headers, stream=True, no_retry_status=no_retry_status)
+
+        return self.get(img_url, is_image=True, headers=headers, no_retry_status=no_retry_status)
 
     def request_with_retry(self,
                            request,
@@ -56,6 +952,7 @@ class AbstractJmClient(
                            domain_index=0,
                            retry_count=0,
                            is_image=False,
+                           no_retry_status: Iterable[int] = (),
                            **kwargs,
                            ):
         """
@@ -70,6 +967,7 @@ class AbstractJmClient(
         :param domain_index: 域名下标
         :param retry_count: 重试次数
         :param is_image: 是否是图片请求
+        :param no_retry_status: 本次请求额外不重试的HTTP状态码，见 JmRetryPolicy.should_retry
         :param kwargs: 请求方法的kwargs
         """
         if self.domain_retry_strategy:
@@ -77,22 +975,62 @@ class AbstractJmClient(
                                               request,
                                               url,
                                               is_image,
+                                              no_retry_status=no_retry_status,
                                               **kwargs,
                                               )
 
-        if domain_index >= len(self.domain_list):
-            return self.fallback(request, url, domain_index, retry_count, is_image, **kwargs)
+        state = self.retry_policy.start()
+        domain_list = self.get_request_domain_list()
+
+        while domain_index < len(domain_list):
+            if not self.allow_request_to(url, domain_list[domain_index]):
+                domain_index, retry_count = domain_index + 1, 0
+                continue
+
+            req_url = self.prepare_retry_request(url, domain_list, domain_index, retry_count, is_image, kwargs)
+
+            begin = monotonic()
+            try:
+                resp = request(req_url, **kwargs)
+                # 在最后返回之前，还可以判断resp是否重试
+                resp = self.raise_if_resp_should_retry(resp, is_image)
+                self.record_request_result(req_url, begin)
+                return resp
+            except Exception as e:
+                self.record_request_result(req_url, begin, e, no_retry_status)
+                if self.retry_times == 0 or not self.retry_policy.should_retry(e, no_retry_status):
+                    raise e
+
+                self.before_retry(e, kwargs, retry_count, req_url)
+
+            domain_index, retry_count = self.next_retry_index(domain_index, retry_count)
+            if domain_index >= len(domain_list):
+                break
+            if retry_count == 0:
+                domain_list = self.rerank_domain_list(domain_list, domain_index)
 
-        url_backup = url
+            delay = self.decide_retry_delay(state, url)
+            if delay is None:
+                break
+            if delay > 0:
+                sleep(delay)
+
+        return self.fallback(request, url, domain_index, retry_count, is_image, **kwargs)
+
+    def prepare_retry_request(self, url, domain_list, domain_index, retry_count, is_image, kwargs) -> str:
+        """
+        为第 retry_count 次重试、第 domain_index 个域名准备请求url，并打印重试日志
+        """
+        req_url = url
 
         if url.startswith('/'):
             # path → url
-            domain = self.domain_list[domain_index]
-            url = self.of_api_url(url, domain)
+            domain = domain_list[domain_index]
+            req_url = self.of_api_url(url, domain)
 
             self.update_request_with_specify_domain(kwargs, domain, is_image)
 
-            jm_log(self.log_topic(), self.decode(url))
+            jm_log(self.log_topic(), self.decode(req_url))
         elif is_image:
             # 图片url
             self.update_request_with_specify_domain(kwargs, None, is_image)
@@ -101,27 +1039,96 @@ class AbstractJmClient(
             jm_log(f'req.retry',
                    ', '.join([
                        f'次数: [{retry_count}/{self.retry_times}]',
-                       f'域名: [{domain_index} of {self.domain_list}]',
-                       f'路径: [{url}]',
-                       f'参数: [{kwargs if "login" not in url else "#login_form#"}]'
+                       f'域名: [{domain_index} of {domain_list}]',
+                       f'路径: [{req_url}]',
+                       f'参数: [{kwargs if "login" not in req_url else "#login_form#"}]'
                    ])
                    )
 
-        try:
-            resp = request(url, **kwargs)
-            # 在最后返回之前，还可以判断resp是否重试
-            resp = self.raise_if_resp_should_retry(resp, is_image)
-            return resp
-        except Exception as e:
-            if self.retry_times == 0:
-                raise e
-
-            self.before_retry(e, kwargs, retry_count, url)
+        return req_url
 
+    def next_retry_index(self, domain_index, retry_count) -> Tuple[int, int]:
+        """
+        同一个域名重试 retry_times 次后，切换到下一个域名
+        """
         if retry_count < self.retry_times:
-            return self.request_with_retry(request, url_backup, domain_index, retry_count + 1, is_image, **kwargs)
-        else:
-            return self.request_with_retry(request, url_backup, domain_index + 1, 0, is_image, **kwargs)
+            return domain_index, retry_count + 1
+
+        return domain_index + 1, 0
+
+    # noinspection PyMethodMayBeStatic
+    def decide_retry_delay(self, state: JmRetryState, url) -> Optional[float]:
+        """
+        下一次重试前的等待秒数，返回None表示已超过总耗时上限，不再重试
+        """
+        delay = state.next_delay()
+        if delay is None:
+            jm_log('req.retry', f'超过请求总耗时上限 [{state.policy.deadline}s]，不再重试: [{url}]')
+        return delay
+
+    def new_async_postman(self, max_clients: int) -> JmAsyncPostman:
+        """
+        创建与当前client共用元数据的异步postman，需要在事件循环内调用
+        """
+        return JmAsyncPostman(self.get_meta_data().copy(), max_clients)
+
+    async def get_jm_image_async(self, postman: JmAsyncPostman, img_url) -> JmImageResp:
+        return await self.request_with_retry_async(postman.get,
+                                                   img_url,
+                                                   is_image=True,
+                                                   headers=JmModuleConfig.new_html_headers(),
+                                                   )
+
+    async def request_with_retry_async(self,
+                                       request,
+                                       url,
+                                       domain_index=0,
+                                       retry_count=0,
+                                       is_image=False,
+                                       no_retry_status: Iterable[int] = (),
+                                       **kwargs,
+                                       ):
+        """
+        request_with_retry 的协程版本，request为异步请求方法，重试和切换域名的规则与同步版本一致。
+
+        domain_retry_strategy（例如 AdvancedRetryPlugin）是同步实现，不作用于本方法。
+        """
+        state = self.retry_policy.start()
+        domain_list = self.get_request_domain_list()
+
+        while domain_index < len(domain_list):
+            if not self.allow_request_to(url, domain_list[domain_index]):
+                domain_index, retry_count = domain_index + 1, 0
+                continue
+
+            req_url = self.prepare_retry_request(url, domain_list, domain_index, retry_count, is_image, kwargs)
+
+            begin = monotonic()
+            try:
+                resp = await request(req_url, **kwargs)
+                resp = self.raise_if_resp_should_retry(resp, is_image)
+                self.record_request_result(req_url, begin)
+                return resp
+            except Exception as e:
+                self.record_request_result(req_url, begin, e, no_retry_status)
+                if self.retry_times == 0 or not self.retry_policy.should_retry(e, no_retry_status):
+                    raise e
+
+                self.before_retry(e, kwargs, retry_count, req_url)
+
+            domain_index, retry_count = self.next_retry_index(domain_index, retry_count)
+            if domain_index >= len(domain_list):
+                break
+            if retry_count == 0:
+                domain_list = self.rerank_domain_list(domain_list, domain_index)
+
+            delay = self.decide_retry_delay(state, url)
+            if delay is None:
+                break
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        return self.fallback(request, url, domain_index, retry_count, is_image, **kwargs)
 
     # noinspection PyMethodMayBeStatic
     def raise_if_resp_should_retry(self, resp, is_image):
@@ -147,6 +1154,8 @@ class AbstractJmClient(
     # noinspection PyMethodMayBeStatic, PyUnusedLocal
     def before_retry(self, e, kwargs, retry_count, url):
         jm_log('req.error', str(e))
+        if self.metrics is not None:
+            self.metrics.inc('request_retries_total', domain=JmHostLimiter.parse_host(url))
 
     def enable_cache(self):
         # noinspection PyDefaultArgument,PyShadowingBuiltins
@@ -811,14 +1820,17 @@ class JmApiClient(AbstractJmClient):
         resp = self.req_api('/setting')
 
         # 检查禁漫最新的版本号
-        setting_ver = str(resp.model_data.version)
+        self.update_app_version(str(resp.model_data.version))
+
+        return resp
+
+    @classmethod
+    def update_app_version(cls, setting_ver: Optional[str]):
         # 禁漫接口的版本 > jmcomic库内置版本
-        if setting_ver > JmMagicConstants.APP_VERSION and JmModuleConfig.FLAG_USE_VERSION_NEWER_IF_BEHIND:
+        if setting_ver and setting_ver > JmMagicConstants.APP_VERSION and JmModuleConfig.FLAG_USE_VERSION_NEWER_IF_BEHIND:
             jm_log('api.setting', f'change APP_VERSION from [{JmMagicConstants.APP_VERSION}] to [{setting_ver}]')
             JmMagicConstants.APP_VERSION = setting_ver
 
-        return resp
-
     def login(self,
               username,
               password,
@@ -918,8 +1930,11 @@ class JmApiClient(AbstractJmClient):
 
     def update_request_with_specify_domain(self, kwargs: dict, domain: Optional[str], is_image=False):
         if is_image:
-            # 设置APP端的图片请求headers
+            # 设置APP端的图片请求headers，保留断点续传的Range
+            range_header = (kwargs.get('headers', None) or {}).get('Range', None)
             kwargs['headers'] = {**JmModuleConfig.APP_HEADERS_TEMPLATE, **JmModuleConfig.APP_HEADERS_IMAGE}
+            if range_header is not None:
+                kwargs['headers']['Range'] = range_header
 
     # noinspection PyMethodMayBeStatic
     def decide_headers_and_ts(self, kwargs, url):
@@ -1039,30 +2054,40 @@ class JmApiClient(AbstractJmClient):
         with self.client_update_domain_lock:
             if True is JmModuleConfig.FLAG_API_CLIENT_AUTO_UPDATE_DOMAIN_DONE:
                 return
-            # 遍历多个域名服务器
-            for url in JmModuleConfig.API_URL_DOMAIN_SERVER_LIST:
-                try:
-                    # 获取域名列表
-                    new_server_list = self.req_api_domain_server(url)
-                    if new_server_list is None:
-                        continue
-                    old_server_list = JmModuleConfig.DOMAIN_API_LIST
-                    jm_log('api.update_domain.success',
-                           f'获取到最新的API域名，替换jmcomic内置域名：(new){new_server_list} ---→ (old){old_server_list}'
-                           )
-                    # 更新域名
-                    if sorted(self.domain_list) == sorted(old_server_list):
-                        self.domain_list = new_server_list
-                    JmModuleConfig.DOMAIN_API_LIST = new_server_list
-                    break
-                except Exception as e:
-                    jm_log('api.update_domain.error',
-                           f'通过[{url}]自动更新API域名失败，仍使用jmcomic内置域名。'
-                           f'可通过代码[JmModuleConfig.FLAG_API_CLIENT_AUTO_UPDATE_DOMAIN=False]关闭自动更新API域名. 异常： {e}'
-                           )
+
+            new_server_list = JmModuleConfig.fetch_with_disk_cache('api_domain', self.fetch_api_domain)
+            if new_server_list:
+                old_server_list = JmModuleConfig.DOMAIN_API_LIST
+                jm_log('api.update_domain.success',
+                       f'获取到最新的API域名，替换jmcomic内置域名：(new){new_server_list} ---→ (old){old_server_list}'
+                       )
+                # 更新域名
+                if sorted(self.domain_list) == sorted(old_server_list):
+                    self.domain_list = new_server_list
+                JmModuleConfig.DOMAIN_API_LIST = new_server_list
+
             # set done finally
             JmModuleConfig.FLAG_API_CLIENT_AUTO_UPDATE_DOMAIN_DONE = True
 
+    def fetch_api_domain(self) -> Optional[List[str]]:
+        """
+        遍历多个域名服务器，获取最新的API域名，全部失败时返回None
+        """
+        for url in JmModuleConfig.API_URL_DOMAIN_SERVER_LIST:
+            try:
+                # 获取域名列表
+                new_server_list = self.req_api_domain_server(url)
+                if new_server_list is None:
+                    continue
+                return new_server_list
+            except Exception as e:
+                jm_log('api.update_domain.error',
+                       f'通过[{url}]自动更新API域名失败，仍使用jmcomic内置域名。'
+                       f'可通过代码[JmModuleConfig.FLAG_API_CLIENT_AUTO_UPDATE_DOMAIN=False]关闭自动更新API域名. 异常： {e}'
+                       )
+
+        return None
+
     client_init_cookies_lock = Lock()
 
     def ensure_have_cookies(self):
@@ -1077,9 +2102,14 @@ class JmApiClient(AbstractJmClient):
 
     @field_cache("APP_COOKIES", obj=JmModuleConfig)
     def get_cookies(self):
+        data = JmModuleConfig.fetch_with_disk_cache('app_cookies', self.fetch_cookies)
+        # 使用缓存时没有请求setting，按缓存的版本号更新
+        self.update_app_version(data.get('version', None))
+        return data['cookies']
+
+    def fetch_cookies(self) -> dict:
         resp = self.setting()
-        cookies = dict(resp.resp.cookies)
-        return cookies
+        return {'cookies': dict(resp.resp.cookies), 'version': JmMagicConstants.APP_VERSION}
 
 
 class PhotoConcurrentFetcherProxy(JmcomicClient):
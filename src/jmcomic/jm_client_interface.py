@@ -1,4 +1,4 @@
-from .jm_toolkit import *
+from .jm_metrics import *
 
 """
 
@@ -46,41 +46,202 @@ class JmResp:
 
 
 class JmImageResp(JmResp):
+    # 断点续传的响应头，例如 Content-Range: bytes 1000-4999/5000
+    pattern_content_range = compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+    def __init__(self, resp):
+        super().__init__(resp)
+        # 流式响应实际接收的字节数，见 stream_to_file
+        self.received_bytes = 0
+
+    @property
+    def is_stream(self) -> bool:
+        """
+        是否是流式响应（请求时使用了stream=True），此时响应体还没有读取，不能使用self.content
+        """
+        # curl_cffi 的流式响应会带有stream_task
+        return getattr(self.resp, 'stream_task', None) is not None
+
+    @property
+    def is_success(self) -> bool:
+        if self.is_stream:
+            # 响应体是否为空，在写文件时根据字节数判断
+            # 206: 断点续传的Range请求
+            return self.http_code in (200, 206)
+
+        return super().is_success
+
+    def require_success(self):
+        if self.is_stream and self.is_not_success:
+            self.resp.close()
+            ExceptionTool.raises_resp(self.error_msg(), self)
+
+        super().require_success()
 
     def error_msg(self):
         msg = f'禁漫图片获取失败: [{self.url}]'
-        if self.http_code != 200:
+        if self.http_code not in (200, 206):
             msg += f'，http状态码={self.http_code}'
-        if len(self.content) == 0:
+        if not self.is_stream and len(self.content) == 0:
             msg += f'，响应数据为空'
         return msg
 
+    def stream_to_file(self, path) -> str:
+        """
+        把流式响应的数据边接收边写入临时文件 {path}.part，不在内存中保留完整的响应体
+
+        如果是Range请求的206响应，数据追加到已有的临时文件末尾（断点续传）；
+        接收中断时保留临时文件，下次请求可以从已接收的字节数继续。
+
+        :returns: 临时文件路径
+        """
+        part_path = f'{path}.part'
+        offset, total = self.decide_stream_offset(part_path)
+        try:
+            with open(part_path, 'ab' if offset != 0 else 'wb') as f:
+                for chunk in self.resp.iter_content():
+                    f.write(chunk)
+                    self.received_bytes += len(chunk)
+        finally:
+            self.resp.close()
+
+        size = offset + self.received_bytes
+        if size == 0:
+            os.remove(part_path)
+            ExceptionTool.raises_resp(f'禁漫图片获取失败: [{self.url}]，响应数据为空', self)
+
+        # 数据不完整时不能解密，保留临时文件等待续传
+        if total is not None and size != total:
+            ExceptionTool.raises_resp(f'禁漫图片数据不完整: [{self.url}]，已接收{size}字节，共{total}字节', self)
+
+        return part_path
+
+    def decide_stream_offset(self, part_path) -> Tuple[int, Optional[int]]:
+        """
+        决定流式响应从临时文件的哪个位置开始写入
+
+        :returns: (写入位置, 图片总字节数，未知时为None)
+        """
+        headers = self.resp.headers
+        if self.http_code != 206:
+            # 没有续传，或者服务器忽略了Range请求头返回完整数据，从头写入
+            length = headers.get('Content-Length', None)
+            return 0, int(length) if length else None
+
+        content_range = headers.get('Content-Range', None) or ''
+        match = self.pattern_content_range.search(content_range)
+        start = int(match[1]) if match is not None else -1
+        size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if start != size:
+            self.resp.close()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            ExceptionTool.raises_resp(
+                f'断点续传的位置不匹配: [{self.url}]，临时文件{size}字节，Content-Range=[{content_range}]',
+                self,
+            )
+
+        return start, int(match[2]) if match[2] != '*' else None
+
     def transfer_to(self,
                     path,
                     scramble_id,
                     decode_image=True,
                     img_url=None,
+                    decode_backend=JmImageTool.DECODE_BACKEND_PIL,
+                    encode_profile=None,
+                    scramble_num=None,
                     ):
         img_url = img_url or self.url
         index = img_url.find("?")
         if index != -1:
             img_url = img_url[0:index]
 
+        if self.is_stream:
+            self.transfer_stream_to(path, scramble_id, decode_image, img_url, decode_backend, encode_profile,
+                                    scramble_num)
+            return
+
         if decode_image is False or scramble_id is None:
             # 不解密图片，直接保存文件
             JmImageTool.save_resp_img(
                 self,
                 path,
                 need_convert=suffix_not_equal(img_url, path),
+                profile=encode_profile,
             )
         else:
             # 解密图片并保存文件
-            JmImageTool.decode_and_save(
-                JmImageTool.get_num_by_url(scramble_id, img_url),
-                JmImageTool.open_image(self.content),
+            JmImageTool.decode_raw_and_save(
+                self.decide_scramble_num(scramble_id, img_url, scramble_num),
+                self.content,
                 path,
+                decode_backend,
+                encode_profile,
             )
 
+    @staticmethod
+    def decide_scramble_num(scramble_id, img_url, scramble_num: Optional[int]) -> int:
+        """
+        图片的分割数，优先使用章节的解密计划（见 JmImageTool.get_descramble_plan），没有时根据url计算
+        """
+        if scramble_num is not None:
+            return scramble_num
+
+        return JmImageTool.get_num_by_url(scramble_id, img_url)
+
+    def transfer_deferred_to(self, path, scramble_id, img_url=None, scramble_num=None):
+        """
+        延迟解密：保存原始的混淆图片和记录分割数的附属文件，见 JmImageTool.save_deferred
+        """
+        img_url = (img_url or self.url).split('?', 1)[0]
+        num = self.decide_scramble_num(scramble_id, img_url, scramble_num)
+
+        if not self.is_stream:
+            JmImageTool.save_deferred(self.content, path, num)
+            return
+
+        part_path = self.stream_to_file(path)
+        try:
+            JmImageTool.save_deferred(part_path, path, num)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    def transfer_stream_to(self,
+                           path,
+                           scramble_id,
+                           decode_image,
+                           img_url,
+                           decode_backend=JmImageTool.DECODE_BACKEND_PIL,
+                           encode_profile=None,
+                           scramble_num=None,
+                           ):
+        """
+        流式响应的 transfer_to：先写入临时文件，
+        不需要解密和转换格式的图片，直接把临时文件重命名为目标文件；否则从临时文件读取图片处理
+        """
+        part_path = self.stream_to_file(path)
+        try:
+            if decode_image is False or scramble_id is None:
+                if not suffix_not_equal(img_url, path):
+                    os.replace(part_path, path)
+                    return
+
+                with JmImageTool.open_image(part_path) as img_src:
+                    JmImageTool.save_image(img_src, path, encode_profile)
+            else:
+                JmImageTool.decode_raw_and_save(
+                    self.decide_scramble_num(scramble_id, img_url, scramble_num),
+                    part_path,
+                    path,
+                    decode_backend,
+                    encode_profile,
+                )
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
 
 class JmJsonResp(JmResp):
 
@@ -240,6 +401,16 @@ class JmUserClient:
 
 
 class JmImageClient:
+    # 下载过程的统计指标，由downloader设置，见 JmDownloadMetrics
+    metrics: Optional[JmDownloadMetrics] = None
+    # 图片对冲请求，由option设置，见 JmImageHedge
+    image_hedge: Optional['JmImageHedge'] = None
+    # 图片解密的实现，由option设置，见 JmImageTool.decode_and_save
+    decode_backend: str = JmImageTool.DECODE_BACKEND_PIL
+    # 图片编码配置，由option设置，见 JmImageTool.save_image
+    encode_profile: Optional[dict] = None
+    # 延迟解密，由option设置，见 JmImageTool.save_deferred
+    defer_decode: bool = False
 
     # -- 下载图片 --
 
@@ -248,6 +419,8 @@ class JmImageClient:
                        img_save_path: str,
                        scramble_id: Optional[int] = None,
                        decode_image=True,
+                       stream=False,
+                       scramble_num=None,
                        ):
         """
         下载JM的图片
@@ -255,33 +428,209 @@ class JmImageClient:
         :param img_save_path: 图片保存位置
         :param scramble_id: 图片所在photo的scramble_id
         :param decode_image: 要保存的是解密后的图还是原图
+        :param stream: 是否流式下载，边接收边写入临时文件，不在内存中保留完整的响应体
+        :param scramble_num: 图片的分割数，为None时根据url计算，见 JmImageTool.get_descramble_plan
+        """
+        part_path = f'{img_save_path}.part'
+        resume_count = 0
+        while True:
+            # 流式下载时，如果有上次中断留下的临时文件，从已接收的字节数继续
+            offset = os.path.getsize(part_path) if stream and os.path.exists(part_path) else 0
+
+            # 请求图片
+            try:
+                with self.time_stage('image_fetch_seconds', 'image_fetch_inflight'):
+                    resp = self.fetch_jm_image(img_url, stream, offset)
+            except Exception as e:
+                if offset == 0:
+                    raise
+
+                # Range请求失败（例如临时文件已失效，服务器返回416），删除临时文件后重新下载完整图片
+                jm_log('image.resume', f'断点续传失败，重新下载完整图片: [{img_url}]，异常: {e}')
+                os.remove(part_path)
+                continue
+
+            resp.require_success()
+
+            try:
+                with self.time_stage(self.decide_save_stage(decode_image, scramble_id)):
+                    return self.save_image_resp(decode_image, img_save_path, img_url, resp, scramble_id, scramble_num)
+            except Exception as e:
+                # 接收中断，且本次有新数据写入临时文件，则断点续传，否则抛出异常
+                if not (resp.is_stream and resp.received_bytes != 0 and os.path.exists(part_path)) \
+                        or resume_count >= self.decide_image_resume_times():
+                    raise
+
+                resume_count += 1
+                jm_log('image.resume',
+                       f'图片数据接收中断，已接收{os.path.getsize(part_path)}字节，断点续传: [{img_url}]，异常: {e}')
+            finally:
+                self.record_image_bytes(resp)
+
+    def decide_image_resume_times(self) -> int:
+        """
+        单次下载图片时，接收中断后最多断点续传的次数，与请求重试次数相同
+        """
+        return getattr(self, 'retry_times', 0)
+
+    # noinspection PyMethodMayBeStatic
+    def save_image_resp(self, decode_image, img_save_path, img_url, resp, scramble_id, scramble_num=None):
+        if self.defer_decode is True and decode_image is not False and scramble_id is not None:
+            resp.transfer_deferred_to(img_save_path, scramble_id, img_url, scramble_num)
+            return
+
+        resp.transfer_to(img_save_path, scramble_id, decode_image, img_url,
+                         self.decode_backend, self.encode_profile, scramble_num)
+
+    def time_stage(self, name: str, inflight: Optional[str] = None):
         """
-        # 请求图片
-        resp = self.get_jm_image(img_url)
+        统计图片下载某个阶段的耗时，未设置metrics时不做任何事
+        """
+        if self.metrics is None:
+            from contextlib import nullcontext
+            return nullcontext()
 
-        resp.require_success()
+        return self.metrics.time(name, inflight)
 
-        return self.save_image_resp(decode_image, img_save_path, img_url, resp, scramble_id)
+    def record_image_bytes(self, resp: JmImageResp):
+        if self.metrics is not None:
+            self.metrics.inc('bytes_received_total', resp.received_bytes if resp.is_stream else len(resp.content))
 
-    # noinspection PyMethodMayBeStatic
-    def save_image_resp(self, decode_image, img_save_path, img_url, resp, scramble_id):
-        resp.transfer_to(img_save_path, scramble_id, decode_image, img_url)
+    @staticmethod
+    def decide_save_stage(decode_image, scramble_id) -> str:
+        if decode_image is False or scramble_id is None:
+            return 'image_write_seconds'
+
+        return 'image_decode_seconds'
 
     def download_by_image_detail(self,
                                  image: JmImageDetail,
                                  img_save_path,
                                  decode_image=True,
+                                 stream=False,
                                  ):
         return self.download_image(
             image.download_url,
             img_save_path,
             int(image.scramble_id),
             decode_image=decode_image,
+            stream=stream,
+            scramble_num=image.scramble_num,
         )
 
-    def get_jm_image(self, img_url) -> JmImageResp:
+    def get_jm_image(self, img_url, stream=False, offset=0) -> JmImageResp:
+        """
+        :param offset: 断点续传时已接收的字节数，不为0时带上Range请求头
+        """
         raise NotImplementedError
 
+    def fetch_jm_image(self, img_url, stream=False, offset=0) -> JmImageResp:
+        """
+        请求图片，启用了对冲请求时，请求超时未返回会向备用域名再发一个请求，取先成功的
+        """
+        img_url = self.decide_image_url(img_url)
+        if self.image_hedge is None:
+            return self.get_jm_image(img_url, stream, offset)
+
+        resp, hedged = self.image_hedge.execute(
+            lambda url: self.get_jm_image(url, stream, offset),
+            img_url,
+            self.image_hedge.decide_delay(self.metrics),
+            self.image_hedge.alternate_url(img_url, getattr(self, 'domain_health', None)),
+        )
+        self.record_hedge(hedged)
+        return resp
+
+    def decide_image_url(self, img_url: str) -> str:
+        """
+        启用了域名健康度时，图片请求换用 JmModuleConfig.DOMAIN_IMAGE_LIST 中健康度最好的图片域名。
+        图片原本的域名排在其他图片域名之前，没有请求过的图片域名不会抢在它前面
+        """
+        domain_health = getattr(self, 'domain_health', None)
+        if domain_health is None:
+            return img_url
+
+        from urllib.parse import urlparse
+        host = urlparse(img_url).netloc
+        if host not in JmModuleConfig.DOMAIN_IMAGE_LIST:
+            return img_url
+
+        candidates = [host] + [domain for domain in JmModuleConfig.DOMAIN_IMAGE_LIST if domain != host]
+        domain = domain_health.sort(candidates)[0]
+        return img_url if domain == host else img_url.replace(host, domain, 1)
+
+    def record_hedge(self, hedged: Optional[bool]):
+        if self.metrics is None or hedged is None:
+            return
+
+        self.metrics.inc('image_hedges_total')
+        if hedged is True:
+            self.metrics.inc('image_hedge_wins_total')
+
+    # -- 异步下载图片，供 AsyncJmDownloader 使用 --
+
+    async def download_image_async(self,
+                                   postman,
+                                   img_url: str,
+                                   img_save_path: str,
+                                   scramble_id: Optional[int] = None,
+                                   decode_image=True,
+                                   scramble_num=None,
+                                   ):
+        """
+        download_image 的协程版本
+        图片请求在事件循环上进行，解密和保存文件属于CPU/IO操作，交给线程池执行，避免阻塞事件循环
+
+        :param postman: 异步postman，见 AbstractJmClient.new_async_postman
+        """
+        with self.time_stage('image_fetch_seconds', 'image_fetch_inflight'):
+            resp = await self.fetch_jm_image_async(postman, img_url)
+
+        resp.require_success()
+        self.record_image_bytes(resp)
+
+        import asyncio
+        with self.time_stage(self.decide_save_stage(decode_image, scramble_id)):
+            return await asyncio.get_running_loop().run_in_executor(
+                None,
+                JmImageTool.retry_on_missing_dir,
+                img_save_path,
+                self.save_image_resp,
+                decode_image, img_save_path, img_url, resp, scramble_id, scramble_num,
+            )
+
+    async def download_by_image_detail_async(self,
+                                             postman,
+                                             image: JmImageDetail,
+                                             img_save_path,
+                                             decode_image=True,
+                                             ):
+        return await self.download_image_async(
+            postman,
+            image.download_url,
+            img_save_path,
+            int(image.scramble_id),
+            decode_image=decode_image,
+            scramble_num=image.scramble_num,
+        )
+
+    async def get_jm_image_async(self, postman, img_url) -> JmImageResp:
+        raise NotImplementedError
+
+    async def fetch_jm_image_async(self, postman, img_url) -> JmImageResp:
+        img_url = self.decide_image_url(img_url)
+        if self.image_hedge is None:
+            return await self.get_jm_image_async(postman, img_url)
+
+        resp, hedged = await self.image_hedge.execute_async(
+            lambda url: self.get_jm_image_async(postman, url),
+            img_url,
+            self.image_hedge.decide_delay(self.metrics),
+            self.image_hedge.alternate_url(img_url, getattr(self, 'domain_health', None)),
+        )
+        self.record_hedge(hedged)
+        return resp
+
     @classmethod
     def img_is_not_need_to_decode(cls, data_original: str, _resp) -> bool:
         # https://cdn-msp2.18comic.vip/media/photos/498976/00027.gif?v=1697541064
@@ -14,6 +14,143 @@ def default_jm_logging(topic: str, msg: str):
     print('[{}] [{}]:【{}】{}'.format(format_ts(), current_thread().name, topic, msg))
 
 
+def file_lock(filepath: str):
+    """
+    进程间的文件锁（with语法），锁住的是 {filepath}.lock 文件
+    """
+    import os
+    from contextlib import contextmanager
+
+    @contextmanager
+    def lock():
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        with open(f'{filepath}.lock', 'a+b') as f:
+            if os.name == 'nt':
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                try:
+                    yield
+                finally:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    return lock()
+
+
+class JmDiskCache:
+    """
+    磁盘缓存（json文件），缓存API域名、移动端cookies等每次启动都要联网获取的数据，
+    多个进程共用同一个缓存文件。
+
+    - 超过ttl的条目依然返回，同时在后台线程重新获取并更新
+    - 超过max_age的条目视为不存在，同步重新获取
+    - 写入时持有文件锁，读取-合并-写入期间其他进程不能写入，不会丢失其他进程写入的条目
+    - 写入时先写临时文件再替换，其他进程不会读到写了一半的文件
+
+    缓存文件中包含移动端cookies，默认不启用，可通过配置项 client.disk_cache 启用
+    """
+
+    def __init__(self, filepath: str, ttl: float, max_age: float):
+        from threading import Lock
+        self.filepath = filepath
+        self.ttl = ttl
+        self.max_age = max_age
+        self.lock = Lock()
+        self.refreshing = set()
+
+    def load(self) -> dict:
+        import json
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        return data if isinstance(data, dict) else {}
+
+    def get(self, key: str):
+        """
+        :returns: (value, 已缓存的秒数)，没有缓存或缓存已超过max_age时返回None
+        """
+        import time
+        entry = self.load().get(key, None)
+        if not isinstance(entry, dict) or 'time' not in entry:
+            return None
+
+        age = time.time() - entry['time']
+        if age < 0 or age > self.max_age:
+            return None
+
+        return entry['value'], age
+
+    def put(self, key: str, value):
+        import json
+        import os
+        import time
+        from threading import get_ident
+
+        tmp = f'{self.filepath}.{os.getpid()}.{get_ident()}.tmp'
+        try:
+            with self.lock, file_lock(self.filepath):
+                # 持有文件锁后重新读取，保留其他进程写入的条目
+                data = self.load()
+                data[key] = {'time': time.time(), 'value': value}
+
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp, self.filepath)
+        except OSError as e:
+            JmModuleConfig.jm_log('cache.disk.error', f'写入磁盘缓存失败: [{self.filepath}], {e}')
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def get_or_fetch(self, key: str, fetch):
+        """
+        :param fetch: 获取数据的方法，返回None表示获取失败，不写入缓存
+        """
+        entry = self.get(key)
+        if entry is None:
+            value = fetch()
+            if value is not None:
+                self.put(key, value)
+            return value
+
+        value, age = entry
+        JmModuleConfig.jm_log('cache.disk.hit', f'使用磁盘缓存: [{key}], 已缓存{int(age)}秒')
+        if age > self.ttl:
+            self.refresh_in_background(key, fetch)
+
+        return value
+
+    def refresh_in_background(self, key: str, fetch):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                value = fetch()
+                if value is not None:
+                    self.put(key, value)
+            except Exception as e:
+                JmModuleConfig.jm_log('cache.disk.error', f'后台更新磁盘缓存失败: [{key}], {e}')
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        from threading import Thread
+        Thread(target=refresh, daemon=True).start()
+
+
 # 禁漫常量
 class JmMagicConstants:
     # 搜索参数-排序
@@ -199,6 +336,29 @@ class JmModuleConfig:
     # value: 函数，参数只有异常对象，无需返回值
     # 这个异常类（或者这个异常的子类）的实例将要被raise前，你的listener方法会被调用
     REGISTRY_EXCEPTION_LISTENER = {}
+    # 图片编码配置，用于 download.image.profile
+    # key: 配置名
+    # value: dict，key是PIL的图片格式名，value是传给 Image.save 的参数。没有列出的格式使用PIL的默认参数
+    REGISTRY_IMAGE_ENCODE_PROFILE = {
+        # 编码最快，适合边下边看
+        'fast': {
+            'JPEG': {'quality': 85, 'optimize': False, 'progressive': False},
+            'WEBP': {'quality': 80, 'method': 0},
+            'PNG': {'compress_level': 1},
+        },
+        # 在速度和文件大小之间折中
+        'balanced': {
+            'JPEG': {'quality': 90, 'optimize': True},
+            'WEBP': {'quality': 85, 'method': 4},
+            'PNG': {'compress_level': 6},
+        },
+        # 文件最小、画质最好，编码最慢，适合长期存档
+        'archival': {
+            'JPEG': {'quality': 95, 'optimize': True, 'progressive': True, 'subsampling': 0},
+            'WEBP': {'lossless': True, 'quality': 100, 'method': 6},
+            'PNG': {'compress_level': 9},
+        },
+    }
 
     # 执行log的函数
     EXECUTOR_LOG = default_jm_logging
@@ -216,6 +376,8 @@ class JmModuleConfig:
     FLAG_DECODE_URL_WHEN_LOGGING = True
     # 当内置的版本号落后时，使用最新的禁漫app版本号
     FLAG_USE_VERSION_NEWER_IF_BEHIND = True
+    # 解密jpg图片并保存为jpg时，尽量在熵编码层面无损重排，跳过解码和重新编码，见 JmJpegTool
+    FLAG_JPEG_LOSSLESS_DECODE = True
 
     # 关联dir_rule的自定义字段与对应的处理函数
     # 例如:
@@ -227,6 +389,17 @@ class JmModuleConfig:
     # 把文件名限制在指定个字符以内
     VAR_FILE_NAME_LENGTH_LIMIT = 100
 
+    # 磁盘缓存API域名、移动端cookies，见 JmDiskCache。
+    # 缓存文件包含cookies，默认不启用，也可以通过配置项 client.disk_cache 启用
+    FLAG_USE_DISK_CACHE = False
+    # 缓存文件路径，None表示 ~/.jmcomic/cache.json
+    VAR_DISK_CACHE_FILEPATH = None
+    # 超过该秒数的缓存会在后台重新获取
+    VAR_DISK_CACHE_TTL = 6 * 60 * 60
+    # 超过该秒数的缓存不再使用
+    VAR_DISK_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+    DISK_CACHE_REGISTRY = {}
+
     @classmethod
     def downloader_class(cls):
         if cls.CLASS_DOWNLOADER is not None:
@@ -278,6 +451,33 @@ class JmModuleConfig:
 
         return clazz
 
+    @classmethod
+    def disk_cache(cls) -> 'Optional[JmDiskCache]':
+        if cls.FLAG_USE_DISK_CACHE is not True:
+            return None
+
+        import os
+        filepath = cls.VAR_DISK_CACHE_FILEPATH or os.path.join(os.path.expanduser('~'), '.jmcomic', 'cache.json')
+        cache = cls.DISK_CACHE_REGISTRY.get(filepath, None)
+        if cache is None:
+            cache = cls.DISK_CACHE_REGISTRY.setdefault(
+                filepath,
+                JmDiskCache(filepath, cls.VAR_DISK_CACHE_TTL, cls.VAR_DISK_CACHE_MAX_AGE),
+            )
+
+        return cache
+
+    @classmethod
+    def fetch_with_disk_cache(cls, key: str, fetch):
+        """
+        优先使用磁盘缓存，没有缓存时调用fetch获取并写入缓存
+        """
+        cache = cls.disk_cache()
+        if cache is None:
+            return fetch()
+
+        return cache.get_or_fetch(key, fetch)
+
     @classmethod
     @field_cache("DOMAIN_HTML")
     def get_html_domain(cls, postman=None):
@@ -287,7 +487,10 @@ class JmModuleConfig:
         这样一来，配置文件也不用配置域名了，一切都在运行时动态获取。
         """
         from .jm_toolkit import JmcomicText
-        return JmcomicText.parse_to_jm_domain(cls.get_html_url(postman))
+        return cls.fetch_with_disk_cache(
+            'html_domain',
+            lambda: JmcomicText.parse_to_jm_domain(cls.get_html_url(postman)),
+        )
 
     @classmethod
     def get_html_url(cls, postman=None):
@@ -309,6 +512,10 @@ class JmModuleConfig:
 
         :returns: ['18comic.vip', ..., 'jm365.xyz/ZNPJam'], 最后一个是【APP軟件下載】
         """
+        return cls.fetch_with_disk_cache('html_domain_all', lambda: cls.fetch_html_domain_all(postman))
+
+    @classmethod
+    def fetch_html_domain_all(cls, postman=None):
         postman = postman or cls.new_postman(session=True)
 
         resp = postman.get(cls.JM_PUB_URL)
@@ -388,6 +595,17 @@ class JmModuleConfig:
     def disable_jm_log(cls):
         cls.FLAG_ENABLE_JM_LOG = False
 
+    @classmethod
+    def enable_disk_cache(cls, filepath: 'Optional[str]' = None):
+        """
+        启用磁盘缓存，见 JmDiskCache
+
+        :param filepath: 缓存文件路径，None表示使用 VAR_DISK_CACHE_FILEPATH
+        """
+        cls.FLAG_USE_DISK_CACHE = True
+        if filepath is not None:
+            cls.VAR_DISK_CACHE_FILEPATH = filepath
+
     @classmethod
     def new_postman(cls, session=False, **kwargs):
         kwargs.setdefault('impersonate', 'chrome')
@@ -414,10 +632,35 @@ class JmModuleConfig:
         'dir_rule': {'rule': 'Bd_Pname', 'base_dir': None, 'normalize_zh': None},
         'download': {
             'cache': True,
-            'image': {'decode': True, 'suffix': None},
+            'cache_check_size': False,
+            'image': {
+                'decode': True,
+                'decode_backend': 'pil',
+                'profile': None,
+                'defer_decode': {
+                    'enable': False,
+                    'workers': 1,
+                },
+                'suffix': None,
+                'stream': False,
+                'hedge': {
+                    'enable': False,
+                    'quantile': 0.95,
+                    'min_delay': 1,
+                    'max_delay': 10,
+                    'alternate': True,
+                    'max_workers': 32,
+                },
+            },
+            'journal': None,
+            'metrics': {'port': None, 'host': '127.0.0.1'},
             'threading': {
                 'image': 30,
                 'photo': None,
+                'max_image': None,
+                'decode': None,
+                'adaptive': None,
+                'prefetch': None,
             },
         },
         'client': {
@@ -433,6 +676,35 @@ class JmModuleConfig:
             },
             'impl': None,
             'retry_times': 5,
+            'retry': {
+                'backoff': None,
+                'base': 0.5,
+                'cap': 10,
+                'deadline': None,
+                'no_retry_status': [],
+                'no_retry_exceptions': [],
+            },
+            'health': {
+                'enable': False,
+                'alpha': 0.3,
+                'max_error_rate': 0.5,
+            },
+            'circuit_breaker': {
+                'enable': False,
+                'failure_threshold': 5,
+                'cooldown': 30,
+                'half_open_max': 1,
+            },
+            'limit': {
+                'concurrency': None,
+                'rate': None,
+                'burst': None,
+                'hosts': {},
+            },
+            'disk_cache': {
+                'enable': False,
+                'path': None,
+            },
         },
         'plugins': {
             # 如果插件抛出参数校验异常，只log。（全局配置，可以被插件的局部配置覆盖）
@@ -1,6 +1,20 @@
 from .jm_option import *
 
 
+def record_download_exception(downloader: 'JmDownloader', detail: JmBaseEntity, e: BaseException):
+    if detail.is_image():
+        detail: JmImageDetail
+        jm_log('image.failed', f'图片下载失败: [{detail.download_url}], 异常: [{e}]')
+        downloader.download_failed_image.append((detail, e))
+        downloader.metrics.inc('image_failed_total')
+
+    elif detail.is_photo():
+        detail: JmPhotoDetail
+        jm_log('photo.failed', f'章节下载失败: [{detail.id}], 异常: [{e}]')
+        downloader.download_failed_photo.append((detail, e))
+        downloader.metrics.inc('photo_failed_total')
+
+
 def catch_exception(func):
     from functools import wraps
 
@@ -10,22 +24,562 @@ def catch_exception(func):
         try:
             return func(self, *args, **kwargs)
         except Exception as e:
-            detail: JmBaseEntity = args[0]
-            if detail.is_image():
-                detail: JmImageDetail
-                jm_log('image.failed', f'图片下载失败: [{detail.download_url}], 异常: [{e}]')
-                self.download_failed_image.append((detail, e))
+            record_download_exception(self, args[0], e)
+            raise e
+
+    return wrapper
 
-            elif detail.is_photo():
-                detail: JmPhotoDetail
-                jm_log('photo.failed', f'章节下载失败: [{detail.id}], 异常: [{e}]')
-                self.download_failed_photo.append((detail, e))
 
+def catch_exception_async(func):
+    """
+    catch_exception 的协程版本
+    """
+    from functools import wraps
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        self: JmDownloader
+        try:
+            return await func(self, *args, **kwargs)
+        except Exception as e:
+            record_download_exception(self, args[0], e)
             raise e
 
     return wrapper
 
 
+class JmImageScheduler:
+    """
+    进程级别共享的图片下载调度器
+
+    所有本子、章节的图片下载任务都提交到同一个工作队列，由固定数量的工作线程执行，
+    从而限制整个进程同时进行中的图片请求数。
+    本子/章节的遍历只负责往队列里提交任务，不再各自创建图片线程池。
+
+    可通过配置项 download.threading.max_image 启用
+    """
+
+    shared_instance: Optional['JmImageScheduler'] = None
+    shared_lock = Lock()
+
+    def __init__(self, max_workers: int):
+        ExceptionTool.require_true(max_workers > 0, f'图片调度器的线程数必须大于0: {max_workers}')
+        from queue import Queue
+        self.max_workers = max_workers
+        self.queue = Queue()
+        self.workers = []
+        self.worker_lock = Lock()
+
+    def submit(self, func: Callable, *args, **kwargs):
+        from concurrent.futures import Future
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        self.try_add_worker()
+        return future
+
+    def run_all(self, iter_objs: Iterable, apply: Callable):
+        """
+        提交一批任务，并阻塞等待它们全部完成
+        """
+        from concurrent.futures import wait
+        futures = [self.submit(apply, obj) for obj in iter_objs]
+        wait(futures)
+        return futures
+
+    def try_add_worker(self):
+        if len(self.workers) >= self.max_workers:
+            return
+
+        with self.worker_lock:
+            if len(self.workers) >= self.max_workers:
+                return
+
+            from threading import Thread
+            worker = Thread(
+                target=self.do_work,
+                name=f'jm_image_scheduler_{len(self.workers)}',
+                daemon=True,
+            )
+            self.workers.append(worker)
+            worker.start()
+
+    def do_work(self):
+        while True:
+            future, func, args, kwargs = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                traceback_print_exec()
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    @classmethod
+    def shared(cls, max_workers: int) -> 'JmImageScheduler':
+        """
+        获取进程内唯一的调度器，首次调用时创建。
+        整个进程只有一个全局上限，后续调用传入的max_workers不同时仅打印日志。
+        """
+        instance = cls.shared_instance
+        if instance is None:
+            with cls.shared_lock:
+                instance = cls.shared_instance
+                if instance is None:
+                    instance = cls(max_workers)
+                    cls.shared_instance = instance
+                    jm_log('scheduler.init', f'启用全局图片调度器，图片并发上限: {max_workers}')
+
+        if instance.max_workers != max_workers:
+            jm_log('scheduler.conflict',
+                   f'全局图片调度器已存在，忽略新的并发上限配置: {max_workers}，继续使用: {instance.max_workers}')
+
+        return instance
+
+
+class JmImageDecodePool:
+    """
+    进程级别共享的图片解密进程池
+
+    图片的解密（PIL打开、切割拼接、重新编码）是CPU密集操作，在下载线程中执行会受GIL限制。
+    启用后，下载线程只负责获取图片数据，解密、编码、写文件交给进程池完成，
+    下载并发和解密并发可以分别配置。
+
+    可通过配置项 download.threading.decode 启用
+    """
+
+    shared_instance: Optional['JmImageDecodePool'] = None
+    shared_lock = Lock()
+
+    def __init__(self, max_workers: int):
+        ExceptionTool.require_true(max_workers > 0, f'图片解密进程数必须大于0: {max_workers}')
+        from concurrent.futures import ProcessPoolExecutor
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def submit(self,
+               content: bytes,
+               filepath: str,
+               num: Optional[int],
+               need_convert: bool,
+               backend: str = JmImageTool.DECODE_BACKEND_PIL,
+               profile: Optional[dict] = None,
+               ):
+        """
+        提交一张图片的解密任务，参数见 JmImageTool.save_content
+        """
+        return self.executor.submit(JmImageTool.save_content, content, filepath, num, need_convert, backend, profile)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    @classmethod
+    def shared(cls, max_workers: int) -> 'JmImageDecodePool':
+        """
+        获取进程内唯一的解密进程池，首次调用时创建。
+        后续调用传入的max_workers不同时仅打印日志。
+        """
+        instance = cls.shared_instance
+        if instance is None:
+            with cls.shared_lock:
+                instance = cls.shared_instance
+                if instance is None:
+                    instance = cls(max_workers)
+                    cls.shared_instance = instance
+                    jm_log('decoder.init', f'启用图片解密进程池，进程数: {max_workers}')
+
+        if instance.max_workers != max_workers:
+            jm_log('decoder.conflict',
+                   f'图片解密进程池已存在，忽略新的进程数配置: {max_workers}，继续使用: {instance.max_workers}')
+
+        return instance
+
+
+class JmDeferredDecoder:
+    """
+    进程级别共享的延迟解密后台线程
+
+    启用延迟解密后，下载线程只保存原始的混淆图片和附属文件（见 JmImageTool.save_deferred），
+    由这里数量有限的后台线程把它们还原为最终的图片，下载高峰期可以把CPU留给网络。
+    后台还原失败的图片会保留原始图片和附属文件，之后可以用命令 `jmcomic descramble <目录>` 重新还原
+
+    可通过配置项 download.image.defer_decode 启用
+    """
+
+    shared_instance: Optional['JmDeferredDecoder'] = None
+    shared_lock = Lock()
+
+    def __init__(self, max_workers: int):
+        ExceptionTool.require_true(max_workers > 0, f'延迟解密线程数必须大于0: {max_workers}')
+        from concurrent.futures import ThreadPoolExecutor
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jm-deferred-decode')
+
+    def submit(self,
+               filepath: str,
+               backend: str = JmImageTool.DECODE_BACKEND_PIL,
+               profile: Optional[dict] = None,
+               ):
+        """
+        提交一张图片的还原任务，参数见 JmImageTool.decode_deferred
+        """
+        return self.executor.submit(self.decode, filepath, backend, profile)
+
+    @staticmethod
+    def decode(filepath: str, backend: str, profile: Optional[dict]):
+        try:
+            JmImageTool.decode_deferred(filepath, backend, profile)
+        except Exception as e:
+            jm_log('image.deferred', f'延迟解密失败，保留原始图片等待重新还原: [{filepath}]，异常: {e}')
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    @classmethod
+    def shared(cls, max_workers: int) -> 'JmDeferredDecoder':
+        """
+        获取进程内唯一的延迟解密后台线程池，首次调用时创建。
+        后续调用传入的max_workers不同时仅打印日志。
+        """
+        instance = cls.shared_instance
+        if instance is None:
+            with cls.shared_lock:
+                instance = cls.shared_instance
+                if instance is None:
+                    instance = cls(max_workers)
+                    cls.shared_instance = instance
+                    jm_log('decoder.init', f'启用延迟解密，后台线程数: {max_workers}')
+
+        if instance.max_workers != max_workers:
+            jm_log('decoder.conflict',
+                   f'延迟解密线程池已存在，忽略新的线程数配置: {max_workers}，继续使用: {instance.max_workers}')
+
+        return instance
+
+
+class JmAdaptiveConcurrency:
+    """
+    图片下载的自适应并发控制（AIMD：加性增、乘性减）
+
+    - 窗口（window）表示同时进行中的图片下载数上限
+    - 图片下载成功且耗时不超过latency秒：每成功一个窗口的图片，窗口+1
+    - 请求重试全部失败、5xx、超时：窗口减半，一段时间内（约一次下载的耗时）最多减半一次
+
+    可通过配置项 download.threading.adaptive 启用，当前窗口可以通过 window / snapshot() 获取
+    """
+
+    def __init__(self,
+                 initial: int,
+                 min_window: int = 1,
+                 max_window: int = 60,
+                 latency: float = 10,
+                 ):
+        ExceptionTool.require_true(0 < min_window <= max_window, f'自适应并发的窗口范围不合法: [{min_window}, {max_window}]')
+        from threading import Condition
+        self.min_window = min_window
+        self.max_window = max_window
+        self.latency = latency
+        self.window = float(min(max(initial, min_window), max_window))
+        self.inflight = 0
+        self.avg_latency = 0.0
+        self.last_decrease_time = 0.0
+        self.success_count = 0
+        self.congestion_count = 0
+        self.condition = Condition()
+        # 等待窗口的协程，[(事件循环, future)]，见 acquire_async
+        self.async_waiters: List[tuple] = []
+
+    def execute(self, func: Callable, *args, **kwargs):
+        """
+        在窗口允许时执行一次图片下载，并根据结果调整窗口
+        """
+        from time import monotonic
+
+        self.acquire()
+        begin = monotonic()
+        try:
+            ret = func(*args, **kwargs)
+        except BaseException as e:
+            self.release(monotonic() - begin, e)
+            raise e
+
+        self.release(monotonic() - begin, None)
+        return ret
+
+    async def execute_async(self, func: Callable, *args, **kwargs):
+        """
+        execute 的协程版本，func为返回协程的方法。与线程共用同一个窗口
+        """
+        from time import monotonic
+
+        await self.acquire_async()
+        begin = monotonic()
+        try:
+            ret = await func(*args, **kwargs)
+        except BaseException as e:
+            self.release(monotonic() - begin, e)
+            raise e
+
+        self.release(monotonic() - begin, None)
+        return ret
+
+    def acquire(self):
+        with self.condition:
+            while self.inflight >= int(self.window):
+                self.condition.wait()
+            self.inflight += 1
+
+    async def acquire_async(self):
+        """
+        acquire 的协程版本，窗口已满时不阻塞事件循环，等待 release 唤醒后重新检查
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.inflight < int(self.window):
+                    self.inflight += 1
+                    return
+
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+
+            await waiter
+
+    def release(self, cost: float, e: Optional[BaseException]):
+        from time import monotonic
+
+        with self.condition:
+            self.inflight -= 1
+            before = int(self.window)
+
+            if e is not None:
+                if self.is_congestion(e) and monotonic() - self.last_decrease_time >= self.avg_latency:
+                    self.congestion_count += 1
+                    self.last_decrease_time = monotonic()
+                    self.window = max(float(self.min_window), self.window / 2)
+            else:
+                self.success_count += 1
+                self.avg_latency = cost if self.avg_latency == 0 else self.avg_latency * 0.8 + cost * 0.2
+                if cost <= self.latency:
+                    self.window = min(float(self.max_window), self.window + 1 / self.window)
+
+            self.condition.notify_all()
+            waiters, self.async_waiters = self.async_waiters, []
+
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(self.wake_waiter, waiter)
+
+        if before != int(self.window):
+            jm_log('adaptive.window', f'图片并发窗口调整: {before} → {int(self.window)}')
+
+    @staticmethod
+    def wake_waiter(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    # noinspection PyMethodMayBeStatic
+    def is_congestion(self, e: BaseException) -> bool:
+        """
+        判断异常是否说明对方服务器拥塞，需要降低并发
+        """
+        if isinstance(e, RequestRetryAllFailException):
+            return True
+
+        if isinstance(e, ResponseUnexpectedException):
+            resp = e.resp
+            code = getattr(resp, 'http_code', None) or getattr(resp, 'status_code', None)
+            return code is not None and code >= 500
+
+        return 'timeout' in type(e).__name__.lower()
+
+    def snapshot(self) -> dict:
+        with self.condition:
+            return {
+                'window': int(self.window),
+                'inflight': self.inflight,
+                'avg_latency': self.avg_latency,
+                'success': self.success_count,
+                'congestion': self.congestion_count,
+            }
+
+
+class JmDownloadJournal:
+    """
+    下载日志，基于SQLite，记录已完成的本子、章节、图片，以及章节的元数据（page_arr、scramble_id、data_original_domain）
+
+    批量下载中断后重新运行时：
+    - 已完成的章节直接跳过，不再请求章节详情，也不再逐个检查图片文件（仍会回调 before_photo/after_photo，见 replay_skipped_photo）
+    - 未完成的章节用记录的元数据恢复，不再请求章节详情
+
+    可通过配置项 download.journal 启用，值为日志文件路径。同一个路径在进程内共用一个实例
+    """
+
+    REGISTRY: Dict[str, 'JmDownloadJournal'] = {}
+    REGISTRY_LOCK = Lock()
+
+    def __init__(self, filepath: str):
+        import sqlite3
+        mkdir_if_not_exists(os.path.dirname(os.path.abspath(filepath)))
+        self.filepath = filepath
+        self.lock = Lock()
+        self.conn = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(
+            """
+            create table if not exists album (
+                album_id text primary key,
+                finish_time real
+            );
+            create table if not exists photo (
+                photo_id text primary key,
+                album_id text,
+                scramble_id text,
+                page_arr text,
+                data_original_domain text,
+                finished integer default 0,
+                finish_time real
+            );
+            create table if not exists image (
+                photo_id text,
+                filename text,
+                save_path text,
+                finish_time real,
+                primary key (photo_id, filename)
+            );
+            """
+        )
+
+    def execute(self, sql: str, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def record_photo(self, photo: JmPhotoDetail):
+        """
+        记录章节的元数据，下载中断后可以用来恢复章节，不用再请求章节详情
+        """
+        import json
+        self.execute(
+            'insert into photo (photo_id, album_id, scramble_id, page_arr, data_original_domain) values (?, ?, ?, ?, ?) '
+            'on conflict(photo_id) do update set scramble_id = excluded.scramble_id, page_arr = excluded.page_arr, '
+            'data_original_domain = excluded.data_original_domain',
+            (photo.photo_id, photo.album_id, photo.scramble_id, json.dumps(photo.page_arr), photo.data_original_domain),
+        )
+
+    def finish_photo(self, photo: JmPhotoDetail):
+        self.execute('update photo set finished = 1, finish_time = ? where photo_id = ?',
+                     (time_stamp(False), photo.photo_id))
+
+    def finish_image(self, image: JmImageDetail, img_save_path: str):
+        self.execute('insert or replace into image (photo_id, filename, save_path, finish_time) values (?, ?, ?, ?)',
+                     (image.from_photo.photo_id, image.filename, img_save_path, time_stamp(False)))
+
+    def finish_album(self, album: JmAlbumDetail):
+        self.execute('insert or replace into album (album_id, finish_time) values (?, ?)',
+                     (album.album_id, time_stamp(False)))
+
+    def is_album_finished(self, album_id) -> bool:
+        return len(self.execute('select 1 from album where album_id = ?', (str(album_id),))) != 0
+
+    def get_image_save_paths(self, photo_id) -> Dict[str, str]:
+        """
+        :returns: 章节已下载完成的图片，文件名 -> 保存路径
+        """
+        return dict(self.execute('select filename, save_path from image where photo_id = ?', (str(photo_id),)))
+
+    def restore_photo(self, photo: JmPhotoDetail) -> bool:
+        """
+        用记录的元数据恢复章节
+
+        :returns: 章节是否已经下载完成
+        """
+        import json
+        rows = self.execute('select scramble_id, page_arr, data_original_domain, finished from photo where photo_id = ?',
+                            (photo.photo_id,))
+        if len(rows) == 0:
+            return False
+
+        scramble_id, page_arr, data_original_domain, finished = rows[0]
+        if photo.page_arr is None or photo.data_original_domain is None:
+            photo.scramble_id = scramble_id
+            photo.page_arr = json.loads(page_arr)
+            photo.data_original_domain = data_original_domain
+
+        return finished == 1
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @classmethod
+    def of(cls, filepath: str) -> 'JmDownloadJournal':
+        filepath = os.path.abspath(filepath)
+        with cls.REGISTRY_LOCK:
+            journal = cls.REGISTRY.get(filepath, None)
+            if journal is None:
+                journal = cls(filepath)
+                cls.REGISTRY[filepath] = journal
+                jm_log('journal.init', f'启用下载日志: [{filepath}]')
+            return journal
+
+
+class JmPhotoPrefetcher:
+    """
+    章节详情的预取
+
+    下载本子时，按章节顺序提前请求后面K个章节的详情（check_photo），
+    章节开始下载时详情通常已经就绪，图片下载不必再等待章节详情的请求。
+
+    可通过配置项 download.threading.prefetch 启用
+    """
+
+    def __init__(self, photos: List[JmPhotoDetail], prepare: Callable, lookahead: int):
+        """
+        :param photos: 要下载的章节，按顺序预取
+        :param prepare: 准备章节的方法，在预取线程中执行，见 JmDownloader.prepare_photo
+        :param lookahead: 预取窗口，最多提前多少个章节
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        self.photos = photos
+        self.prepare = prepare
+        self.lookahead = lookahead
+        self.index_dict: Dict[JmPhotoDetail, int] = {photo: i for i, photo in enumerate(photos)}
+        self.futures = []
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=lookahead, thread_name_prefix='jm_photo_prefetch')
+        self.fill(0)
+
+    def fill(self, index: int):
+        """
+        提交预取任务，直到第index个章节之后的lookahead个章节
+        """
+        with self.lock:
+            end = min(len(self.photos), index + self.lookahead + 1)
+            while len(self.futures) < end:
+                self.futures.append(self.executor.submit(self.prepare, self.photos[len(self.futures)]))
+
+    def get(self, photo: JmPhotoDetail):
+        """
+        获取章节的准备结果，预取窗口随之向后移动
+        """
+        index = self.index_dict.get(photo, None)
+        if index is None:
+            return self.prepare(photo)
+
+        self.fill(index)
+        return self.futures[index].result()
+
+    def shutdown(self):
+        # 手动取消还没开始的预取任务（cancel_futures参数需要python3.9）
+        with self.lock:
+            for future in self.futures:
+                future.cancel()
+        self.executor.shutdown(wait=False)
+
+
 # noinspection PyMethodMayBeStatic
 class DownloadCallback:
 
@@ -76,11 +630,108 @@ class JmDownloader(DownloadCallback):
     def __init__(self, option: JmOption) -> None:
         self.option = option
         self.client = option.build_jm_client()
+        # 统计指标，同一个option创建的downloader共用
+        self.metrics: JmDownloadMetrics = option.decide_download_metrics()
+        self.client.set_metrics(self.metrics)
         # 下载成功的记录dict
         self.download_success_dict: Dict[JmAlbumDetail, Dict[JmPhotoDetail, List[Tuple[str, JmImageDetail]]]] = {}
         # 下载失败的记录list
         self.download_failed_image: List[Tuple[JmImageDetail, BaseException]] = []
         self.download_failed_photo: List[Tuple[JmPhotoDetail, BaseException]] = []
+        # 全局图片调度器，未启用时为None
+        self.image_scheduler: Optional[JmImageScheduler] = self.build_image_scheduler()
+        # 图片解密进程池，未启用时为None
+        self.decode_pool: Optional[JmImageDecodePool] = self.build_decode_pool()
+        # 图片解密的实现，见 JmImageTool.decode_and_save
+        self.decode_backend: str = option.decide_image_decode_backend()
+        # 图片编码配置，见 JmImageTool.save_image
+        self.encode_profile: Optional[dict] = option.decide_image_encode_profile()
+        # 延迟解密，下载时只保存原始图片，见 JmImageTool.save_deferred
+        self.defer_decode: bool = option.decide_image_defer_decode() is not None
+        # 延迟解密的后台线程，后台线程数为0或未启用延迟解密时为None
+        self.deferred_decoder: Optional[JmDeferredDecoder] = self.build_deferred_decoder()
+        # 本downloader提交的延迟解密任务，退出时等待完成
+        self.deferred_futures: list = []
+        # 章节 → 该章节还在解密中的图片 (image, img_save_path, future)
+        self.decode_futures: Dict[JmPhotoDetail, list] = {}
+        self.decode_futures_lock = Lock()
+        # 图片下载的自适应并发控制，未启用时为None
+        self.adaptive: Optional[JmAdaptiveConcurrency] = self.build_adaptive_concurrency()
+        self.register_adaptive_gauge()
+        self.register_scheduler_gauge()
+        # 下载日志，未启用时为None
+        self.journal: Optional[JmDownloadJournal] = self.build_journal()
+        # 本子 → 该本子的章节详情预取，未启用时为空
+        self.photo_prefetchers: Dict[JmAlbumDetail, JmPhotoPrefetcher] = {}
+        # 目录 → 目录下已存在的文件名，每个目录只扫描一次，见 image_exists
+        self.dir_index: Dict[str, Set[str]] = {}
+        self.dir_index_lock = Lock()
+        # 章节 → 章节图片的保存文件夹，章节下载完成后清除，见 decide_image_save_dir
+        self.image_save_dirs: Dict[JmPhotoDetail, str] = {}
+        self.image_save_dirs_lock = Lock()
+
+    def build_image_scheduler(self) -> Optional[JmImageScheduler]:
+        max_image = self.option.decide_max_image_count()
+        if max_image is None:
+            return None
+
+        return JmImageScheduler.shared(max_image)
+
+    def build_journal(self) -> Optional[JmDownloadJournal]:
+        filepath = self.option.decide_journal_filepath()
+        if filepath is None:
+            return None
+
+        return JmDownloadJournal.of(filepath)
+
+    def register_adaptive_gauge(self):
+        """
+        把自适应并发的当前窗口注册为仪表。
+        metrics由同一个option创建的downloader共用，因此按downloader区分标签，
+        并且只弱引用窗口对象，downloader被回收后仪表自动移除，__exit__ 时也会主动移除
+        """
+        if self.adaptive is None:
+            return
+
+        import weakref
+        ref = weakref.ref(self.adaptive)
+
+        def window():
+            adaptive = ref()
+            return None if adaptive is None else adaptive.snapshot()['window']
+
+        self.metrics.register_gauge('adaptive_window', window, downloader=f'{id(self):x}')
+
+    def register_scheduler_gauge(self):
+        """
+        把全局图片调度器的队列长度（等待执行的图片任务数）注册为仪表。
+        调度器是进程内唯一的，所有downloader注册的都是同一个仪表，不需要区分标签，也不需要移除
+        """
+        if self.image_scheduler is None:
+            return
+
+        self.metrics.register_gauge('image_scheduler_queue', self.image_scheduler.queue.qsize)
+
+    def build_adaptive_concurrency(self) -> Optional[JmAdaptiveConcurrency]:
+        conf = self.option.decide_adaptive_concurrency()
+        if conf is None:
+            return None
+
+        return JmAdaptiveConcurrency(**conf)
+
+    def build_decode_pool(self) -> Optional[JmImageDecodePool]:
+        decode_count = self.option.decide_decode_process_count()
+        if decode_count is None:
+            return None
+
+        return JmImageDecodePool.shared(decode_count)
+
+    def build_deferred_decoder(self) -> Optional[JmDeferredDecoder]:
+        workers = self.option.decide_image_defer_decode()
+        if not workers:
+            return None
+
+        return JmDeferredDecoder.shared(workers)
 
     def download_album(self, album_id):
         album = self.client.get_album_detail(album_id)
@@ -105,25 +756,35 @@ class JmDownloader(DownloadCallback):
 
     @catch_exception
     def download_by_photo_detail(self, photo: JmPhotoDetail):
-        self.client.check_photo(photo)
-
-        self.before_photo(photo)
-        if photo.skip:
+        if self.wait_prepare_photo(photo):
+            self.replay_skipped_photo(photo)
             return
-        self.execute_on_condition(
-            iter_objs=photo,
-            apply=self.download_by_image_detail,
-            count_batch=self.option.decide_image_batch_count(photo)
-        )
-        self.after_photo(photo)
+
+        try:
+            self.before_photo(photo)
+            if photo.skip:
+                return
+
+            if self.image_scheduler is not None:
+                self.execute_by_scheduler(
+                    iter_objs=photo,
+                    apply=self.download_by_image_detail,
+                )
+            else:
+                self.execute_on_condition(
+                    iter_objs=photo,
+                    apply=self.download_by_image_detail,
+                    count_batch=self.decide_image_batch_count(photo)
+                )
+            self.wait_decode_finish(photo)
+            self.after_photo(photo)
+        finally:
+            # 下载失败、被跳过的章节不会回调 after_photo，也要清除缓存
+            self.release_image_save_dir(photo)
 
     @catch_exception
     def download_by_image_detail(self, image: JmImageDetail):
-        img_save_path = self.option.decide_image_filepath(image)
-
-        image.save_path = img_save_path
-        image.exists = file_exists(img_save_path)
-
+        img_save_path = self.prepare_image(image)
         self.before_image(image, img_save_path)
 
         if image.skip:
@@ -137,13 +798,371 @@ class JmDownloader(DownloadCallback):
         if use_cache is True and image.exists:
             return
 
-        self.client.download_by_image_detail(
+        if self.defer_decode is True:
+            self.download_by_image_detail_deferred(image, img_save_path, use_cache, decode_image)
+            return
+
+        if self.decode_pool is not None:
+            self.download_by_image_detail_pipeline(image, img_save_path, decode_image)
+            return
+
+        JmImageTool.retry_on_missing_dir(
+            img_save_path,
+            self.execute_image_request,
+            self.client.download_by_image_detail,
+            image,
+            img_save_path,
+            decode_image=decode_image,
+            stream=self.option.decide_download_image_stream(image),
+        )
+
+        self.after_image(image, img_save_path)
+
+    def prepare_image(self, image: JmImageDetail) -> str:
+        """
+        决定图片的保存路径，并检查图片是否已存在
+
+        :returns: 图片的保存路径
+        """
+        img_save_path = self.option.decide_image_filepath(image, save_dir=self.decide_image_save_dir(image.from_photo))
+
+        image.save_path = img_save_path
+        image.exists = self.image_exists(img_save_path) and not self.image_pending_decode(img_save_path)
+        return img_save_path
+
+    def download_by_image_detail_deferred(self, image: JmImageDetail, img_save_path, use_cache, decode_image):
+        """
+        延迟解密：下载线程只保存原始图片和附属文件，保存后即回调 after_image，
+        图片的还原交给后台线程（见 JmDeferredDecoder），或者之后用命令 `jmcomic descramble <目录>` 还原
+        """
+        # 上次已保存原始图片、还没还原的图片，不用重新下载
+        if use_cache is True and self.image_pending_decode(img_save_path):
+            self.submit_deferred_decode(img_save_path)
+            return
+
+        JmImageTool.retry_on_missing_dir(
+            img_save_path,
+            self.execute_image_request,
+            self.client.download_by_image_detail,
             image,
             img_save_path,
             decode_image=decode_image,
+            stream=self.option.decide_download_image_stream(image),
         )
 
         self.after_image(image, img_save_path)
+        self.submit_deferred_decode(img_save_path)
+
+    def submit_deferred_decode(self, img_save_path):
+        if self.deferred_decoder is None:
+            return
+
+        future = self.deferred_decoder.submit(img_save_path, self.decode_backend, self.encode_profile)
+        with self.decode_futures_lock:
+            self.deferred_futures.append(future)
+
+    def wait_deferred_decode(self):
+        """
+        等待本downloader提交的延迟解密任务全部完成
+        """
+        with self.decode_futures_lock:
+            futures, self.deferred_futures = self.deferred_futures, []
+
+        if len(futures) == 0:
+            return
+
+        from concurrent.futures import wait
+        wait(futures)
+
+    def decide_image_save_dir(self, photo: JmPhotoDetail) -> str:
+        """
+        同一个章节的所有图片，保存文件夹都是一样的，
+        因此每个章节只通过 option.decide_image_save_dir 解析一次路径规则并创建文件夹，结果给该章节的其他图片使用。
+        下载过程中文件夹被删除时，由保存图片时重新创建，见 JmImageTool.retry_on_missing_dir
+
+        缓存在章节结束后清除，见 release_image_save_dir
+        """
+        save_dir = self.image_save_dirs.get(photo, None)
+        if save_dir is not None:
+            return save_dir
+
+        with self.image_save_dirs_lock:
+            save_dir = self.image_save_dirs.get(photo, None)
+            if save_dir is None:
+                save_dir = self.option.decide_image_save_dir(photo)
+                self.image_save_dirs[photo] = save_dir
+
+        return save_dir
+
+    def image_exists(self, img_save_path: str) -> bool:
+        """
+        判断图片文件是否已存在。
+        每个目录只扫描一次，之后同目录的图片直接查内存中的文件名集合，避免每张图都访问一次文件系统
+        """
+        dirpath, filename = self.to_dir_index_key(img_save_path)
+        return filename in self.get_dir_index(dirpath)
+
+    @staticmethod
+    def to_dir_index_key(path: str) -> Tuple[str, str]:
+        """
+        目录集合的 (目录, 文件名)，用 os.path.normcase 统一大小写，
+        使Windows等不区分大小写的文件系统上，只有大小写不同的路径也能命中
+        """
+        return os.path.split(os.path.normcase(os.path.normpath(path)))
+
+    def image_pending_decode(self, img_save_path: str) -> bool:
+        """
+        判断图片是否还在等待延迟解密（附属文件还在）。
+        此时即使最终图片已存在，也可能只是上次还原中断，还差删除原始图片和附属文件，不能算作已下载
+        """
+        return self.image_exists(img_save_path + JmImageTool.DEFERRED_SIDECAR_SUFFIX)
+
+    def get_dir_index(self, dirpath: str) -> Set[str]:
+        index = self.dir_index.get(dirpath, None)
+        if index is not None:
+            return index
+
+        with self.dir_index_lock:
+            index = self.dir_index.get(dirpath, None)
+            if index is None:
+                index = self.scan_dir(dirpath, self.option.decide_cache_check_size())
+                self.dir_index[dirpath] = index
+
+        return index
+
+    # noinspection PyMethodMayBeStatic
+    def scan_dir(self, dirpath: str, check_size: bool) -> Set[str]:
+        """
+        扫描目录下已存在的文件名
+
+        :param check_size: 为True时，忽略大小为0的文件
+        """
+        try:
+            with os.scandir(dirpath) as it:
+                return {
+                    os.path.normcase(entry.name)
+                    for entry in it
+                    if entry.is_file() and (not check_size or entry.stat().st_size > 0)
+                }
+        except FileNotFoundError:
+            return set()
+
+    def update_dir_index(self, img_save_path: str):
+        """
+        图片下载完成后，把文件名加入目录的集合
+        """
+        dirpath, filename = self.to_dir_index_key(img_save_path)
+        with self.dir_index_lock:
+            index = self.dir_index.get(dirpath, None)
+            if index is not None:
+                index.add(filename)
+
+    def release_image_save_dir(self, photo: JmPhotoDetail):
+        """
+        章节结束后（包括下载失败、被跳过的章节），清除章节的保存文件夹缓存，并释放该目录的集合
+        """
+        with self.image_save_dirs_lock:
+            save_dir = self.image_save_dirs.pop(photo, None)
+
+        if save_dir is not None:
+            self.release_dir_index(save_dir)
+
+    def release_dir_index(self, dirpath: str):
+        """
+        章节下载完成后，释放该章节目录的集合
+        """
+        with self.dir_index_lock:
+            self.dir_index.pop(os.path.normcase(os.path.normpath(dirpath)), None)
+
+    def prepare_photo(self, photo: JmPhotoDetail) -> bool:
+        """
+        准备章节的详情，使章节包含下载图片所需的信息
+
+        :returns: 章节是否可以跳过（下载日志中已完成）
+        """
+        if self.skip_photo_by_journal(photo):
+            return True
+
+        self.client.check_photo(photo)
+        self.record_photo_to_journal(photo)
+        return False
+
+    def wait_prepare_photo(self, photo: JmPhotoDetail) -> bool:
+        """
+        启用了章节详情预取时，等待预取结果，否则直接准备章节
+        """
+        prefetcher = self.photo_prefetchers.get(photo.from_album, None)
+        if prefetcher is None:
+            return self.prepare_photo(photo)
+
+        return prefetcher.get(photo)
+
+    def start_photo_prefetch(self, detail: DetailEntity, iter_objs) -> Optional[JmPhotoPrefetcher]:
+        """
+        开始下载本子的章节前，启动章节详情的预取
+        """
+        if not detail.is_album():
+            return None
+
+        lookahead = self.option.decide_photo_prefetch_count(detail)
+        if not lookahead:
+            return None
+
+        # 下载日志中已完成的本子，章节都会被日志跳过，不需要预取
+        if self.journal is not None and self.journal.is_album_finished(detail.album_id):
+            return None
+
+        prefetcher = JmPhotoPrefetcher(list(iter_objs), self.prepare_photo, lookahead)
+        self.photo_prefetchers[detail] = prefetcher
+        return prefetcher
+
+    def stop_photo_prefetch(self, detail: DetailEntity):
+        prefetcher = self.photo_prefetchers.pop(detail, None)
+        if prefetcher is not None:
+            prefetcher.shutdown()
+
+    def skip_photo_by_journal(self, photo: JmPhotoDetail) -> bool:
+        """
+        用下载日志恢复章节的元数据，已下载完成的章节返回True
+        """
+        if self.journal is None:
+            return False
+
+        if self.journal.restore_photo(photo):
+            jm_log('photo.skip', f'章节已下载完成（见下载日志），跳过: [{photo.id}]')
+            return True
+
+        return False
+
+    def replay_skipped_photo(self, photo: JmPhotoDetail):
+        """
+        下载日志中已完成的章节，不再下载图片，但仍然回调 before_photo 和 after_photo，
+        并把日志中记录的图片放入 download_success_dict，使 after_photo/after_album 的插件（例如zip）能拿到完整的章节。
+
+        注意：这些图片不会回调 before_image/after_image
+        """
+        self.before_photo(photo)
+        if photo.skip:
+            return
+
+        save_paths = self.journal.get_image_save_paths(photo.photo_id)
+        success_list = self.download_success_dict[photo.from_album][photo]
+        for image in photo:
+            img_save_path = save_paths.get(image.filename, None)
+            if img_save_path is not None:
+                image.save_path = img_save_path
+                image.exists = True
+                success_list.append((img_save_path, image))
+
+        self.after_photo(photo)
+
+    def record_photo_to_journal(self, photo: JmPhotoDetail):
+        if self.journal is not None:
+            self.journal.record_photo(photo)
+
+    def has_failure_of(self, detail: Union[JmAlbumDetail, JmPhotoDetail]) -> bool:
+        """
+        本子/章节是否有下载失败的章节或图片
+        """
+        if detail.is_album():
+            return (any(photo.from_album is detail for photo, _ in self.download_failed_photo)
+                    or any(image.from_photo.from_album is detail for image, _ in self.download_failed_image))
+
+        return (any(photo is detail for photo, _ in self.download_failed_photo)
+                or any(image.from_photo is detail for image, _ in self.download_failed_image))
+
+    def decide_image_batch_count(self, photo: JmPhotoDetail) -> int:
+        """
+        章节的图片线程数。
+        启用自适应并发时取章节开始下载时的窗口大小，窗口增长后由之后的章节使用，
+        这样线程数随窗口变化，不会每个章节都按窗口上限创建线程
+        """
+        if self.adaptive is None:
+            return self.option.decide_image_batch_count(photo)
+
+        return self.adaptive.snapshot()['window']
+
+    def execute_image_request(self, func: Callable, *args, **kwargs):
+        """
+        执行图片请求，启用自适应并发时由其控制同时进行中的图片请求数
+        """
+        if self.adaptive is None:
+            return func(*args, **kwargs)
+
+        return self.adaptive.execute(func, *args, **kwargs)
+
+    def fetch_image(self, img_url: str) -> JmImageResp:
+        """
+        请求图片数据，在取得并发许可之后才开始计时，image_fetch_seconds 不包含等待许可的时间
+        """
+        with self.metrics.time('image_fetch_seconds', 'image_fetch_inflight'):
+            return self.client.fetch_jm_image(img_url)
+
+    def download_by_image_detail_pipeline(self, image: JmImageDetail, img_save_path, decode_image):
+        """
+        下载线程只请求图片数据，解密保存交给解密进程池，
+        章节的图片全部请求完后，由章节线程等待解密完成并回调 after_image（见 wait_decode_finish），再回调 after_photo
+        """
+        resp = self.execute_image_request(self.fetch_image, image.download_url)
+        resp.require_success()
+        self.metrics.inc('bytes_received_total', len(resp.content))
+
+        num, need_convert = self.decide_image_decode_task(image, img_save_path, decode_image)
+        if num is None and need_convert is False:
+            # 无需解密也无需转换格式，直接写文件，省去进程间传输数据
+            with self.metrics.time('image_write_seconds'):
+                JmImageTool.save_content(resp.content, img_save_path, num, need_convert)
+            self.after_image(image, img_save_path)
+            return
+
+        # 解密耗时从提交开始计算，包含在进程池中排队的时间
+        begin = time_stamp(False)
+        self.metrics.add_gauge('image_decode_inflight', 1)
+
+        def on_done(_):
+            # 在进程池的结果线程上执行，只更新指标，after_image 由章节线程在 wait_decode_finish 中回调
+            self.metrics.add_gauge('image_decode_inflight', -1)
+            self.metrics.observe('image_decode_seconds', time_stamp(False) - begin)
+
+        future = self.decode_pool.submit(resp.content, img_save_path, num, need_convert,
+                                         self.decode_backend, self.encode_profile)
+        future.add_done_callback(on_done)
+        with self.decode_futures_lock:
+            self.decode_futures.setdefault(image.from_photo, []).append((image, img_save_path, future))
+
+    # noinspection PyMethodMayBeStatic
+    def decide_image_decode_task(self, image: JmImageDetail, img_save_path, decode_image):
+        """
+        决定解密任务的参数，规则与 JmImageResp.transfer_to 一致
+
+        :returns: (分割数，为None表示不解密, 是否需要转换图片格式)
+        """
+        if decode_image is False or image.scramble_id is None:
+            return None, suffix_not_equal(image.img_url, img_save_path)
+
+        return JmImageTool.get_num_by_detail(image), True
+
+    def on_image_decoded(self, image: JmImageDetail, img_save_path, future):
+        e = future.exception()
+        if e is not None:
+            record_download_exception(self, image, e)
+            return
+
+        self.after_image(image, img_save_path)
+
+    def wait_decode_finish(self, photo: JmPhotoDetail):
+        """
+        等待章节的图片全部解密完成，并在当前（章节）线程回调 after_image，
+        使插件不会在进程池的结果线程上执行
+        """
+        if self.decode_pool is None:
+            return
+
+        with self.decode_futures_lock:
+            tasks = self.decode_futures.pop(photo, [])
+
+        for image, img_save_path, future in tasks:
+            self.on_image_decoded(image, img_save_path, future)
 
     def execute_on_condition(self,
                              iter_objs: DetailEntity,
@@ -153,25 +1172,43 @@ class JmDownloader(DownloadCallback):
         """
         调度本子/章节的下载
         """
+        detail = iter_objs
         iter_objs = self.do_filter(iter_objs)
         count_real = len(iter_objs)
 
         if count_real == 0:
             return
 
-        if count_batch >= count_real:
-            # 一个图/章节 对应 一个线程
-            multi_thread_launcher(
-                iter_objs=iter_objs,
-                apply_each_obj_func=apply,
-            )
-        else:
-            # 创建batch个线程的线程池
-            thread_pool_executor(
-                iter_objs=iter_objs,
-                apply_each_obj_func=apply,
-                max_workers=count_batch,
-            )
+        self.start_photo_prefetch(detail, iter_objs)
+        try:
+            if count_batch >= count_real:
+                # 一个图/章节 对应 一个线程
+                multi_thread_launcher(
+                    iter_objs=iter_objs,
+                    apply_each_obj_func=apply,
+                )
+            else:
+                # 创建batch个线程的线程池
+                thread_pool_executor(
+                    iter_objs=iter_objs,
+                    apply_each_obj_func=apply,
+                    max_workers=count_batch,
+                )
+        finally:
+            self.stop_photo_prefetch(detail)
+
+    def execute_by_scheduler(self,
+                             iter_objs: DetailEntity,
+                             apply: Callable,
+                             ):
+        """
+        把章节的图片提交到全局图片调度器，当前线程只负责等待它们完成
+        """
+        iter_objs = self.do_filter(iter_objs)
+        if len(iter_objs) == 0:
+            return
+
+        self.image_scheduler.run_all(iter_objs, apply)
 
     # noinspection PyMethodMayBeStatic
     def do_filter(self, detail: DetailEntity):
@@ -225,6 +1262,8 @@ class JmDownloader(DownloadCallback):
 
     def after_album(self, album: JmAlbumDetail):
         super().after_album(album)
+        if self.journal is not None and not self.has_failure_of(album):
+            self.journal.finish_album(album)
         self.option.call_all_plugin(
             'after_album',
             album=album,
@@ -240,14 +1279,22 @@ class JmDownloader(DownloadCallback):
             photo=photo,
             downloader=self,
         )
+        # 插件可能修改了 page_arr，之后再计算解密计划
+        if not photo.skip:
+            JmImageTool.get_descramble_plan(photo)
 
     def after_photo(self, photo: JmPhotoDetail):
         super().after_photo(photo)
+        self.metrics.inc('photo_success_total')
+        if self.journal is not None and not self.has_failure_of(photo):
+            self.journal.finish_photo(photo)
         self.option.call_all_plugin(
             'after_photo',
             photo=photo,
             downloader=self,
         )
+        # 插件可能会删除章节文件夹，例如zip插件，因此在插件之后清除缓存
+        self.release_image_save_dir(photo)
 
     def before_image(self, image: JmImageDetail, img_save_path):
         super().before_image(image, img_save_path)
@@ -263,6 +1310,10 @@ class JmDownloader(DownloadCallback):
         album = photo.from_album
 
         self.download_success_dict.get(album).get(photo).append((img_save_path, image))
+        self.update_dir_index(img_save_path)
+        self.metrics.inc('image_success_total')
+        if self.journal is not None:
+            self.journal.finish_image(image, img_save_path)
         self.option.call_all_plugin(
             'after_image',
             image=image,
@@ -292,6 +1343,9 @@ class JmDownloader(DownloadCallback):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.wait_deferred_decode()
+        if self.adaptive is not None:
+            self.metrics.unregister_gauge('adaptive_window', downloader=f'{id(self):x}')
         if exc_type is not None:
             jm_log('dler.exception',
                    f'{self.__class__.__name__} Exit with exception: {exc_type, str(exc_val)}'
@@ -348,3 +1402,225 @@ class JustDownloadSpecificCountImage(JmDownloader):
     def use(cls, count):
         cls.count = count
         super().use()
+
+
+class AsyncJmDownloader(JmDownloader):
+    """
+    基于asyncio的下载器，是 JmDownloader 的协程版本
+
+    - 图片请求通过 curl_cffi 的 AsyncSession 在同一个事件循环上并发进行，不再占用一个线程一张图
+    - 并发上限由信号量控制，沿用option的配置：
+      download.threading.photo（同时下载的章节数）、download.threading.image（每个章节同时下载的图片数）、
+      download.threading.max_image（可选，全部图片的并发上限）
+    - 启用了自适应并发（download.threading.adaptive）时，同时进行中的图片请求数由自适应窗口控制
+    - 本子/章节详情请求、插件回调、图片解密保存、检查和创建文件夹都是同步实现，交给线程池执行，不阻塞事件循环
+
+    用法:
+    ```
+    async def main():
+        async with AsyncJmDownloader(option) as dler:
+            await dler.download_album_async(album_id)
+
+    asyncio.run(main())
+    ```
+    """
+
+    def __init__(self, option: JmOption) -> None:
+        super().__init__(option)
+        self.async_postman: Optional[JmAsyncPostman] = None
+        self.max_image_semaphore = None
+
+    def build_image_scheduler(self):
+        # 并发由信号量控制，不使用线程调度器
+        return None
+
+    async def run_sync(self, func: Callable, *args):
+        """
+        在线程池中执行同步函数（请求详情、插件回调等）
+        """
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def get_async_postman(self) -> JmAsyncPostman:
+        if self.async_postman is None:
+            max_image = self.option.decide_max_image_count()
+            if max_image is not None:
+                import asyncio
+                self.max_image_semaphore = asyncio.Semaphore(max_image)
+
+            # 未设置全局上限时，最大并发为 章节并发数 × 每章节的图片并发数，启用自适应并发时为窗口上限
+            threading = self.option.download.threading
+            max_clients = max_image or threading.photo * threading.image
+            if self.adaptive is not None:
+                max_clients = self.adaptive.max_window
+            self.async_postman = self.client.new_async_postman(max_clients)
+
+        return self.async_postman
+
+    def decide_image_batch_count(self, photo: JmPhotoDetail) -> int:
+        """
+        协程不占用线程，启用自适应并发时按窗口上限创建协程，由窗口控制实际的并发数
+        """
+        if self.adaptive is None:
+            return self.option.decide_image_batch_count(photo)
+
+        return self.adaptive.max_window
+
+    async def execute_image_request_async(self, func: Callable, *args, **kwargs):
+        """
+        execute_image_request 的协程版本，
+        启用自适应并发时由其窗口控制同时进行中的图片请求数，否则由 download.threading.max_image 的信号量控制
+        """
+        if self.adaptive is not None:
+            return await self.adaptive.execute_async(func, *args, **kwargs)
+
+        if self.max_image_semaphore is None:
+            return await func(*args, **kwargs)
+
+        async with self.max_image_semaphore:
+            return await func(*args, **kwargs)
+
+    async def close(self):
+        if self.async_postman is not None:
+            await self.async_postman.close()
+            self.async_postman = None
+            self.max_image_semaphore = None
+
+    async def download_album_async(self, album_id):
+        album = await self.run_sync(self.client.get_album_detail, album_id)
+        await self.download_by_album_detail_async(album)
+        return album
+
+    async def download_by_album_detail_async(self, album: JmAlbumDetail):
+        await self.run_sync(self.before_album, album)
+        if album.skip:
+            return
+        await self.execute_on_condition_async(
+            iter_objs=album,
+            apply=self.download_by_photo_detail_async,
+            count_batch=self.option.decide_photo_batch_count(album)
+        )
+        await self.run_sync(self.after_album, album)
+
+    async def download_photo_async(self, photo_id):
+        photo = await self.run_sync(self.client.get_photo_detail, photo_id)
+        await self.download_by_photo_detail_async(photo)
+        return photo
+
+    @catch_exception_async
+    async def download_by_photo_detail_async(self, photo: JmPhotoDetail):
+        if await self.run_sync(self.wait_prepare_photo, photo):
+            await self.run_sync(self.replay_skipped_photo, photo)
+            return
+
+        try:
+            await self.run_sync(self.before_photo, photo)
+            if photo.skip:
+                return
+            await self.execute_on_condition_async(
+                iter_objs=photo,
+                apply=self.download_by_image_detail_async,
+                count_batch=self.decide_image_batch_count(photo)
+            )
+            await self.run_sync(self.after_photo, photo)
+        finally:
+            self.release_image_save_dir(photo)
+
+    @catch_exception_async
+    async def download_by_image_detail_async(self, image: JmImageDetail):
+        # 可能创建文件夹、扫描目录
+        img_save_path = await self.run_sync(self.prepare_image, image)
+        await self.run_sync(self.before_image, image, img_save_path)
+
+        if image.skip:
+            return
+
+        # let option decide use_cache and decode_image
+        use_cache = self.option.decide_download_cache(image)
+        decode_image = self.option.decide_download_image_decode(image)
+
+        # skip download
+        if use_cache is True and image.exists:
+            return
+
+        # 上次已保存原始图片、还没还原的图片，不用重新下载，见 download_by_image_detail_deferred
+        if self.defer_decode is True and use_cache is True \
+                and await self.run_sync(self.image_pending_decode, img_save_path):
+            self.submit_deferred_decode(img_save_path)
+            return
+
+        postman = self.get_async_postman()
+        if self.decode_pool is not None and self.defer_decode is False:
+            await self.download_by_image_detail_pipeline_async(postman, image, img_save_path, decode_image)
+        else:
+            await self.execute_image_request_async(
+                self.client.download_by_image_detail_async,
+                postman,
+                image,
+                img_save_path,
+                decode_image=decode_image,
+            )
+
+        await self.run_sync(self.after_image, image, img_save_path)
+        if self.defer_decode is True:
+            self.submit_deferred_decode(img_save_path)
+
+    async def fetch_image_async(self, postman, img_url: str) -> JmImageResp:
+        """
+        fetch_image 的协程版本
+        """
+        with self.metrics.time('image_fetch_seconds', 'image_fetch_inflight'):
+            return await self.client.fetch_jm_image_async(postman, img_url)
+
+    async def download_by_image_detail_pipeline_async(self, postman, image: JmImageDetail, img_save_path, decode_image):
+        """
+        download_by_image_detail_pipeline 的协程版本，解密完成后才返回
+        """
+        import asyncio
+        resp = await self.execute_image_request_async(self.fetch_image_async, postman, image.download_url)
+
+        resp.require_success()
+        self.metrics.inc('bytes_received_total', len(resp.content))
+
+        num, need_convert = self.decide_image_decode_task(image, img_save_path, decode_image)
+        with self.metrics.time('image_decode_seconds', 'image_decode_inflight'):
+            await asyncio.wrap_future(
+                self.decode_pool.submit(resp.content, img_save_path, num, need_convert,
+                                        self.decode_backend, self.encode_profile)
+            )
+
+    async def execute_on_condition_async(self,
+                                         iter_objs: DetailEntity,
+                                         apply: Callable,
+                                         count_batch: int,
+                                         ):
+        """
+        调度本子/章节的下载，同时进行中的协程数不超过count_batch
+        """
+        import asyncio
+        detail = iter_objs
+        iter_objs = self.do_filter(iter_objs)
+        if len(iter_objs) == 0:
+            return
+
+        semaphore = asyncio.Semaphore(count_batch)
+
+        async def bounded(obj):
+            async with semaphore:
+                return await apply(obj)
+
+        self.start_photo_prefetch(detail, iter_objs)
+        try:
+            # 异常已被 catch_exception_async 记录，这里收集起来，避免一个失败取消其他任务
+            await asyncio.gather(*[bounded(obj) for obj in iter_objs], return_exceptions=True)
+        finally:
+            self.stop_photo_prefetch(detail)
+
+    # 下面是对async with语法的支持
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+        await self.run_sync(self.__exit__, exc_type, exc_val, exc_tb)
@@ -217,6 +217,8 @@ class JmImageDetail(JmBaseEntity, Downloadable):
         self.from_photo: Optional[JmPhotoDetail] = from_photo
         self.query_params: Optional[str] = query_params
         self.index = index  # 从1开始
+        # 图片的分割数，由章节的解密计划设置，见 JmImageTool.get_descramble_plan
+        self.scramble_num: Optional[int] = None
 
     @property
     def filename_without_suffix(self):
@@ -338,6 +340,10 @@ class JmPhotoDetail(DetailEntity, Downloadable):
         # self.data_original_query_params = self.get_data_original_query_params(data_original_0)
         self.data_original_query_params = None
 
+        # 解密计划 (scramble_id, page_arr, 分割数列表)，由下载器在开始下载章节时计算，
+        # 见 JmImageTool.get_descramble_plan
+        self.descramble_plan: Optional[tuple] = None
+
     @property
     def is_single_album(self) -> bool:
         return self._series_id == 0
@@ -396,7 +402,7 @@ class JmPhotoDetail(DetailEntity, Downloadable):
 
         data_original = self.get_img_data_original(self.page_arr[index])
 
-        return JmModuleConfig.image_class().of(
+        image = JmModuleConfig.image_class().of(
             self.photo_id,
             self.scramble_id,
             data_original,
@@ -405,6 +411,13 @@ class JmPhotoDetail(DetailEntity, Downloadable):
             index=index + 1,
         )
 
+        # page_arr 或 scramble_id 被重新赋值后，解密计划失效，由解密时根据url计算
+        plan = self.descramble_plan
+        if plan is not None and plan[0] == str(self.scramble_id) and plan[1] is self.page_arr:
+            image.scramble_num = plan[2][index]
+
+        return image
+
     def get_img_data_original(self, img_name: str) -> str:
         """
         根据图片名，生成图片的完整请求路径 URL
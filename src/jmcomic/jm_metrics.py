@@ -0,0 +1,278 @@
+from .jm_toolkit import *
+
+
+class JmDownloadMetrics:
+    """
+    下载过程的统计指标，供监控使用
+
+    - 计数器（counter）：下载成功/失败的图片数、接收的字节数、各域名的重试次数等
+    - 仪表（gauge）：进行中的图片请求数、等待解密的图片数等
+    - 直方图（histogram）：图片请求耗时、解密耗时、写文件耗时
+
+    支持两种获取方式：
+    1. 拉取：snapshot() 返回dict
+    2. HTTP：serve(port) 在本地启动HTTP服务，以Prometheus文本格式输出
+    """
+
+    PREFIX = 'jmcomic_'
+
+    # 耗时直方图的桶，单位秒
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    HELP = {
+        'image_success_total': '下载成功的图片数',
+        'image_failed_total': '下载失败的图片数',
+        'photo_success_total': '下载完成的章节数',
+        'bytes_received_total': '接收的图片字节数',
+        'request_retries_total': '请求失败重试的次数',
+        'image_fetch_inflight': '进行中的图片请求数',
+        'image_decode_inflight': '等待解密保存的图片数',
+        'image_fetch_seconds': '图片请求耗时',
+        'image_decode_seconds': '图片解密保存耗时（包含编码和写文件）',
+        'image_write_seconds': '不需要解密的图片写文件耗时',
+    }
+
+    def __init__(self):
+        from threading import Lock
+        from time import monotonic
+        self.lock = Lock()
+        self.start_time = monotonic()
+        # name → {labels → value}，labels为 ((k, v), ...)
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.gauges: Dict[str, Dict[tuple, float]] = {}
+        # name → {labels → [各个桶的计数..., 总数, 总和]}
+        self.histograms: Dict[str, Dict[tuple, list]] = {}
+        # name → {labels → 获取当前值的函数}，在取值时调用
+        self.gauge_functions: Dict[str, Dict[tuple, Callable[[], Optional[float]]]] = {}
+
+    @staticmethod
+    def to_labels(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self.to_labels(labels)
+        with self.lock:
+            metric = self.counters.setdefault(name, {})
+            metric[key] = metric.get(key, 0) + value
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        key = self.to_labels(labels)
+        with self.lock:
+            metric = self.gauges.setdefault(name, {})
+            metric[key] = metric.get(key, 0) + delta
+
+    def register_gauge(self, name: str, func: Callable[[], Optional[float]], **labels):
+        """
+        注册一个取值时才计算的仪表，例如自适应并发的当前窗口。
+        func返回None表示仪表已失效（例如所属对象已被回收），取值时会移除该仪表
+        """
+        key = self.to_labels(labels)
+        with self.lock:
+            self.gauge_functions.setdefault(name, {})[key] = func
+
+    def unregister_gauge(self, name: str, **labels):
+        key = self.to_labels(labels)
+        with self.lock:
+            metric = self.gauge_functions.get(name, {})
+            metric.pop(key, None)
+            if len(metric) == 0:
+                self.gauge_functions.pop(name, None)
+
+    def collect_gauge_functions(self) -> Dict[str, Dict[tuple, float]]:
+        """
+        调用所有注册的仪表函数，移除已失效的仪表
+        """
+        with self.lock:
+            functions = {name: dict(metric) for name, metric in self.gauge_functions.items()}
+
+        gauges = {}
+        for name, metric in functions.items():
+            for key, func in metric.items():
+                value = func()
+                if value is None:
+                    self.unregister_gauge(name, **dict(key))
+                else:
+                    gauges.setdefault(name, {})[key] = value
+        return gauges
+
+    def observe(self, name: str, value: float, **labels):
+        key = self.to_labels(labels)
+        buckets = self.LATENCY_BUCKETS
+        with self.lock:
+            metric = self.histograms.setdefault(name, {})
+            data = metric.get(key, None)
+            if data is None:
+                data = [0] * (len(buckets) + 2)
+                metric[key] = data
+
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += 1
+            data[-1] += value
+
+    def time(self, name: str, inflight: Optional[str] = None, **labels):
+        """
+        统计一段代码的耗时，用法:
+        with metrics.time('image_fetch_seconds', inflight='image_fetch_inflight'):
+            ...
+
+        :param name: 直方图名
+        :param inflight: 仪表名，执行期间该仪表+1
+        """
+        from contextlib import contextmanager
+        from time import monotonic
+
+        @contextmanager
+        def timer():
+            if inflight is not None:
+                self.add_gauge(inflight, 1)
+            begin = monotonic()
+            try:
+                yield
+            finally:
+                self.observe(name, monotonic() - begin, **labels)
+                if inflight is not None:
+                    self.add_gauge(inflight, -1)
+
+        return timer()
+
+    def percentile(self, name: str, q: float, **labels) -> Optional[float]:
+        """
+        根据直方图估算分位数，在所在的桶内按样本均匀分布线性插值，没有数据时返回None，
+        超过最大的桶时返回无穷大
+        """
+        with self.lock:
+            data = self.histograms.get(name, {}).get(self.to_labels(labels), None)
+            if data is None or data[-2] == 0:
+                return None
+            data = list(data)
+
+        # 桶的计数是累计的：data[i] 是不超过第i个桶上界的样本数
+        target = q * data[-2]
+        lower, lower_count = 0.0, 0
+        for i, bound in enumerate(self.LATENCY_BUCKETS):
+            if data[i] >= target and data[i] > lower_count:
+                return lower + (bound - lower) * (target - lower_count) / (data[i] - lower_count)
+            lower, lower_count = bound, data[i]
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        """
+        返回当前的全部指标
+
+        不带标签的指标，值为数字；带标签的指标，值为 {'k=v,...': 数字}
+        """
+        from time import monotonic
+
+        def unwrap(metric: dict):
+            if list(metric.keys()) == [()]:
+                return metric[()]
+            return {','.join(f'{k}={v}' for k, v in key): value for key, value in metric.items()}
+
+        with self.lock:
+            uptime = monotonic() - self.start_time
+            counters = {name: unwrap(metric) for name, metric in self.counters.items()}
+            gauges = {name: unwrap(metric) for name, metric in self.gauges.items()}
+            histograms = {}
+            for name, metric in self.histograms.items():
+                histograms[name] = unwrap({
+                    key: {
+                        'count': data[-2],
+                        'sum': data[-1],
+                        'avg': data[-1] / data[-2] if data[-2] else 0,
+                        'buckets': dict(zip(self.LATENCY_BUCKETS, data[:-2])),
+                    }
+                    for key, data in metric.items()
+                })
+
+        for name, metric in self.collect_gauge_functions().items():
+            gauges[name] = unwrap(metric)
+
+        return {
+            'uptime': uptime,
+            'image_per_second': self.counter_value('image_success_total') / uptime if uptime else 0,
+            'bytes_per_second': self.counter_value('bytes_received_total') / uptime if uptime else 0,
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': histograms,
+        }
+
+    def counter_value(self, name: str) -> float:
+        with self.lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def to_prometheus_text(self) -> str:
+        """
+        以Prometheus文本格式输出全部指标
+        """
+
+        def fmt_labels(key: tuple, extra: tuple = ()):
+            items = key + extra
+            if len(items) == 0:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        lines = []
+
+        def header(name, kind):
+            full = self.PREFIX + name
+            if name in self.HELP:
+                lines.append(f'# HELP {full} {self.HELP[name]}')
+            lines.append(f'# TYPE {full} {kind}')
+            return full
+
+        with self.lock:
+            counters = {name: dict(metric) for name, metric in self.counters.items()}
+            gauges = {name: dict(metric) for name, metric in self.gauges.items()}
+            histograms = {name: {k: list(v) for k, v in metric.items()} for name, metric in self.histograms.items()}
+
+        gauges.update(self.collect_gauge_functions())
+
+        for name, metric in counters.items():
+            full = header(name, 'counter')
+            for key, value in metric.items():
+                lines.append(f'{full}{fmt_labels(key)} {value}')
+
+        for name, metric in gauges.items():
+            full = header(name, 'gauge')
+            for key, value in metric.items():
+                lines.append(f'{full}{fmt_labels(key)} {value}')
+
+        for name, metric in histograms.items():
+            full = header(name, 'histogram')
+            for key, data in metric.items():
+                for bound, count in zip(self.LATENCY_BUCKETS, data[:-2]):
+                    lines.append(f'{full}_bucket{fmt_labels(key, (("le", bound),))} {count}')
+                lines.append(f'{full}_bucket{fmt_labels(key, (("le", "+Inf"),))} {data[-2]}')
+                lines.append(f'{full}_count{fmt_labels(key)} {data[-2]}')
+                lines.append(f'{full}_sum{fmt_labels(key)} {data[-1]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host='127.0.0.1'):
+        """
+        在后台线程启动HTTP服务，任意路径都返回Prometheus文本格式的指标
+
+        :returns: http.server.ThreadingHTTPServer，可调用shutdown()停止
+        """
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from threading import Thread
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        Thread(target=server.serve_forever, name='jm_metrics_server', daemon=True).start()
+        jm_log('metrics.serve', f'指标HTTP服务已启动: http://{host}:{server.server_port}/metrics')
+        return server
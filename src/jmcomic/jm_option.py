@@ -201,6 +201,21 @@ class JmOption:
         # 需要主线程等待完成的插件
         self.need_wait_plugins = []
 
+        # 按域名限流，同一个option创建的所有client共用，见 decide_client_limiter
+        self.client_limiter: Optional[JmHostLimiter] = None
+        self.client_limiter_lock = Lock()
+        # 图片对冲请求，同一个option创建的所有client共用，见 decide_image_hedge
+        self.image_hedge: Optional[JmImageHedge] = None
+        self.image_hedge_lock = Lock()
+        # 域名健康度，同一个option创建的所有client共用，见 decide_domain_health
+        self.domain_health: Optional[JmDomainHealth] = None
+        self.domain_health_lock = Lock()
+
+        # 下载统计指标，同一个option创建的所有downloader共用，见 decide_download_metrics
+        self.download_metrics: Optional[JmDownloadMetrics] = None
+        self.download_metrics_server = None
+        self.download_metrics_lock = Lock()
+
         if call_after_init_plugin:
             self.call_all_plugin('after_init', safe=True)
 
@@ -230,6 +245,123 @@ class JmOption:
     def decide_photo_batch_count(self, album: JmAlbumDetail):
         return self.download.threading.photo
 
+    def decide_client_limiter(self) -> Optional[JmHostLimiter]:
+        """
+        按域名限流的limiter，首次调用时根据 client.limit 配置创建，
+        之后该option创建的所有client都共用这一个limiter
+        """
+        if self.client_limiter is None:
+            with self.client_limiter_lock:
+                if self.client_limiter is None:
+                    self.client_limiter = JmHostLimiter.from_conf(self.client.src_dict.get('limit', None))
+
+        return self.client_limiter
+
+    def decide_domain_health(self) -> Optional[JmDomainHealth]:
+        """
+        域名健康度，首次调用时根据 client.health 配置创建，
+        之后该option创建的所有client都共用，从而共享各个域名的耗时和失败率
+        """
+        if self.domain_health is None:
+            with self.domain_health_lock:
+                if self.domain_health is None:
+                    self.domain_health = JmDomainHealth.from_conf(self.client.src_dict.get('health', None))
+
+        return self.domain_health
+
+    def decide_image_hedge(self) -> Optional[JmImageHedge]:
+        """
+        图片对冲请求，首次调用时根据 download.image.hedge 配置创建，
+        之后该option创建的所有client都共用（包括执行请求的线程池）
+        """
+        if self.image_hedge is None:
+            with self.image_hedge_lock:
+                if self.image_hedge is None:
+                    self.image_hedge = JmImageHedge.from_conf(self.download.image.src_dict.get('hedge', None))
+
+        return self.image_hedge
+
+    def decide_circuit_breaker(self) -> Optional[JmCircuitBreaker]:
+        """
+        按域名熔断的熔断器，根据 client.circuit_breaker 配置获取，配置相同时进程内共用同一个
+        """
+        return JmCircuitBreaker.from_conf(self.client.src_dict.get('circuit_breaker', None))
+
+    def decide_client_retry_policy(self) -> JmRetryPolicy:
+        """
+        client的重试策略，根据 client.retry 配置创建
+        """
+        return JmRetryPolicy.from_conf(self.client.src_dict.get('retry', None))
+
+    def decide_download_metrics(self) -> JmDownloadMetrics:
+        """
+        下载统计指标，首次调用时创建，之后该option创建的所有downloader都共用。
+        如果配置了 download.metrics.port，同时在本地启动HTTP服务，以Prometheus文本格式输出指标
+        """
+        if self.download_metrics is None:
+            with self.download_metrics_lock:
+                if self.download_metrics is None:
+                    metrics = JmDownloadMetrics()
+                    conf = self.download.get('metrics', None) or {}
+                    if conf.get('port', None) is not None:
+                        self.download_metrics_server = metrics.serve(conf['port'], conf.get('host', None) or '127.0.0.1')
+                    self.download_metrics = metrics
+
+        return self.download_metrics
+
+    def decide_journal_filepath(self) -> Optional[str]:
+        """
+        下载日志的文件路径，返回None表示不启用下载日志
+        """
+        filepath = self.download.get('journal', None)
+        if not filepath:
+            return None
+
+        return JmcomicText.parse_to_abspath(filepath)
+
+    # noinspection PyUnusedLocal
+    def decide_photo_prefetch_count(self, album: JmAlbumDetail) -> Optional[int]:
+        """
+        章节详情的预取窗口，即最多提前请求多少个章节的详情，
+        返回None或0表示不预取，每个章节开始下载时才请求详情
+        """
+        return self.download.threading.get('prefetch', None) or None
+
+    def decide_max_image_count(self) -> Optional[int]:
+        """
+        进程内所有本子/章节共享的图片并发上限，
+        返回None表示不启用全局图片调度器，沿用每个章节各自的图片线程池
+        """
+        return self.download.threading.get('max_image', None)
+
+    def decide_adaptive_concurrency(self) -> Optional[dict]:
+        """
+        图片下载自适应并发的配置，返回None表示不启用，使用固定的 download.threading.image
+
+        :returns: JmAdaptiveConcurrency 的构造参数
+        """
+        conf = self.download.threading.get('adaptive', None)
+        if not conf:
+            return None
+
+        if conf is True:
+            conf = {}
+
+        image = self.download.threading.image
+        return {
+            'initial': image,
+            'min_window': conf.get('min', 1),
+            'max_window': conf.get('max', max(image, 60)),
+            'latency': conf.get('latency', 10),
+        }
+
+    def decide_decode_process_count(self) -> Optional[int]:
+        """
+        图片解密进程池的进程数，
+        返回None或0表示不启用进程池，沿用在下载线程中直接解密保存的方式
+        """
+        return self.download.threading.get('decode', None) or None
+
     # noinspection PyMethodMayBeStatic
     def decide_image_filename(self, image: JmImageDetail) -> str:
         """
@@ -261,15 +393,84 @@ class JmOption:
 
         return save_dir
 
-    def decide_image_filepath(self, image: JmImageDetail, consider_custom_suffix=True) -> str:
+    def decide_image_filepath(self, image: JmImageDetail, consider_custom_suffix=True, save_dir=None) -> str:
+        """
+        :param save_dir: 已经决定好的保存文件夹，为None时根据 dir_rule 决定，见 JmDownloader.decide_image_save_dir
+        """
         # 以此决定保存文件夹、后缀、不包含后缀的文件名
-        save_dir = self.decide_image_save_dir(image.from_photo)
+        if save_dir is None:
+            save_dir = self.decide_image_save_dir(image.from_photo)
         suffix = self.decide_image_suffix(image) if consider_custom_suffix else image.img_file_suffix
         return os.path.join(save_dir, fix_windir_name(self.decide_image_filename(image)) + suffix)
 
     def decide_download_cache(self, _image: JmImageDetail) -> bool:
         return self.download.cache
 
+    # noinspection PyUnusedLocal
+    def decide_download_image_stream(self, image: JmImageDetail) -> bool:
+        """
+        是否流式下载图片：边接收边写入临时文件，不在内存中保留完整的响应体。
+        启用了解密进程池时，图片数据需要传给解密进程，不使用流式下载
+        """
+        return self.download.image.get('stream', False) is True
+
+    def decide_cache_check_size(self) -> bool:
+        """
+        判断图片是否已存在时，是否忽略大小为0的文件（例如上次下载中断留下的空文件）
+        """
+        return self.download.get('cache_check_size', False) is True
+
+    def decide_image_decode_backend(self) -> str:
+        """
+        图片解密的实现，见 JmImageTool.decode_and_save。
+        配置为numpy但未安装numpy时，打印日志并使用pil
+        """
+        backend = self.download.image.get('decode_backend', None) or JmImageTool.DECODE_BACKEND_PIL
+        ExceptionTool.require_true(
+            backend in (JmImageTool.DECODE_BACKEND_PIL, JmImageTool.DECODE_BACKEND_NUMPY),
+            f'不支持的图片解密实现: {backend}，可选值: pil, numpy',
+        )
+
+        if backend == JmImageTool.DECODE_BACKEND_NUMPY:
+            try:
+                import numpy
+            except ImportError:
+                jm_log('option.decode_backend',
+                       '图片解密实现配置为numpy，但未安装numpy，使用pil。安装命令: [pip install numpy]')
+                return JmImageTool.DECODE_BACKEND_PIL
+
+        return backend
+
+    def decide_image_encode_profile(self) -> Optional[dict]:
+        """
+        图片编码配置，见 JmImageTool.save_image。
+        可以是 JmModuleConfig.REGISTRY_IMAGE_ENCODE_PROFILE 中的配置名，也可以直接配置 {图片格式: 参数}；
+        为null时使用PIL的默认参数
+        """
+        profile = self.download.image.get('profile', None)
+        if profile is None or isinstance(profile, dict):
+            return profile
+
+        registry = JmModuleConfig.REGISTRY_IMAGE_ENCODE_PROFILE
+        ExceptionTool.require_true(
+            profile in registry,
+            f'不支持的图片编码配置: {profile}，可选值: {", ".join(registry)}',
+        )
+        return registry[profile]
+
+    def decide_image_defer_decode(self) -> Optional[int]:
+        """
+        延迟解密的后台线程数，见 JmDeferredDecoder。
+        返回None表示不启用延迟解密；返回0表示下载期间不还原图片，之后用命令 `jmcomic descramble <目录>` 还原
+        """
+        conf = self.download.image.get('defer_decode', None) or {}
+        if conf.get('enable', False) is not True:
+            return None
+
+        workers = conf.get('workers', None) or 0
+        ExceptionTool.require_true(workers >= 0, f'延迟解密的线程数不能小于0: {workers}')
+        return workers
+
     def decide_download_image_decode(self, image: JmImageDetail) -> bool:
         # .gif file needn't be decoded
         if image.is_gif:
@@ -301,6 +502,11 @@ class JmOption:
         if log is False:
             disable_jm_log()
 
+        # disk cache，与log一样是全局配置
+        disk_cache = (dic.get('client', None) or {}).get('disk_cache', None) or {}
+        if disk_cache.get('enable', False) is True:
+            JmModuleConfig.enable_disk_cache(disk_cache.get('path', None))
+
         # version
         version = dic.pop('version', None)
         # noinspection PyTypeChecker
@@ -446,6 +652,30 @@ class JmOption:
         # enable cache
         CacheRegistry.enable_client_cache_on_condition(self, client, cache)
 
+        # enable limit
+        client.set_limiter(self.decide_client_limiter())
+
+        # retry policy
+        client.set_retry_policy(self.decide_client_retry_policy())
+
+        # domain health
+        client.set_domain_health(self.decide_domain_health())
+
+        # circuit breaker
+        client.set_circuit_breaker(self.decide_circuit_breaker())
+
+        # image hedge
+        client.set_image_hedge(self.decide_image_hedge())
+
+        # decode backend
+        client.set_decode_backend(self.decide_image_decode_backend())
+
+        # encode profile
+        client.set_encode_profile(self.decide_image_encode_profile())
+
+        # defer decode
+        client.set_defer_decode(self.decide_image_defer_decode() is not None)
+
         # noinspection PyTypeChecker
         return client
 
@@ -1251,13 +1251,16 @@ class AdvancedRetryPlugin(JmOptionPlugin):
                            request: Callable,
                            url: str,
                            is_image: bool,
+                           no_retry_status: Iterable[int] = (),
                            **kwargs,
                            ):
         """
         实现如下域名重试机制：
         - 对域名列表轮询请求，配置：retry_rounds
         - 限制单个域名最大失败次数，配置：retry_domain_max_times
-        - 轮询域名列表前，根据历史失败次数对域名列表排序，失败多的后置
+        - 轮询域名列表前，根据历史失败次数对域名列表排序，失败多的后置；启用了域名健康度时，按健康度排序
+        - 退避等待、总耗时上限、不重试的异常，沿用client的重试策略（client.retry），
+          只在两次尝试之间等待，最后一次尝试失败后不再等待
         """
 
         def do_request(domain):
@@ -1271,34 +1274,62 @@ class AdvancedRetryPlugin(JmOptionPlugin):
                 # 图片url
                 client.update_request_with_specify_domain(kwargs, None, is_image)
 
-            resp = request(url_to_use, **kwargs)
-            resp = client.raise_if_resp_should_retry(resp, is_image)
+            begin = monotonic()
+            try:
+                resp = request(url_to_use, **kwargs)
+                resp = client.raise_if_resp_should_retry(resp, is_image)
+            except Exception as e:
+                client.record_request_result(url_to_use, begin, e, no_retry_status)
+                raise
+            client.record_request_result(url_to_use, begin)
             return resp
 
         retry_domain_max_times: int = self.retry_config['retry_domain_max_times']
         retry_rounds: int = self.retry_config['retry_rounds']
+        state = client.retry_policy.start()
+        failed = False
         for rindex in range(retry_rounds):
             domain_list = self.get_sorted_domain(client, retry_domain_max_times)
             for i, domain in enumerate(domain_list):
                 if self.failed_count(client, domain) >= retry_domain_max_times:
                     continue
 
+                if not client.allow_request_to(url, domain):
+                    continue
+
+                # 在下一次尝试之前等待，没有下一次尝试时不用等
+                if failed:
+                    delay = client.decide_retry_delay(state, url)
+                    if delay is None:
+                        return client.fallback(request, url, 0, 0, is_image, **kwargs)
+                    if delay > 0:
+                        sleep(delay)
+
                 try:
                     return do_request(domain)
                 except Exception as e:
+                    if not client.retry_policy.should_retry(e, no_retry_status):
+                        raise e
+
                     from common import traceback_print_exec
                     traceback_print_exec()
                     jm_log('req.error', str(e))
                     self.update_failed_count(client, domain)
+                    if client.metrics is not None:
+                        client.metrics.inc('request_retries_total', domain=domain)
+                    failed = True
 
         return client.fallback(request, url, 0, 0, is_image, **kwargs)
 
     def get_sorted_domain(self, client: JmcomicClient, times):
-        domain_list = client.get_domain_list()
-        return sorted(
-            filter(lambda d: self.failed_count(client, d) < times, domain_list),
-            key=lambda d: self.failed_count(client, d)
-        )
+        domain_list = [d for d in client.get_domain_list() if self.failed_count(client, d) < times]
+
+        # noinspection PyUnresolvedReferences
+        domain_health: Optional[JmDomainHealth] = client.domain_health
+        if domain_health is not None:
+            return domain_health.sort(domain_list)
+
+        return sorted(domain_list, key=lambda d: self.failed_count(client, d))
 
     # noinspection PyUnresolvedReferences
     def update_failed_count(self, client: AbstractJmClient, domain: str):
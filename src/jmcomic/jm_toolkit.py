@@ -792,9 +792,15 @@ class JmApiAdaptTool:
 
 
 class JmImageTool:
+    # 图片解密的实现，见 decode_and_save
+    DECODE_BACKEND_PIL = 'pil'
+    DECODE_BACKEND_NUMPY = 'numpy'
+    # 延迟解密时，原始图片和附属文件的后缀，见 save_deferred
+    DEFERRED_RAW_SUFFIX = '.scrambled'
+    DEFERRED_SIDECAR_SUFFIX = '.scrambled.json'
 
     @classmethod
-    def save_resp_img(cls, resp: Any, filepath: str, need_convert=True):
+    def save_resp_img(cls, resp: Any, filepath: str, need_convert=True, profile: Optional[dict] = None):
         """
         接收HTTP响应对象，将其保存到图片文件.
         如果需要改变图片的文件格式，比如 .jpg → .png，则需要指定参数 neet_convert=True.
@@ -803,21 +809,35 @@ class JmImageTool:
         :param resp: JmImageResp
         :param filepath: 图片文件路径
         :param need_convert: 是否转换图片
+        :param profile: 图片编码配置，见 save_image
         """
         if need_convert is False:
             cls.save_directly(resp, filepath)
         else:
-            cls.save_image(cls.open_image(resp.content), filepath)
+            cls.save_image(cls.open_image(resp.content), filepath, profile)
 
     @classmethod
-    def save_image(cls, image: Image, filepath: str):
+    def save_image(cls, image: Image, filepath: str, profile: Optional[dict] = None):
         """
         保存图片
 
         :param image: PIL.Image对象
         :param filepath: 保存文件路径
+        :param profile: 图片编码配置，key是PIL的图片格式名，value是传给 Image.save 的参数，
+                        见 JmModuleConfig.REGISTRY_IMAGE_ENCODE_PROFILE。为None时使用PIL的默认参数
         """
-        image.save(filepath)
+        image.save(filepath, **cls.decide_encode_params(filepath, profile))
+
+    @classmethod
+    def decide_encode_params(cls, filepath: str, profile: Optional[dict]) -> dict:
+        """
+        根据保存路径的后缀名，从编码配置中取出对应图片格式的参数
+        """
+        if not profile:
+            return {}
+
+        image_format = Image.registered_extensions().get(of_file_suffix(filepath).lower(), None)
+        return profile.get(image_format, None) or {}
 
     @classmethod
     def save_directly(cls, resp, filepath):
@@ -828,36 +848,79 @@ class JmImageTool:
     def decode_and_save(cls,
                         num: int,
                         img_src: Image,
-                        decoded_save_path: str
+                        decoded_save_path: str,
+                        backend: str = DECODE_BACKEND_PIL,
+                        profile: Optional[dict] = None,
                         ) -> None:
         """
         解密图片并保存
         :param num: 分割数，可以用 cls.calculate_segmentation_num 计算
         :param img_src: 原始图片
         :param decoded_save_path: 解密图片的保存路径
+        :param backend: 解密实现，pil 或 numpy，两者得到的像素完全一致
+        :param profile: 图片编码配置，见 save_image
         """
 
         # 无需解密，直接保存
         if num == 0:
-            cls.save_image(img_src, decoded_save_path)
+            cls.save_image(img_src, decoded_save_path, profile)
             return
 
-        import math
+        if backend == cls.DECODE_BACKEND_NUMPY:
+            img_decode = cls.decode_image_numpy(num, img_src)
+        else:
+            img_decode = cls.decode_image_pil(num, img_src)
+
+        # 保存到新的解密文件
+        cls.save_image(img_decode, decoded_save_path, profile)
+
+    @classmethod
+    def decode_raw_and_save(cls,
+                            num: int,
+                            raw: Union[str, bytes],
+                            decoded_save_path: str,
+                            backend: str = DECODE_BACKEND_PIL,
+                            profile: Optional[dict] = None,
+                            ) -> None:
+        """
+        解密图片的原始数据并保存。
+        原图是jpg、要保存为jpg时，先尝试 JmJpegTool 的无损重排，不满足条件再解码图片，交给 decode_and_save
+
+        :param num: 分割数
+        :param raw: 图片的原始字节，或者图片文件路径
+        :param decoded_save_path: 解密图片的保存路径
+        :param backend: 解密实现，见 decode_and_save
+        :param profile: 图片编码配置，见 save_image。无损重排不重新编码，不使用该配置
+        """
+        if (
+                num != 0
+                and JmModuleConfig.FLAG_JPEG_LOSSLESS_DECODE is True
+                and of_file_suffix(decoded_save_path).lower() in ('.jpg', '.jpeg')
+        ):
+            data = raw
+            if isinstance(raw, str):
+                with open(raw, 'rb') as f:
+                    data = f.read()
+
+            data = JmJpegTool.descramble(num, data)
+            if data is not None:
+                with open(decoded_save_path, 'wb') as f:
+                    f.write(data)
+                return
+
+        with cls.open_image(raw) as img_src:
+            cls.decode_and_save(num, img_src, decoded_save_path, backend, profile)
+
+    @classmethod
+    def decode_image_pil(cls, num: int, img_src: Image) -> Image:
+        """
+        逐个条带 crop + paste 还原图片
+        """
         w, h = img_src.size
 
         # 创建新的解密图片
         img_decode = Image.new("RGB", (w, h))
-        over = h % num
-        for i in range(num):
-            move = math.floor(h / num)
-            y_src = h - (move * (i + 1)) - over
-            y_dst = move * i
-
-            if i == 0:
-                move += over
-            else:
-                y_dst += over
-
+        for y_src, y_dst, move in cls.get_strip_list(num, h):
             img_decode.paste(
                 img_src.crop((
                     0, y_src,
@@ -869,14 +932,171 @@ class JmImageTool:
                 )
             )
 
-            # save every step result
-            # cls.save_image(img_decode, change_file_name(
-            #     decoded_save_path,
-            #     f'{of_file_name(decoded_save_path, trim_suffix=True)}_{i}{of_file_suffix(decoded_save_path)}'
-            # ))
+        return img_decode
 
-        # 保存到新的解密文件
-        cls.save_image(img_decode, decoded_save_path)
+    @classmethod
+    def decode_image_numpy(cls, num: int, img_src: Image) -> Image:
+        """
+        与 decode_image_pil 的结果一致，但只把图片转为numpy数组一次，
+        条带的还原是对行切片的一次拼接，不会为每个条带创建中间图片。
+
+        混淆图从上到下依次是 num-1 个高为 h//num 的条带和最后一个包含余数行的条带，
+        还原就是把这些条带的顺序倒过来。
+        """
+        import numpy as np
+        arr = np.asarray(img_src if img_src.mode == 'RGB' else img_src.convert('RGB'))
+        strips = [arr[y_src:y_src + move] for y_src, _, move in cls.get_strip_list(num, arr.shape[0])]
+        return Image.fromarray(np.concatenate(strips, axis=0))
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def get_strip_list(num: int, h: int) -> Tuple[Tuple[int, int, int], ...]:
+        """
+        还原图片时每个条带的位置，按在原图中从上到下的顺序。
+        同样高度的图片条带位置相同，结果会被缓存
+
+        :param num: 分割数
+        :param h: 图片高度
+        :returns: 每个条带的 (在混淆图中的起始行, 在原图中的起始行, 高度)
+        """
+        over = h % num
+        height = h // num
+        strip_list = []
+        for i in range(num):
+            move = height
+            y_src = h - (move * (i + 1)) - over
+            y_dst = move * i
+
+            if i == 0:
+                move += over
+            else:
+                y_dst += over
+
+            strip_list.append((y_src, y_dst, move))
+
+        return tuple(strip_list)
+
+    @classmethod
+    def save_content(cls,
+                     content: bytes,
+                     filepath: str,
+                     num: Optional[int] = None,
+                     need_convert=True,
+                     backend: str = DECODE_BACKEND_PIL,
+                     profile: Optional[dict] = None,
+                     ) -> None:
+        """
+        把图片的原始字节解密并保存，与 JmImageResp.transfer_to 的处理一致，
+        但只依赖bytes，可以在解密进程池中执行
+
+        :param content: 图片响应的原始数据
+        :param filepath: 保存文件路径
+        :param num: 分割数，为None时表示不解密
+        :param need_convert: 不解密时，是否需要用PIL转换图片格式
+        :param backend: 解密实现，见 decode_and_save
+        :param profile: 图片编码配置，见 save_image
+        """
+        cls.retry_on_missing_dir(filepath, cls.do_save_content, content, filepath, num, need_convert, backend, profile)
+
+    @classmethod
+    def do_save_content(cls, content: bytes, filepath: str, num, need_convert, backend, profile) -> None:
+        if num is not None:
+            cls.decode_raw_and_save(num, content, filepath, backend, profile)
+        elif need_convert is True:
+            cls.save_image(cls.open_image(content), filepath, profile)
+        else:
+            with open(filepath, 'wb') as f:
+                f.write(content)
+
+    @classmethod
+    def retry_on_missing_dir(cls, filepath: str, func: Callable, *args, **kwargs):
+        """
+        执行保存图片的方法func。
+        保存文件夹只在章节开始时创建一次，下载过程中被删除时，func会抛出 FileNotFoundError，
+        这时重新创建文件夹后再执行一次
+        """
+        try:
+            return func(*args, **kwargs)
+        except FileNotFoundError:
+            save_dir = os.path.dirname(filepath)
+            if save_dir == '' or os.path.isdir(save_dir):
+                raise
+
+        jm_log('image.save_dir', f'保存文件夹不存在，重新创建: [{save_dir}]')
+        JmcomicText.try_mkdir(save_dir)
+        return func(*args, **kwargs)
+
+    @classmethod
+    def save_deferred(cls, raw: Union[str, bytes], filepath: str, num: int) -> None:
+        """
+        延迟解密：不解密图片，只保存原始的混淆图片和记录分割数的附属文件，之后再用 decode_deferred 还原。
+        附属文件最后写入，附属文件存在即表示原始图片已完整保存
+
+        :param raw: 图片的原始字节，或者原始图片的临时文件路径（会被移动）
+        :param filepath: 最终的图片路径
+        :param num: 分割数
+        """
+        import json
+        raw_path = filepath + cls.DEFERRED_RAW_SUFFIX
+        if isinstance(raw, str):
+            os.replace(raw, raw_path)
+        else:
+            with open(raw_path, 'wb') as f:
+                f.write(raw)
+
+        sidecar_path = filepath + cls.DEFERRED_SIDECAR_SUFFIX
+        with open(f'{sidecar_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'num': num}, f)
+        os.replace(f'{sidecar_path}.tmp', sidecar_path)
+
+    @classmethod
+    def decode_deferred(cls,
+                        filepath: str,
+                        backend: str = DECODE_BACKEND_PIL,
+                        profile: Optional[dict] = None,
+                        ) -> bool:
+        """
+        把 save_deferred 保存的图片还原为最终的图片文件，可以重复执行、中断后重新执行：
+        最终图片先写到临时文件，写完再替换为最终路径，因此最终图片要么不存在、要么是完整的；
+        最终图片保存完成后才删除原始图片，最后删除附属文件；
+        附属文件还在但原始图片已删除，说明上次已保存完最终图片，只差删除附属文件
+
+        :param filepath: 最终的图片路径
+        :param backend: 解密实现，见 decode_and_save
+        :param profile: 图片编码配置，见 save_image
+        :returns: 是否还原了图片，没有待还原的数据时返回False
+        """
+        import json
+        sidecar_path = filepath + cls.DEFERRED_SIDECAR_SUFFIX
+        if not os.path.exists(sidecar_path):
+            return False
+
+        raw_path = filepath + cls.DEFERRED_RAW_SUFFIX
+        if os.path.exists(raw_path):
+            with open(sidecar_path, encoding='utf-8') as f:
+                num = json.load(f)['num']
+            # 临时文件保留原后缀，PIL据此决定图片格式
+            root, suffix = os.path.splitext(filepath)
+            tmp_path = f'{root}.decoding{suffix}'
+            cls.decode_raw_and_save(num, raw_path, tmp_path, backend, profile)
+            os.replace(tmp_path, filepath)
+            os.remove(raw_path)
+
+        os.remove(sidecar_path)
+        return True
+
+    @classmethod
+    def find_deferred(cls, dirpath: str) -> List[str]:
+        """
+        递归查找目录下等待还原的图片，返回最终的图片路径
+        """
+        suffix = cls.DEFERRED_SIDECAR_SUFFIX
+        return [
+            os.path.join(root, filename[:-len(suffix)])
+            for root, _, files in os.walk(dirpath)
+            for filename in files
+            if filename.endswith(suffix)
+        ]
 
     @classmethod
     def open_image(cls, fp: Union[str, bytes]):
@@ -898,15 +1118,66 @@ class JmImageTool:
         elif aid < JmMagicConstants.SCRAMBLE_268850:
             return 10
         else:
-            import hashlib
-            x = 10 if aid < JmMagicConstants.SCRAMBLE_421926 else 8
-            s = f"{aid}{filename}"  # 拼接
-            s = s.encode()
-            s = hashlib.md5(s).hexdigest()
-            num = ord(s[-1])
-            num %= x
-            num = num * 2 + 2
-            return num
+            return cls.get_num_by_md5(aid, filename)
+
+    @classmethod
+    def get_num_by_md5(cls, aid: int, filename: str) -> int:
+        """
+        较新的章节（aid >= SCRAMBLE_268850），分割数由章节id和图片文件名的md5决定
+        """
+        import hashlib
+        x = 10 if aid < JmMagicConstants.SCRAMBLE_421926 else 8
+        s = f"{aid}{filename}"  # 拼接
+        s = s.encode()
+        s = hashlib.md5(s).hexdigest()
+        num = ord(s[-1])
+        num %= x
+        num = num * 2 + 2
+        return num
+
+    @classmethod
+    def get_num_list(cls, scramble_id, aid, filename_list: List[str]) -> List[int]:
+        """
+        一次获得同一个章节的全部图片的分割数，与逐张调用 get_num 的结果一致。
+        分割数与图片文件名无关时（较早的章节），不需要逐张计算md5
+
+        :param filename_list: 图片文件名，不包含后缀
+        """
+        scramble_id = int(scramble_id)
+        aid = int(aid)
+
+        if aid < scramble_id:
+            return [0] * len(filename_list)
+        elif aid < JmMagicConstants.SCRAMBLE_268850:
+            return [10] * len(filename_list)
+
+        return [cls.get_num_by_md5(aid, filename) for filename in filename_list]
+
+    @classmethod
+    def get_descramble_plan(cls, photo: JmPhotoDetail) -> Optional[List[int]]:
+        """
+        解密计划：page_arr 中每张图片的分割数，一次计算整个章节，结果保存在 photo.descramble_plan，
+        之后从该章节取出的图片直接带上分割数（JmImageDetail.scramble_num）。
+        page_arr 或 scramble_id 被重新赋值后（例如从下载日志恢复、单独请求scramble_id），会重新计算
+
+        :returns: 与 page_arr 一一对应的分割数，缺少 page_arr 或 scramble_id 时返回None
+        """
+        page_arr = photo.page_arr
+        scramble_id = str(photo.scramble_id)
+        if not isinstance(page_arr, list) or not scramble_id.isdigit():
+            return None
+
+        plan = photo.descramble_plan
+        if plan is not None and plan[0] == scramble_id and plan[1] is page_arr:
+            return plan[2]
+
+        num_list = cls.get_num_list(
+            scramble_id,
+            photo.photo_id,
+            [of_file_name(img_name, True) for img_name in page_arr],
+        )
+        photo.descramble_plan = (scramble_id, page_arr, num_list)
+        return num_list
 
     @classmethod
     def get_num_by_url(cls, scramble_id, url) -> int:
@@ -922,11 +1193,198 @@ class JmImageTool:
     @classmethod
     def get_num_by_detail(cls, detail: JmImageDetail) -> int:
         """
-        获得图片分割数
+        获得图片分割数，优先使用章节的解密计划
         """
+        if detail.scramble_num is not None:
+            return detail.scramble_num
+
         return cls.get_num(detail.scramble_id, detail.aid, detail.img_file_name)
 
 
+class JmJpegTool:
+    """
+    在熵编码层面重排JPEG的条带，实现无损的图片解密（类似 jpegtran 的无损变换），
+    跳过解码和重新编码，既更快，也不会因为重新压缩而损失画质。
+
+    只有满足下面条件的JPEG可以这样处理，不满足时 descramble 返回None，由调用方回退到像素级的解密：
+    1. 基线或扩展顺序编码（SOF0/SOF1），只有一个包含全部颜色分量的扫描
+    2. 带有重启间隔（DRI）。重启标记处DC预测值会被重置，各个重启区间的数据互不依赖，可以直接调换顺序
+    3. 图片高度、每个条带的边界都落在MCU行上，并且条带边界恰好是某个重启区间的起点
+
+    一般来说，禁漫的图片大多是webp，或者不带重启标记的jpg，这类图片仍然走像素级的解密。
+    """
+
+    MARKER_SOI = 0xD8
+    MARKER_EOI = 0xD9
+    MARKER_SOS = 0xDA
+    MARKER_DRI = 0xDD
+    MARKER_RST0 = 0xD0
+    # 支持的帧类型：基线、扩展顺序（霍夫曼编码）
+    MARKER_SOF_SUPPORTED = (0xC0, 0xC1)
+    # 其他帧类型：渐进式、无损、算术编码等
+    MARKER_SOF_OTHERS = (0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+
+    @classmethod
+    def is_jpeg(cls, data: bytes) -> bool:
+        return data[:2] == b'\xff\xd8'
+
+    @classmethod
+    def parse(cls, data: bytes) -> Optional[dict]:
+        """
+        解析JPEG的帧信息和按重启标记切分的熵编码数据，不支持的JPEG返回None
+
+        :returns: dict，包含
+            header: SOS及之前的全部字节
+            segments: 每个重启区间的熵编码数据
+            interval: 重启间隔（MCU个数）
+            width, height: 图片尺寸
+            mcu_width, mcu_height: MCU尺寸
+        """
+        if not cls.is_jpeg(data):
+            return None
+
+        n = len(data)
+        pos = 2
+        frame = None
+        interval = 0
+
+        while True:
+            if pos + 4 > n or data[pos] != 0xFF:
+                return None
+
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                # 填充字节
+                pos += 1
+                continue
+
+            length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+            segment_end = pos + 2 + length
+
+            if marker in cls.MARKER_SOF_OTHERS:
+                return None
+
+            if marker in cls.MARKER_SOF_SUPPORTED:
+                height = int.from_bytes(data[pos + 5:pos + 7], 'big')
+                width = int.from_bytes(data[pos + 7:pos + 9], 'big')
+                component_count = data[pos + 9]
+                sampling = [data[pos + 11 + 3 * i] for i in range(component_count)]
+                frame = (width, height, component_count,
+                         max(s >> 4 for s in sampling), max(s & 0x0F for s in sampling))
+
+            elif marker == cls.MARKER_DRI:
+                interval = int.from_bytes(data[pos + 4:pos + 6], 'big')
+
+            elif marker == cls.MARKER_SOS:
+                break
+
+            pos = segment_end
+
+        # 高度为0表示高度由DNL标记给出，不支持
+        if frame is None or interval == 0 or frame[1] == 0:
+            return None
+
+        width, height, component_count, h_max, v_max = frame
+        # 只有一个扫描，并且包含全部颜色分量
+        if data[pos + 4] != component_count:
+            return None
+
+        if component_count == 1:
+            mcu_width, mcu_height = 8, 8
+        else:
+            mcu_width, mcu_height = 8 * h_max, 8 * v_max
+
+        segments = cls.split_restart_segments(data, segment_end)
+        if segments is None:
+            return None
+
+        mcu_count = -(-width // mcu_width) * -(-height // mcu_height)
+        if len(segments) != -(-mcu_count // interval):
+            return None
+
+        return {
+            'header': data[:segment_end],
+            'segments': segments,
+            'interval': interval,
+            'width': width,
+            'height': height,
+            'mcu_width': mcu_width,
+            'mcu_height': mcu_height,
+        }
+
+    @classmethod
+    def split_restart_segments(cls, data: bytes, begin: int) -> Optional[List[bytes]]:
+        """
+        从熵编码数据的起点开始，按重启标记切分，直到EOI。
+        遇到其他标记（第二个扫描、DNL等）时返回None
+        """
+        segments = []
+        start = begin
+        pos = begin
+        while True:
+            pos = data.find(b'\xff', pos)
+            if pos == -1 or pos + 1 >= len(data):
+                return None
+
+            b = data[pos + 1]
+            if b == 0x00:
+                # 字节填充
+                pos += 2
+            elif b == 0xFF:
+                pos += 1
+            elif cls.MARKER_RST0 <= b <= cls.MARKER_RST0 + 7:
+                segments.append(data[start:pos])
+                pos += 2
+                start = pos
+            elif b == cls.MARKER_EOI:
+                segments.append(data[start:pos])
+                return segments
+            else:
+                return None
+
+    @classmethod
+    def descramble(cls, num: int, data: bytes) -> Optional[bytes]:
+        """
+        把混淆的JPEG无损还原，结果与 JmImageTool.decode_image_pil 在像素上一致。
+        不满足条件时返回None，见类注释
+
+        :param num: 分割数
+        :param data: JPEG文件的字节
+        """
+        jpeg = cls.parse(data)
+        if jpeg is None:
+            return None
+
+        height, mcu_height = jpeg['height'], jpeg['mcu_height']
+        if height % mcu_height != 0:
+            return None
+
+        mcus_per_row = -(-jpeg['width'] // jpeg['mcu_width'])
+        interval = jpeg['interval']
+        move = height // num
+
+        # 每个条带的起止行对应的重启区间下标
+        index_list = []
+        for y in [move * i for i in range(num)] + [height]:
+            mcu_index = y // mcu_height * mcus_per_row
+            if y % mcu_height != 0 or mcu_index % interval != 0:
+                return None
+            index_list.append(mcu_index // interval)
+
+        # 倒序拼接各个条带，重启标记重新从 RST0 开始依次编号
+        segments = jpeg['segments']
+        out = bytearray(jpeg['header'])
+        k = 0
+        for i in range(num - 1, -1, -1):
+            for segment in segments[index_list[i]:index_list[i + 1]]:
+                if k != 0:
+                    out += bytes((0xFF, cls.MARKER_RST0 + (k - 1) % 8))
+                out += segment
+                k += 1
+        out += b'\xff\xd9'
+        return bytes(out)
+
+
 class JmCryptoTool:
     """
     禁漫加解密相关逻辑
@@ -0,0 +1,611 @@
+"""
+离线的禁漫替身服务器（stand-in），用于确定性的负载测试和性能基准测试。
+
+在本地启动一个HTTP服务器，模拟jmcomic客户端会访问的接口：
+
+- 移动端API: /album, /chapter, /chapter_view_template, /search, /setting
+- API域名服务器: /server.txt
+- 网页端: /album/{id}, /photo/{id}
+- 图片CDN: /media/photos/{photo_id}/{img_name}
+
+API响应数据与禁漫一样使用AES加密（见 JmCryptoTool.decode_resp_data），
+图片按 JmImageTool.get_num 的分割数进行切割混淆，客户端需要解密才能还原。
+服务器支持配置延迟和错误注入，并使用固定的随机种子，保证每次运行的结果一致。
+
+用法：
+```python
+with JmStandinServer(latency=0.01, error_rate=0.05) as server:
+    server.add_album(500000, photo_count=2, image_count=5)
+    option = server.new_option(base_dir)
+    option.download_album(500000)
+```
+"""
+import base64
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit, parse_qs
+
+from PIL import Image
+
+from jmcomic import *
+
+
+class StandinAlbum:
+    """
+    替身服务器中的本子数据，章节id从album_id开始连续分配
+    """
+
+    def __init__(self, album_id: int, photo_count: int, image_count: int, name: Optional[str] = None):
+        self.album_id = int(album_id)
+        self.photo_count = photo_count
+        self.image_count = image_count
+        self.name = name or f'standin-album-{album_id}'
+
+    @property
+    def photo_id_list(self) -> List[int]:
+        return [self.album_id + i for i in range(self.photo_count)]
+
+    @property
+    def is_single(self) -> bool:
+        return self.photo_count == 1
+
+    def img_name_list(self, suffix: str) -> List[str]:
+        return [f'{i:05d}{suffix}' for i in range(1, self.image_count + 1)]
+
+
+class StandinHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 默认的listen队列长度只有5，并发建立连接时SYN会被丢弃，导致客户端等待1秒后重连
+    request_queue_size = 128
+
+
+LatencyType = Union[float, Tuple[float, float]]
+
+
+class JmStandinServer:
+    """
+    禁漫替身服务器
+
+    :param latency: API和网页请求的延迟（秒），可以是固定值，也可以是 (min, max) 区间
+    :param image_latency: 图片请求的延迟，为None时使用latency
+    :param error_rate: 错误注入概率，命中时返回 error_status
+    :param error_status: 错误注入时返回的HTTP状态码
+    :param truncate_rate: 图片响应体截断的概率，命中时只发送一半数据就断开连接，模拟接收中断
+    :param range_support: 图片请求是否支持Range请求头（断点续传），为False时忽略Range返回完整数据
+    :param seed: 随机种子，用于延迟和错误注入，保证结果可复现
+    :param image_size: 生成的图片尺寸 (w, h)
+    :param image_format: 图片格式，PIL的format名，例如 WEBP, JPEG, PNG
+    :param scramble_id: 返回给客户端的scramble_id
+    """
+
+    SUFFIX_OF_FORMAT = {
+        'WEBP': '.webp',
+        'JPEG': '.jpg',
+        'PNG': '.png',
+        'GIF': '.gif',
+    }
+
+    def __init__(self,
+                 latency: LatencyType = 0,
+                 image_latency: Optional[LatencyType] = None,
+                 error_rate: float = 0,
+                 error_status: int = 503,
+                 truncate_rate: float = 0,
+                 range_support: bool = True,
+                 seed: int = 0,
+                 image_size: Tuple[int, int] = (200, 300),
+                 image_format: str = 'WEBP',
+                 scramble_id: int = JmMagicConstants.SCRAMBLE_220980,
+                 host: str = '127.0.0.1',
+                 port: int = 0,
+                 ):
+        self.latency = latency
+        self.image_latency = latency if image_latency is None else image_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.truncate_rate = truncate_rate
+        self.range_support = range_support
+        self.image_size = image_size
+        self.image_format = image_format.upper()
+        self.image_suffix = self.SUFFIX_OF_FORMAT.get(self.image_format, f'.{self.image_format.lower()}')
+        self.scramble_id = int(scramble_id)
+        self.host = host
+        self.port = port
+
+        self.albums: Dict[int, StandinAlbum] = {}
+        self.photo_to_album: Dict[int, StandinAlbum] = {}
+        self.image_cache: Dict[str, bytes] = {}
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats: Dict[str, int] = {}
+
+        self.httpd: Optional[ThreadingHTTPServer] = None
+        self.thread: Optional[threading.Thread] = None
+        self.saved_config: Optional[dict] = None
+
+    # 生命周期
+
+    def start(self):
+        if self.httpd is not None:
+            return self
+
+        server = self
+
+        class Handler(JmStandinHandler):
+            standin = server
+
+        self.httpd = StandinHTTPServer((self.host, self.port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is None:
+            return
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.httpd = None
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+        self.stop()
+
+    @property
+    def domain(self) -> str:
+        return f'{self.host}:{self.port}'
+
+    # 数据
+
+    def add_album(self, album_id, photo_count=1, image_count=10, name=None, prerender=True) -> StandinAlbum:
+        """
+        :param prerender: 是否预先生成全部图片，避免图片编码的耗时计入请求延迟
+        """
+        album = StandinAlbum(album_id, photo_count, image_count, name)
+        self.albums[album.album_id] = album
+        for pid in album.photo_id_list:
+            self.photo_to_album[pid] = album
+            if prerender:
+                for img_name in album.img_name_list(self.image_suffix):
+                    self.scrambled_image_bytes(pid, img_name)
+        return album
+
+    def original_image(self, photo_id: int, img_name: str) -> Image.Image:
+        """
+        生成确定性的原图，客户端解密后应与此图一致
+        """
+        w, h = self.image_size
+        seed = int(JmCryptoTool.md5hex(f'{photo_id}{img_name}')[:8], 16)
+        img = Image.new('RGB', (w, h))
+        # 按行填充渐变色，使得切割顺序错误时可以被检测到
+        for y in range(h):
+            color = ((seed + y * 3) % 256, (seed // 7 + y) % 256, (seed // 13 + y * 5) % 256)
+            img.paste(color, (0, y, w, y + 1))
+        return img
+
+    def scrambled_image_bytes(self, photo_id: int, img_name: str) -> bytes:
+        """
+        生成按 JmImageTool.get_num 切割混淆后的图片，即 JmImageTool.decode_and_save 的逆操作
+        """
+        key = f'{photo_id}/{img_name}'
+        data = self.image_cache.get(key, None)
+        if data is not None:
+            return data
+
+        img = self.original_image(photo_id, img_name)
+        num = JmImageTool.get_num(self.scramble_id, photo_id, of_file_name(img_name, True))
+        if num != 0:
+            w, h = img.size
+            scrambled = Image.new('RGB', (w, h))
+            over = h % num
+            for i in range(num):
+                move = math.floor(h / num)
+                y_src = h - (move * (i + 1)) - over
+                y_dst = move * i
+
+                if i == 0:
+                    move += over
+                else:
+                    y_dst += over
+
+                scrambled.paste(img.crop((0, y_dst, w, y_dst + move)), (0, y_src, w, y_src + move))
+            img = scrambled
+
+        buf = BytesIO()
+        save_kwargs = {'lossless': True, 'method': 0} if self.image_format == 'WEBP' else {}
+        img.save(buf, format=self.image_format, **save_kwargs)
+        data = buf.getvalue()
+        self.image_cache[key] = data
+        return data
+
+    # JmModuleConfig
+
+    config_fields = [
+        'PROT',
+        'DOMAIN_API_LIST',
+        'DOMAIN_IMAGE_LIST',
+        'DOMAIN_HTML',
+        'DOMAIN_HTML_LIST',
+        'API_URL_DOMAIN_SERVER_LIST',
+        'FLAG_USE_DISK_CACHE',
+        'FLAG_API_CLIENT_AUTO_UPDATE_DOMAIN_DONE',
+        'APP_COOKIES',
+    ]
+
+    def install(self):
+        """
+        让jmcomic的全局配置指向替身服务器，可用 uninstall 恢复
+        """
+        if self.saved_config is None:
+            self.saved_config = {k: getattr(JmModuleConfig, k) for k in self.config_fields}
+
+        JmModuleConfig.PROT = 'http://'
+        JmModuleConfig.DOMAIN_API_LIST = [self.domain]
+        JmModuleConfig.DOMAIN_IMAGE_LIST = [self.domain]
+        JmModuleConfig.DOMAIN_HTML = self.domain
+        JmModuleConfig.DOMAIN_HTML_LIST = [self.domain]
+        JmModuleConfig.API_URL_DOMAIN_SERVER_LIST = [f'http://{self.domain}/server.txt']
+        JmModuleConfig.FLAG_USE_DISK_CACHE = False
+        JmModuleConfig.FLAG_API_CLIENT_AUTO_UPDATE_DOMAIN_DONE = False
+        JmModuleConfig.APP_COOKIES = None
+        JmModuleConfig.SCRAMBLE_CACHE.clear()
+
+    def uninstall(self):
+        if self.saved_config is None:
+            return
+
+        for k, v in self.saved_config.items():
+            setattr(JmModuleConfig, k, v)
+        JmModuleConfig.SCRAMBLE_CACHE.clear()
+        self.saved_config = None
+
+    def new_option(self, base_dir: str, impl='api', **download) -> JmOption:
+        """
+        构造一个请求替身服务器的option
+
+        :param base_dir: 下载目录
+        :param impl: 客户端实现，api 或 html
+        :param download: 覆盖option的download配置，例如 image={'decode': False}
+        """
+        download_conf = {
+            'cache': False,
+            'image': {'decode': True, 'suffix': None},
+            'threading': {'image': 8, 'photo': 2},
+        }
+        for k, v in download.items():
+            if isinstance(v, dict) and isinstance(download_conf.get(k, None), dict):
+                download_conf[k] = {**download_conf[k], **v}
+            else:
+                download_conf[k] = v
+
+        return JmOption.construct({
+            'dir_rule': {'rule': 'Bd_Aid_Pindex', 'base_dir': base_dir},
+            'download': download_conf,
+            'client': {
+                'impl': impl,
+                'retry_times': 2,
+                'domain': [self.domain],
+                'postman': {'meta_data': {'impersonate': None}},
+            },
+        })
+
+    # 请求处理的辅助方法
+
+    def count(self, kind: str):
+        with self.lock:
+            self.stats[kind] = self.stats.get(kind, 0) + 1
+
+    def decide_latency(self, is_image: bool) -> float:
+        latency = self.image_latency if is_image else self.latency
+        if isinstance(latency, (tuple, list)):
+            lo, hi = latency
+            with self.lock:
+                return self.random.uniform(lo, hi)
+        return float(latency or 0)
+
+    def should_inject_error(self) -> bool:
+        return self.hit(self.error_rate)
+
+    def should_truncate(self) -> bool:
+        return self.hit(self.truncate_rate)
+
+    def hit(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    @classmethod
+    def encrypt_data(cls, data, ts: str, secret: str = JmMagicConstants.APP_DATA_SECRET) -> str:
+        """
+        JmCryptoTool.decode_resp_data 的逆操作
+        """
+        from Crypto.Cipher import AES
+        raw = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+        raw = raw.encode('utf-8')
+        pad = 16 - len(raw) % 16
+        raw += bytes([pad]) * pad
+        key = JmCryptoTool.md5hex(f'{ts}{secret}').encode('utf-8')
+        return base64.b64encode(AES.new(key, AES.MODE_ECB).encrypt(raw)).decode('ascii')
+
+    # 接口数据
+
+    def api_album(self, album: StandinAlbum) -> dict:
+        return {
+            'id': album.album_id,
+            'name': album.name,
+            'author': ['standin'],
+            'images': album.img_name_list(self.image_suffix),
+            'description': '',
+            'total_views': '0',
+            'likes': '0',
+            'series': [] if album.is_single else [
+                {'id': str(pid), 'name': f'第{i}話', 'sort': str(i)}
+                for i, pid in enumerate(album.photo_id_list, start=1)
+            ],
+            'series_id': '0',
+            'comment_total': '0',
+            'tags': ['standin'],
+            'works': [],
+            'actors': [],
+            'related_list': [],
+            'liked': False,
+            'is_favorite': False,
+        }
+
+    def api_chapter(self, album: StandinAlbum, photo_id: int) -> dict:
+        return {
+            'id': photo_id,
+            'series': self.api_album(album)['series'],
+            'tags': 'standin',
+            'name': album.name if album.is_single else f'{album.name}-{photo_id}',
+            'images': album.img_name_list(self.image_suffix),
+            'series_id': '0' if album.is_single else str(album.album_id),
+            'is_favorite': False,
+            'liked': False,
+        }
+
+    def api_search(self, query: str) -> dict:
+        # 直接搜索车号时，与禁漫一样返回 redirect_aid
+        if query.isdigit() and int(query) in self.albums:
+            return {'search_query': query, 'total': 1, 'redirect_aid': query, 'content': []}
+
+        content = [
+            {
+                'id': str(album.album_id),
+                'author': 'standin',
+                'description': '',
+                'name': album.name,
+                'image': '',
+                'category': {'id': '1', 'title': '同人'},
+                'category_sub': {'id': '1', 'title': '同人'},
+            }
+            for album in self.albums.values()
+            if query in album.name
+        ]
+        return {'search_query': query, 'total': str(len(content)), 'content': content}
+
+    def html_album(self, album: StandinAlbum) -> str:
+        episodes = '' if album.is_single else '\n'.join(
+            f'<a href="/photo/{pid}" data-album="{pid}">\n<li>第{i}話 {album.name}-{pid}\n</li></a>'
+            for i, pid in enumerate(album.photo_id_list, start=1)
+        )
+        return f'''<html><head><title>{album.name}|禁漫天堂</title></head><body>
+<span class="number">禁漫車號：JM{album.album_id}</span>
+<script>var scramble_id = {self.scramble_id};</script>
+<h1 id="book-name">{album.name}</h1>
+<h2>叙述：</h2>
+<span class="pagecount">頁數:{album.image_count * album.photo_count}</span>
+<span>上架日期 : 2024-01-01</span>
+<span>更新日期 : 2024-01-01</span>
+<span itemprop="author" data-type="works"></span>
+<span itemprop="author" data-type="actor"></span>
+<span itemprop="genre" data-type="tags"><a href="#">standin</a></span>
+<span itemprop="author" data-type="author"><a href="#">standin</a></span>
+<span id="albim_likes_{album.album_id}">0</span>
+<span>0</span>
+<span>次觀看</span>
+<div class="badge" id="total_video_comments">0</div>
+{episodes}
+</body></html>'''
+
+    def html_photo(self, album: StandinAlbum, photo_id: int) -> str:
+        chapter = self.api_chapter(album, photo_id)
+        img_name_list = chapter['images']
+        sort = 1 if album.is_single else album.photo_id_list.index(photo_id) + 1
+        # data-original 使用https，与禁漫网页一致，客户端只从中提取域名
+        images = '\n'.join(
+            f'<img src="https://{self.domain}/media/albums/blank.jpg" '
+            f'data-original="https://{self.domain}/media/photos/{photo_id}/{name}" '
+            f'id="album_photo_{name}" data-page="{i}">'
+            for i, name in enumerate(img_name_list)
+        )
+        return f'''<html><head><title>{chapter["name"]}|禁漫天堂</title>
+<meta property="og:url" content="https://{self.domain}/photo/{photo_id}/">
+<meta name="keywords" content="standin">
+</head><body>
+<script>
+var scramble_id = {self.scramble_id};
+var series_id = {chapter["series_id"]};
+var sort = {sort};
+var page_arr = {json.dumps(img_name_list)};
+</script>
+{images}
+</body></html>'''
+
+
+class JmStandinHandler(BaseHTTPRequestHandler):
+    standin: JmStandinServer = None
+    protocol_version = 'HTTP/1.1'
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length:
+            self.rfile.read(length)
+        self.handle_request()
+
+    def handle_request(self):
+        server = self.standin
+        split = urlsplit(self.path)
+        path = split.path
+        query = {k: v[0] for k, v in parse_qs(split.query).items()}
+        is_image = path.startswith('/media/')
+
+        server.count('request')
+        latency = server.decide_latency(is_image)
+        if latency > 0:
+            time.sleep(latency)
+
+        if path != '/server.txt' and server.should_inject_error():
+            server.count('error_injected')
+            return self.send(server.error_status, b'standin injected error', 'text/plain')
+
+        try:
+            self.route(path, query)
+        except Exception as e:
+            server.count('error_internal')
+            self.send(500, str(e).encode('utf-8'), 'text/plain')
+
+    def route(self, path: str, query: dict):
+        server = self.standin
+        parts = [p for p in path.split('/') if p]
+
+        if path == '/server.txt':
+            return self.send_text(server.encrypt_data({'Server': [server.domain]}, '',
+                                                      JmMagicConstants.API_DOMAIN_SERVER_SECRET))
+
+        if path == '/setting':
+            return self.send_api({'version': JmMagicConstants.APP_VERSION},
+                                 cookies={'AVS': 'standin'})
+
+        if path == '/search':
+            server.count('api')
+            return self.send_api(server.api_search(query.get('search_query', '')))
+
+        if path == JmApiClient.API_SCRAMBLE:
+            server.count('api')
+            return self.send(200, f'<script>var scramble_id = {server.scramble_id};</script>'.encode(), 'text/html')
+
+        if path in (JmApiClient.API_ALBUM, JmApiClient.API_CHAPTER):
+            server.count('api')
+            jmid = int(query.get('id', 0))
+            album = server.photo_to_album.get(jmid, None)
+            if album is None or (path == JmApiClient.API_ALBUM and jmid not in server.albums):
+                # 与禁漫一样，本子不存在时返回空列表
+                return self.send_json({'code': 200, 'data': []})
+
+            data = server.api_album(album) if path == JmApiClient.API_ALBUM else server.api_chapter(album, jmid)
+            return self.send_api(data)
+
+        if len(parts) >= 2 and parts[0] in ('album', 'photo'):
+            server.count('html')
+            jmid = int(parts[1])
+            album = server.photo_to_album.get(jmid, None)
+            if album is None or (parts[0] == 'album' and jmid not in server.albums):
+                return self.redirect('/error/album_missing')
+
+            html = server.html_album(album) if parts[0] == 'album' else server.html_photo(album, jmid)
+            return self.send(200, html.encode('utf-8'), 'text/html; charset=utf-8')
+
+        if len(parts) == 4 and parts[0] == 'media' and parts[1] == 'photos':
+            server.count('image')
+            photo_id, img_name = int(parts[2]), parts[3]
+            album = server.photo_to_album.get(photo_id, None)
+            if album is None or img_name not in album.img_name_list(server.image_suffix):
+                return self.send(404, b'', 'text/plain')
+            return self.send_image(server.scrambled_image_bytes(photo_id, img_name))
+
+        if path.startswith('/error/'):
+            return self.send(200, b'<html>error</html>', 'text/html')
+
+        self.send(404, b'', 'text/plain')
+
+    # 响应
+
+    def send_api(self, data, cookies: Optional[dict] = None):
+        tokenparam = self.headers.get('tokenparam', '') or ''
+        ts = tokenparam.split(',')[0]
+        self.send_json({'code': 200, 'data': self.standin.encrypt_data(data, ts)}, cookies)
+
+    def send_json(self, obj: dict, cookies: Optional[dict] = None):
+        self.send(200, json.dumps(obj).encode('utf-8'), 'application/json', cookies)
+
+    def send_text(self, text: str):
+        self.send(200, text.encode('utf-8'), 'text/plain')
+
+    def send_image(self, data: bytes):
+        server = self.standin
+        content_type = f'image/{server.image_format.lower()}'
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', None) or '')
+        if match is None or not server.range_support:
+            return self.send(200, data, content_type, truncate=server.should_truncate())
+
+        server.count('image_range')
+        start = int(match[1])
+        if start >= len(data):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(data)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send(206, data[start:], content_type,
+                  headers={'Content-Range': f'bytes {start}-{len(data) - 1}/{len(data)}'},
+                  truncate=server.should_truncate())
+
+    def redirect(self, location: str):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send(self,
+             code: int,
+             body: bytes,
+             content_type: str,
+             cookies: Optional[dict] = None,
+             headers: Optional[dict] = None,
+             truncate=False,
+             ):
+        """
+        :param truncate: 只发送一半响应体就断开连接，Content-Length仍为完整长度
+        """
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (cookies or {}).items():
+            self.send_header('Set-Cookie', f'{k}={v}; Path=/')
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+
+        if truncate and len(body) > 1:
+            self.standin.count('image_truncated')
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
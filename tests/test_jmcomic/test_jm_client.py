@@ -337,3 +337,441 @@ class Test_Client(JmTestConfigurable):
         album_id = 123
         self.client.download_album_cover(album_id, f'{self.option.dir_rule.base_dir}/{album_id}.webp')
         self.client.download_album_cover(album_id, f'{self.option.dir_rule.base_dir}/{album_id}_3x4.webp', '_3x4')
+
+    def test_host_limiter(self):
+        from threading import Lock, Thread
+        from time import sleep
+
+        limiter = JmHostLimiter(concurrency=2, hosts={'b.com': {'concurrency': 1}})
+        lock = Lock()
+        running, peak = {}, {}
+
+        def request(url, **_kwargs):
+            host = JmHostLimiter.parse_host(url)
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peak[host] = max(peak.get(host, 0), running[host])
+            sleep(0.02)
+            with lock:
+                running[host] -= 1
+
+        limited = limiter.limit(request)
+        threads = [Thread(target=limited, args=(f'https://{host}/x',)) for host in ['a.com', 'b.com'] * 6]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(peak, {'a.com': 2, 'b.com': 1})
+
+        # 流式响应在关闭之前一直占用并发许可
+        class StreamResp:
+            closed = 0
+
+            def close(self):
+                self.closed += 1
+
+        limiter = JmHostLimiter(concurrency=1)
+        stream_request = limiter.limit(lambda url, **_kwargs: StreamResp())
+        resp = stream_request('https://c.com/x', stream=True)
+        semaphore = limiter.get_host_limit('c.com')[0]
+        self.assertFalse(semaphore.acquire(blocking=False))
+        resp.close()
+        resp.close()
+        self.assertEqual(resp.closed, 2)
+        self.assertTrue(semaphore.acquire(blocking=False))
+        self.assertFalse(semaphore.acquire(blocking=False))
+        semaphore.release()
+
+        # 没有关闭就被回收时也会释放
+        import gc
+        stream_request('https://c.com/x', stream=True)
+        gc.collect()
+        self.assertTrue(semaphore.acquire(blocking=False))
+        semaphore.release()
+
+        # 同一个option创建的client共用limiter
+        option = JmOption.construct({'client': {'limit': {'rate': 5}}})
+        self.assertIsNotNone(option.decide_client_limiter())
+        self.assertIs(option.decide_client_limiter(), option.decide_client_limiter())
+        self.assertIsNone(JmOption.default().decide_client_limiter())
+
+    def test_retry_policy(self):
+        from time import monotonic
+
+        option = JmOption.construct({'client': {
+            'domain': ['a.com', 'b.com'],
+            'retry_times': 2,
+            'retry': {'backoff': 'exponential', 'base': 0.01, 'cap': 0.02, 'no_retry_status': [404]},
+        }})
+        client = option.new_jm_client(impl=JmHtmlClient)
+        urls = []
+
+        class Resp:
+            def __init__(self, status_code):
+                self.status_code = status_code
+                self.content = b''
+                self.text = ''
+                self.url = ''
+
+        def request(url, status_code=500, **_kwargs):
+            urls.append(url)
+            return Resp(status_code)
+
+        # 迭代重试：每个域名请求 1 + retry_times 次，之后fallback
+        with self.assertRaises(RequestRetryAllFailException):
+            client.request_with_retry(request, '/album/1', is_image=True)
+        self.assertEqual(len(urls), 6)
+        self.assertEqual([u.split('/')[2] for u in urls], ['a.com'] * 3 + ['b.com'] * 3)
+
+        # 404 不重试
+        urls.clear()
+        with self.assertRaises(ResponseUnexpectedException):
+            client.request_with_retry(request, '/album/1', is_image=True, status_code=404)
+        self.assertEqual(len(urls), 1)
+
+        # 调用方指定不重试的状态码（断点续传的416），默认会重试
+        urls.clear()
+        with self.assertRaises(ResponseUnexpectedException):
+            client.request_with_retry(request, '/album/1', is_image=True, status_code=416, no_retry_status=(416,))
+        self.assertEqual(len(urls), 1)
+        e = ResponseUnexpectedException('416', {ExceptionTool.CONTEXT_KEY_RESP: Resp(416)})
+        self.assertTrue(client.retry_policy.should_retry(e))
+        self.assertFalse(client.retry_policy.should_retry(e, (416,)))
+
+        # 退避等待
+        policy = JmRetryPolicy(backoff='decorrelated', base=0.1, cap=1)
+        delay = 0
+        for attempt in range(1, 10):
+            delay = policy.compute_delay(attempt, delay)
+            self.assertTrue(0.1 <= delay <= 1)
+        self.assertEqual(JmRetryPolicy().compute_delay(3, 0), 0)
+
+        # 总耗时上限
+        client.set_retry_policy(JmRetryPolicy(backoff='exponential', base=10, cap=10, deadline=0.001))
+        urls.clear()
+        begin = monotonic()
+        with self.assertRaises(RequestRetryAllFailException):
+            client.request_with_retry(request, '/album/1', is_image=True)
+        self.assertTrue(len(urls) <= 2)
+        self.assertTrue(monotonic() - begin < 1)
+
+    def test_advanced_retry_no_sleep_after_last_attempt(self):
+        from time import monotonic
+
+        option = JmOption.construct({'client': {
+            'domain': ['a.com', 'b.com'],
+            'retry': {'backoff': 'decorrelated', 'base': 0.3, 'cap': 0.3},
+        }})
+        client = option.new_jm_client(impl=JmHtmlClient)
+        plugin = AdvancedRetryPlugin(option)
+        plugin.retry_config = {'retry_domain_max_times': 1, 'retry_rounds': 1}
+        plugin(client)
+
+        urls = []
+
+        def request(url, **_kwargs):
+            urls.append(url)
+            raise ConnectionError(url)
+
+        # 两个域名各请求一次，只在两次尝试之间等待一次
+        begin = monotonic()
+        with self.assertRaises(RequestRetryAllFailException):
+            plugin(client, request, '/album/1', False)
+        self.assertEqual(len(urls), 2)
+        self.assertTrue(0.3 <= monotonic() - begin < 0.6)
+
+    def test_domain_health(self):
+        health = JmDomainHealth(alpha=0.5)
+        # 未请求过的域名保持原顺序
+        self.assertEqual(health.sort(['a.com', 'b.com', 'c.com']), ['a.com', 'b.com', 'c.com'])
+
+        health.record('a.com', 2.0, True)
+        health.record('b.com', 0.5, True)
+        health.record('c.com', 0.1, False)
+        self.assertEqual(health.sort(['a.com', 'b.com', 'c.com']), ['b.com', 'a.com', 'c.com'])
+        # 未请求过的域名排在请求过的健康域名之后，不健康的域名之前
+        self.assertEqual(health.sort(['d.com', 'c.com', 'a.com', 'e.com', 'b.com']),
+                         ['b.com', 'a.com', 'd.com', 'e.com', 'c.com'])
+
+        # 失败率升高后，快的域名也会被后置
+        health.record('b.com', 0.5, False)
+        health.record('b.com', 0.5, False)
+        self.assertEqual(health.sort(['a.com', 'b.com', 'c.com']), ['a.com', 'b.com', 'c.com'])
+
+        # client按健康度选择域名
+        option = JmOption.construct({'client': {'domain': ['slow.com', 'fast.com', 'new.com'], 'retry_times': 0,
+                                                'health': {'enable': True}}})
+        client = option.new_jm_client(impl=JmHtmlClient)
+        self.assertIs(client.domain_health, option.decide_domain_health())
+        client.domain_health.record('slow.com', 3.0, True)
+        client.domain_health.record('fast.com', 0.2, True)
+
+        urls = []
+
+        def request(url, **_kwargs):
+            urls.append(url)
+            return url
+
+        client.request_with_retry(request, '/album/1')
+        self.assertEqual(urls, ['https://fast.com/album/1'])
+        self.assertEqual(client.domain_health.snapshot()['fast.com']['samples'], 2)
+
+        # 切换域名时按最新的健康度重新排序：fast.com失败时，其他请求测得new.com比slow.com更快
+        def failing(url, **_kwargs):
+            urls.append(url)
+            if 'fast.com' in url:
+                client.domain_health.record('new.com', 0.1, True)
+                raise ConnectionError(url)
+            return url
+
+        urls.clear()
+        client.retry_times = 1
+        client.request_with_retry(failing, '/album/1')
+        self.assertEqual(urls, ['https://fast.com/album/1', 'https://fast.com/album/1', 'https://new.com/album/1'])
+
+        # 图片请求换用健康度最好的图片域名，不在图片域名列表中的url不变
+        JmModuleConfig.DOMAIN_IMAGE_LIST, backup = ['cdn-a.com', 'cdn-b.com'], JmModuleConfig.DOMAIN_IMAGE_LIST
+        try:
+            self.assertEqual(client.decide_image_url('https://cdn-a.com/media/photos/1/00001.jpg'),
+                             'https://cdn-a.com/media/photos/1/00001.jpg')
+            client.domain_health.record('cdn-a.com', 3.0, True)
+            client.domain_health.record('cdn-b.com', 0.2, True)
+            self.assertEqual(client.decide_image_url('https://cdn-a.com/media/photos/1/00001.jpg'),
+                             'https://cdn-b.com/media/photos/1/00001.jpg')
+            self.assertEqual(client.decide_image_url('https://other.com/1.jpg'), 'https://other.com/1.jpg')
+        finally:
+            JmModuleConfig.DOMAIN_IMAGE_LIST = backup
+
+        # 默认不启用
+        self.assertIsNone(JmOption.default().decide_domain_health())
+        option = JmOption.construct({'client': {'health': {'enable': False}}})
+        self.assertIsNone(option.decide_domain_health())
+
+    def test_image_hedge(self):
+        from time import sleep
+
+        hedge = JmImageHedge(min_delay=0.05, max_delay=0.1, max_workers=4)
+
+        def request(url):
+            if 'slow' in url:
+                sleep(1)
+            return url
+
+        # 请求及时返回，不发起对冲请求
+        self.assertEqual(hedge.execute(request, 'https://fast.com/1.jpg', 0.1, 'https://alt.com/1.jpg'),
+                         ('https://fast.com/1.jpg', None))
+        # 请求超时未返回，对冲请求先返回
+        self.assertEqual(hedge.execute(request, 'https://slow.com/1.jpg', 0.1, 'https://alt.com/1.jpg'),
+                         ('https://alt.com/1.jpg', True))
+
+        # 主请求超时失败，直接使用对冲请求的结果
+        def broken(url):
+            if 'broken' in url:
+                sleep(0.3)
+                raise TimeoutError(url)
+            return url
+
+        self.assertEqual(hedge.execute(broken, 'https://broken.com/1.jpg', 0.1, 'https://alt.com/1.jpg'),
+                         ('https://alt.com/1.jpg', True))
+
+        # 并发的主请求在各自的调用方线程执行，不经过线程池排队，不会因为排队而发起对冲请求
+        def medium(url):
+            sleep(0.06)
+            return url
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(12) as executor:
+            result = list(executor.map(lambda i: hedge.execute(medium, f'https://a.com/{i}.jpg', 0.1, 'https://b.com'),
+                                       range(12)))
+        self.assertEqual([hedged for _, hedged in result], [None] * 12)
+
+        # 没有历史数据时使用max_delay
+        self.assertEqual(hedge.decide_delay(None), 0.1)
+        metrics = JmDownloadMetrics()
+        for _ in range(20):
+            metrics.observe('image_fetch_seconds', 0.01)
+        self.assertEqual(hedge.decide_delay(metrics), 0.05)
+
+        JmModuleConfig.DOMAIN_IMAGE_LIST, backup = ['cdn-a.com', 'cdn-b.com'], JmModuleConfig.DOMAIN_IMAGE_LIST
+        try:
+            self.assertEqual(hedge.alternate_url('https://cdn-a.com/media/photos/1/00001.jpg'),
+                             'https://cdn-b.com/media/photos/1/00001.jpg')
+        finally:
+            JmModuleConfig.DOMAIN_IMAGE_LIST = backup
+
+        self.assertIsNone(JmOption.default().decide_image_hedge())
+
+    def test_circuit_breaker(self):
+        from time import sleep
+
+        breaker = JmCircuitBreaker(failure_threshold=2, cooldown=0.1)
+        breaker.record('a.com', False)
+        self.assertTrue(breaker.allow('a.com'))
+        breaker.record('a.com', False)
+        self.assertEqual(breaker.state_of('a.com'), JmCircuitBreaker.STATE_OPEN)
+        self.assertFalse(breaker.allow('a.com'))
+
+        # 冷却期结束后只放行一个探测请求
+        sleep(0.1)
+        self.assertTrue(breaker.allow('a.com'))
+        self.assertFalse(breaker.allow('a.com'))
+        breaker.record('a.com', True)
+        self.assertEqual(breaker.state_of('a.com'), JmCircuitBreaker.STATE_CLOSED)
+
+        # 熔断中的域名被所有client直接跳过
+        conf = {'client': {
+            'domain': ['bad.com', 'good.com'],
+            'retry_times': 1,
+            'health': {'enable': False},
+            'circuit_breaker': {'enable': True, 'failure_threshold': 2, 'cooldown': 60},
+        }}
+        client = JmOption.construct(conf).new_jm_client(impl=JmHtmlClient)
+        other = JmOption.construct(conf).new_jm_client(impl=JmHtmlClient)
+        self.assertIs(client.circuit_breaker, other.circuit_breaker)
+
+        urls = []
+
+        def request(url, **_kwargs):
+            urls.append(url)
+            if 'bad.com' in url:
+                raise ConnectionError(url)
+            return url
+
+        client.request_with_retry(request, '/album/1')
+        self.assertEqual(len(urls), 3)
+        urls.clear()
+        other.request_with_retry(request, '/album/1')
+        self.assertEqual(urls, ['https://good.com/album/1'])
+
+    def test_session_pool_postman(self):
+        postman = Postmans.create(data={'type': 'curl_cffi_pool', 'meta_data': {'impersonate': 'chrome', 'pool_size': 2}})
+        self.assertIsInstance(postman, JmSessionPoolPostman)
+        self.assertEqual(postman.pool_size, 2)
+        self.assertNotIn('pool_size', postman.get_meta_data())
+        self.assertEqual(postman.copy().pool_size, 2)
+
+        # 同一个域名最多借出pool_size个session，归还后复用
+        s1, s2 = postman.borrow_session('a.com'), postman.borrow_session('a.com')
+        self.assertIsNot(s1, s2)
+        postman.return_session('a.com', s1)
+        self.assertIs(postman.borrow_session('a.com'), s1)
+
+        from curl_cffi import CurlInfo
+        self.assertIn(CurlInfo.NUM_CONNECTS, s1.curl_infos)
+
+        class Resp:
+            def __init__(self, num_connects):
+                self.infos = {CurlInfo.NUM_CONNECTS: num_connects}
+
+        # 连接是否复用以curl的计数为准，与本地端口无关
+        postman.record_connection('a.com', Resp(1))
+        postman.record_connection('a.com', Resp(0))
+        postman.record_connection('a.com', Resp(2))
+        postman.record_connection('a.com', object())
+        self.assertEqual((postman.opened, postman.reused), (3, 1))
+
+    def test_disk_cache(self):
+        import json
+        import tempfile
+        from time import sleep, time
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filepath = os.path.join(tmp, 'cache.json')
+            cache = JmDiskCache(filepath, ttl=60, max_age=3600)
+            calls = []
+
+            def fetch():
+                calls.append(1)
+                return ['www.a.com', 'www.b.com']
+
+            self.assertEqual(cache.get_or_fetch('api_domain', fetch), ['www.a.com', 'www.b.com'])
+            # 另一个进程（新的JmDiskCache对象）直接使用缓存
+            self.assertEqual(JmDiskCache(filepath, 60, 3600).get_or_fetch('api_domain', fetch), ['www.a.com', 'www.b.com'])
+            self.assertEqual(len(calls), 1)
+
+            # 获取失败不写入缓存
+            self.assertIsNone(cache.get_or_fetch('html_domain', lambda: None))
+            self.assertIsNone(cache.get('html_domain'))
+
+            # 超过ttl的缓存依然返回，同时后台更新
+            cache.put('html_domain', 'jm.com')
+            data = cache.load()
+            data['api_domain']['time'] = time() - 120
+            with open(filepath, 'w') as f:
+                f.write(json.dumps(data))
+
+            self.assertEqual(cache.get_or_fetch('api_domain', lambda: ['www.c.com']), ['www.a.com', 'www.b.com'])
+            for _ in range(50):
+                if cache.get('api_domain')[0] == ['www.c.com']:
+                    break
+                sleep(0.02)
+            self.assertEqual(cache.get('api_domain')[0], ['www.c.com'])
+            self.assertEqual(cache.get('html_domain')[0], 'jm.com')
+
+            # 超过max_age的缓存不再使用
+            self.assertIsNone(JmDiskCache(filepath, 0, -1).get('api_domain'))
+
+            # 多个进程同时写入，不会丢失彼此的条目
+            from multiprocessing import Process
+            process_list = [Process(target=put_disk_cache, args=(filepath, f'key{i}')) for i in range(4)]
+            for p in process_list:
+                p.start()
+            for p in process_list:
+                p.join()
+            self.assertTrue(all(cache.get(f'key{i}') is not None for i in range(4)))
+
+    def test_disk_cache_option(self):
+        flag, filepath = JmModuleConfig.FLAG_USE_DISK_CACHE, JmModuleConfig.VAR_DISK_CACHE_FILEPATH
+        try:
+            JmModuleConfig.FLAG_USE_DISK_CACHE = False
+            self.assertIsNone(JmModuleConfig.disk_cache())
+            JmOption.construct({})
+            self.assertIsNone(JmModuleConfig.disk_cache())
+
+            JmOption.construct({'client': {'disk_cache': {'enable': True, 'path': '/tmp/jm-cache.json'}}})
+            self.assertEqual(JmModuleConfig.disk_cache().filepath, '/tmp/jm-cache.json')
+        finally:
+            JmModuleConfig.FLAG_USE_DISK_CACHE, JmModuleConfig.VAR_DISK_CACHE_FILEPATH = flag, filepath
+
+    def test_stream_image_resp(self):
+        import tempfile
+
+        class StreamResp:
+            status_code = 200
+            url = 'https://cdn.example/media/photos/500000/00001.gif'
+            stream_task = object()
+            headers = {}
+
+            def __init__(self, chunks):
+                self.chunks = chunks
+
+            def iter_content(self):
+                yield from self.chunks
+
+            def close(self):
+                pass
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '00001.gif')
+            resp = JmImageResp(StreamResp([b'GIF89a', b'0' * 10]))
+            self.assertTrue(resp.is_stream)
+            resp.require_success()
+            resp.transfer_to(path, None, False)
+
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'GIF89a' + b'0' * 10)
+            self.assertEqual(resp.received_bytes, 16)
+            self.assertEqual(os.listdir(tmp), ['00001.gif'])
+
+            # 响应数据为空
+            with self.assertRaises(ResponseUnexpectedException):
+                JmImageResp(StreamResp([])).transfer_to(os.path.join(tmp, '00002.gif'), None, False)
+            self.assertEqual(os.listdir(tmp), ['00001.gif'])
+
+
+def put_disk_cache(filepath, key):
+    cache = JmDiskCache(filepath, 60, 3600)
+    for i in range(20):
+        cache.put(f'{key}-{i}', i)
+    cache.put(key, True)
@@ -403,6 +403,511 @@ class Test_JmDownloader(JmTestConfigurable):
             
             # Should complete without error
 
+    def test_image_scheduler_limit(self):
+        """Test JmImageScheduler never runs more tasks than max_workers"""
+        from threading import Lock
+        from time import sleep
+
+        scheduler = JmImageScheduler(3)
+        lock = Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def task(_):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            sleep(0.01)
+            with lock:
+                state['running'] -= 1
+
+        futures = scheduler.run_all(range(20), task)
+
+        self.assertEqual(len(futures), 20)
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertLessEqual(state['peak'], 3)
+        self.assertLessEqual(len(scheduler.workers), 3)
+
+    def test_image_scheduler_queue_gauge(self):
+        """Test the image scheduler queue depth is exported as a metrics gauge"""
+        option = self.new_option()
+        downloader = JmDownloader(option)
+        downloader.image_scheduler = JmImageScheduler(1)
+        downloader.register_scheduler_gauge()
+
+        # 不启动工作线程，任务都留在队列中
+        for i in range(3):
+            downloader.image_scheduler.queue.put(i)
+        self.assertEqual(downloader.metrics.snapshot()['gauges']['image_scheduler_queue'], 3)
+
+    def test_async_downloader_concurrency(self):
+        """Test AsyncJmDownloader bounds concurrent coroutines by count_batch"""
+        import asyncio
+
+        downloader = AsyncJmDownloader(self.option)
+        state = {'running': 0, 'peak': 0, 'done': 0}
+
+        async def apply(_):
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+            await asyncio.sleep(0.01)
+            state['running'] -= 1
+            state['done'] += 1
+
+        photo = JmPhotoDetail('500000', 'name', '0', 1, scramble_id='220980',
+                              page_arr=[f'{i:05}.jpg' for i in range(1, 21)], data_original_domain='cdn.example')
+        asyncio.run(downloader.execute_on_condition_async(photo, apply, 3))
+
+        self.assertEqual(state['done'], len(photo))
+        self.assertLessEqual(state['peak'], 3)
+
+    def test_async_downloader_adaptive_window(self):
+        """Test AsyncJmDownloader bounds in-flight image requests by the adaptive window"""
+        import asyncio
+
+        option = self.new_option()
+        option.download.threading['image'] = 2
+        # 耗时都超过latency，窗口不会增长
+        option.download.threading['adaptive'] = {'max': 8, 'latency': 0}
+        downloader = AsyncJmDownloader(option)
+        photo = JmPhotoDetail('500000', 'name', '0', 1, page_arr=['00001.jpg'])
+        self.assertEqual(downloader.decide_image_batch_count(photo), 8)
+
+        state = {'running': 0, 'peak': 0}
+
+        async def request():
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+            await asyncio.sleep(0.01)
+            state['running'] -= 1
+
+        async def main():
+            await asyncio.gather(*[downloader.execute_image_request_async(request) for _ in range(10)])
+
+        asyncio.run(main())
+        self.assertEqual(state['peak'], 2)
+        self.assertEqual(downloader.adaptive.snapshot()['inflight'], 0)
+
+    def test_decode_pool_same_as_inline(self):
+        """Test images decoded in JmImageDecodePool equal images decoded inline"""
+        import os
+        import tempfile
+        from io import BytesIO
+        from PIL import Image
+
+        buf = BytesIO()
+        Image.new('RGB', (100, 300), (10, 20, 30)).save(buf, 'JPEG')
+        content = buf.getvalue()
+
+        pool = JmImageDecodePool(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            inline_path = os.path.join(tmp, 'inline.png')
+            pool_path = os.path.join(tmp, 'pool.png')
+            JmImageTool.decode_and_save(8, JmImageTool.open_image(content), inline_path)
+            pool.submit(content, pool_path, 8, True).result()
+
+            with open(inline_path, 'rb') as f1, open(pool_path, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+        pool.shutdown()
+
+    def test_decode_callbacks_on_photo_thread(self):
+        """Test after_image of pipelined images runs on the thread that joins the photo"""
+        import threading
+        from concurrent.futures import Future
+
+        downloader = JmDownloader(self.option)
+        downloader.decode_pool = JmImageDecodePool(1)
+        photo = JmPhotoDetail('500000', 'name', '0', 1, scramble_id='220980',
+                              page_arr=['00001.jpg', '00002.jpg'], data_original_domain='cdn.example')
+
+        called = []
+        downloader.after_image = lambda image, path: called.append((path, threading.current_thread().name))
+
+        futures = [Future(), Future()]
+        for image, future in zip(photo, futures):
+            downloader.decode_futures.setdefault(photo, []).append((image, image.filename, future))
+
+        # 模拟进程池在其他线程完成任务
+        threading.Thread(target=lambda: [f.set_result(None) for f in futures]).start()
+        downloader.wait_decode_finish(photo)
+        downloader.decode_pool.shutdown()
+
+        self.assertEqual(called, [('00001.jpg', threading.current_thread().name),
+                                  ('00002.jpg', threading.current_thread().name)])
+        self.assertNotIn(photo, downloader.decode_futures)
+
+    def test_decode_strip_list(self):
+        """Test the cached strip list covers every row of the scrambled and the decoded image exactly once"""
+        for h in (1700, 301, 37):
+            for num in (2, 6, 10, 16, 20):
+                strip_list = JmImageTool.get_strip_list(num, h)
+                self.assertEqual(len(strip_list), num)
+                src_rows = sorted(y for y_src, _, move in strip_list for y in range(y_src, y_src + move))
+                dst_rows = [y for _, y_dst, move in strip_list for y in range(y_dst, y_dst + move)]
+                self.assertEqual(src_rows, list(range(h)), f'h={h}, num={num}')
+                self.assertEqual(dst_rows, list(range(h)), f'h={h}, num={num}')
+                self.assertIs(JmImageTool.get_strip_list(num, h), strip_list)
+
+    def test_decode_backend_numpy_same_as_pil(self):
+        """Test the numpy decode backend produces the same pixels as the PIL backend"""
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+
+        from PIL import Image
+        img = Image.effect_noise((37, 301), 64).convert('RGB')
+        for mode in ('RGB', 'RGBA', 'L', 'P'):
+            src = img.convert(mode)
+            for num in (2, 6, 10, 16, 20):
+                self.assertEqual(
+                    JmImageTool.decode_image_numpy(num, src).tobytes(),
+                    JmImageTool.decode_image_pil(num, src).tobytes(),
+                    f'mode={mode}, num={num}',
+                )
+
+    def test_jpeg_lossless_descramble(self):
+        """Test JmJpegTool reorders restart intervals to the same pixels as the PIL backend"""
+        from io import BytesIO
+        from PIL import Image
+
+        def jpeg(size, **kwargs):
+            buf = BytesIO()
+            Image.effect_noise(size, 64).convert('RGB').save(buf, 'JPEG', quality=90, subsampling=0, **kwargs)
+            return buf.getvalue()
+
+        for size, num in [((200, 320), 10), ((203, 480), 6), ((64, 256), 16)]:
+            data = jpeg(size, restart_marker_rows=1)
+            decoded = JmJpegTool.descramble(num, data)
+            self.assertIsNotNone(decoded, f'size={size}, num={num}')
+            self.assertEqual(
+                JmImageTool.open_image(decoded).convert('RGB').tobytes(),
+                JmImageTool.decode_image_pil(num, JmImageTool.open_image(data)).tobytes(),
+                f'size={size}, num={num}',
+            )
+
+        # 没有重启标记、条带不在MCU行上，不能无损重排
+        self.assertIsNone(JmJpegTool.descramble(10, jpeg((200, 320))))
+        self.assertIsNone(JmJpegTool.descramble(10, jpeg((200, 330), restart_marker_rows=1)))
+        self.assertIsNone(JmJpegTool.descramble(10, b'RIFF'))
+
+    def test_descramble_plan(self):
+        """Test JmImageTool.get_descramble_plan computes the same scramble num as JmImageTool.get_num for every image"""
+        page_arr = [f'{i:05}.webp' for i in range(1, 31)]
+        for photo_id in (200000, 250000, 300000, 500000):
+            photo = JmPhotoDetail(photo_id, 'name', 0, 1, scramble_id=220980, page_arr=page_arr,
+                                  data_original_domain='cdn.example.com')
+            # 构建章节时不计算，由下载器在 before_photo 中计算
+            self.assertIsNone(photo.descramble_plan)
+            self.assertEqual(len(JmImageTool.get_descramble_plan(photo)), len(page_arr))
+            for image in photo:
+                self.assertEqual(image.scramble_num, JmImageTool.get_num_by_url(220980, image.img_url), image.img_url)
+                self.assertEqual(JmImageTool.get_num_by_detail(image), image.scramble_num)
+
+        # scramble_id、page_arr 重新赋值后重新计算
+        photo.scramble_id = '600000'
+        self.assertEqual(set(JmImageTool.get_descramble_plan(photo)), {0})
+        photo.page_arr = page_arr[:2]
+        self.assertEqual(len(JmImageTool.get_descramble_plan(photo)), 2)
+        self.assertIsNone(JmImageTool.get_descramble_plan(JmPhotoDetail(500000, 'name', 0, 1)))
+
+    def test_image_encode_profile(self):
+        """Test download.image.profile resolves to per-format Image.save parameters"""
+        import tempfile
+        from PIL import Image
+
+        registry = JmModuleConfig.REGISTRY_IMAGE_ENCODE_PROFILE
+        self.assertIsNone(JmOption.default().decide_image_encode_profile())
+        fast = JmOption.construct({'download': {'image': {'profile': 'fast'}}}).decide_image_encode_profile()
+        self.assertEqual(fast, registry['fast'])
+        with self.assertRaises(JmcomicException):
+            JmOption.construct({'download': {'image': {'profile': 'unknown'}}}).decide_image_encode_profile()
+
+        self.assertEqual(JmImageTool.decide_encode_params('a/00001.webp', fast), fast['WEBP'])
+        self.assertEqual(JmImageTool.decide_encode_params('a/00001.gif', fast), {})
+        self.assertEqual(JmImageTool.decide_encode_params('a/00001.png', None), {})
+
+        img = Image.effect_mandelbrot((120, 160), (-2, -1.5, 1, 1.5), 100).convert('RGB')
+        with tempfile.TemporaryDirectory() as tmp:
+            size = {}
+            for name in ('fast', 'archival'):
+                path = os.path.join(tmp, f'{name}.png')
+                JmImageTool.decode_and_save(4, img, path, profile=registry[name])
+                size[name] = os.path.getsize(path)
+                self.assertEqual(Image.open(path).tobytes(), JmImageTool.decode_image_pil(4, img).tobytes())
+            self.assertLessEqual(size['archival'], size['fast'])
+
+    def test_adaptive_concurrency_window(self):
+        """Test JmAdaptiveConcurrency grows on success and halves on congestion"""
+        adaptive = JmAdaptiveConcurrency(4, min_window=1, max_window=8, latency=10)
+
+        for _ in range(100):
+            adaptive.execute(lambda: None)
+        self.assertEqual(adaptive.snapshot()['window'], 8)
+
+        def fail():
+            ExceptionTool.raises('请求重试全部失败', {}, RequestRetryAllFailException)
+
+        with self.assertRaises(RequestRetryAllFailException):
+            adaptive.execute(fail)
+        self.assertEqual(adaptive.snapshot()['window'], 4)
+        self.assertEqual(adaptive.snapshot()['inflight'], 0)
+
+    def test_adaptive_image_batch_count(self):
+        """Test photo thread pools follow the current adaptive window instead of its maximum"""
+        option = self.new_option()
+        option.download.threading['image'] = 4
+        option.download.threading['adaptive'] = {'max': 60}
+        downloader = JmDownloader(option)
+        photo = JmPhotoDetail('500000', 'name', '0', 1, page_arr=['00001.jpg'])
+
+        self.assertEqual(option.decide_image_batch_count(photo), 4)
+        self.assertEqual(downloader.decide_image_batch_count(photo), 4)
+        for _ in range(100):
+            downloader.adaptive.execute(lambda: None)
+        self.assertEqual(downloader.decide_image_batch_count(photo), downloader.adaptive.snapshot()['window'])
+        self.assertLess(downloader.decide_image_batch_count(photo), 60)
+
+    def test_download_journal_restore_photo(self):
+        """Test JmDownloadJournal restores photo metadata and finished state"""
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = JmDownloadJournal(os.path.join(tmp, 'journal.db'))
+
+            photo = JmPhotoDetail('500000', 'name', '0', 1, scramble_id='220980',
+                                  page_arr=['00001.jpg', '00002.jpg'], data_original_domain='cdn.example')
+            journal.record_photo(photo)
+
+            restored = JmPhotoDetail('500000', 'name', '0', 1)
+            self.assertFalse(journal.restore_photo(restored))
+            self.assertEqual(restored.page_arr, photo.page_arr)
+            self.assertEqual(restored.scramble_id, photo.scramble_id)
+            self.assertEqual(restored.data_original_domain, photo.data_original_domain)
+
+            journal.finish_photo(photo)
+            self.assertTrue(journal.restore_photo(JmPhotoDetail('500000', 'name', '0', 1)))
+            self.assertFalse(journal.restore_photo(JmPhotoDetail('500001', 'name', '0', 1)))
+            journal.close()
+
+    def test_download_journal_replay_skipped_photo(self):
+        """Test photos skipped by the journal still fire photo callbacks with the recorded images"""
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filepath = os.path.join(tmp, 'journal.db')
+            option = self.new_option()
+            option.download['journal'] = filepath
+            option.download.threading['prefetch'] = 2
+            downloader = JmDownloader(option)
+            journal = downloader.journal
+
+            album = JmAlbumDetail('500000', '0', 'name', [('500000', '1', 'name')], 2, '', '', 0, 0, 0, [], [], [], [])
+            photo = JmPhotoDetail('500000', 'name', '0', 1, scramble_id='220980',
+                                  page_arr=['00001.jpg', '00002.jpg'], data_original_domain='cdn.example')
+            journal.record_photo(photo)
+            for image in photo:
+                journal.finish_image(image, os.path.join(tmp, image.filename))
+            journal.finish_photo(photo)
+
+            called = []
+            downloader.before_photo = lambda p, f=downloader.before_photo: (called.append('before'), f(p))
+            downloader.after_photo = lambda p, f=downloader.after_photo: (called.append('after'), f(p))
+
+            restored = album[0]
+            downloader.download_by_photo_detail(restored)
+
+            self.assertEqual(called, ['before', 'after'])
+            self.assertEqual(
+                [path for path, _ in downloader.download_success_dict[album][restored]],
+                [os.path.join(tmp, '00001.jpg'), os.path.join(tmp, '00002.jpg')],
+            )
+            self.assertFalse(downloader.has_download_failures)
+
+            # 已完成的本子不启动章节预取
+            self.assertIsNotNone(downloader.start_photo_prefetch(album, album))
+            downloader.stop_photo_prefetch(album)
+            journal.finish_album(album)
+            self.assertIsNone(downloader.start_photo_prefetch(album, album))
+            JmDownloadJournal.REGISTRY.pop(os.path.abspath(filepath)).close()
+
+    def test_image_save_dir_per_photo(self):
+        """Test JmDownloader.decide_image_save_dir resolves dir_rule once per photo and saving recreates deleted dirs"""
+        import os
+        import shutil
+        import tempfile
+
+        album = JmAlbumDetail('500000', '0', 'album', [('500000', '1', 'p1'), ('500001', '2', 'p2')],
+                              2, '', '', 0, 0, 0, [], [], [], [])
+        photo, other = album[0], album[1]
+        photo.page_arr = ['00001.jpg']
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for rule, expected in [
+                ('Bd_Pid', os.path.join(tmp, '500000')),
+                ('Bd_Aid_Pindex', os.path.join(tmp, '500000', '1')),
+                ('Bd_Aname_Ptitle', os.path.join(tmp, 'album', 'p1')),
+            ]:
+                option = self.new_option()
+                option.dir_rule = DirRule(rule, tmp)
+                downloader = JmDownloader(option)
+
+                resolved = []
+                origin = option.decide_image_save_dir
+                option.decide_image_save_dir = lambda p, f=origin: resolved.append(p) or f(p)
+
+                # 未命中时解析路径规则并创建文件夹
+                save_dir = downloader.decide_image_save_dir(photo)
+                self.assertEqual(os.path.normpath(save_dir), expected)
+                self.assertTrue(os.path.isdir(save_dir))
+
+                # 命中时不再解析，文件夹被删除时由保存图片时重新创建
+                shutil.rmtree(save_dir)
+                self.assertEqual(downloader.decide_image_save_dir(photo), save_dir)
+                self.assertEqual(resolved, [photo])
+                JmImageTool.save_content(b'data', os.path.join(save_dir, '00001.jpg'), None, False)
+                self.assertTrue(os.path.isfile(os.path.join(save_dir, '00001.jpg')))
+
+                # 其他章节各自解析
+                self.assertNotEqual(downloader.decide_image_save_dir(other), save_dir)
+                self.assertEqual(resolved, [photo, other])
+
+                # 章节下载完成后清除
+                downloader.before_photo(photo)
+                downloader.after_photo(photo)
+                self.assertNotIn(photo, downloader.image_save_dirs)
+                self.assertIn(other, downloader.image_save_dirs)
+
+                # 下载失败的章节也会清除
+                downloader.wait_prepare_photo = lambda _: False
+                downloader.before_photo = lambda _: ExceptionTool.raises('before_photo failed')
+                with self.assertRaises(JmcomicException):
+                    downloader.download_by_photo_detail(other)
+                self.assertNotIn(other, downloader.image_save_dirs)
+
+    def test_image_exists_by_dir_index(self):
+        """Test JmDownloader.image_exists scans a directory once and honors cache_check_size"""
+        import os
+        import tempfile
+
+        downloader = JmDownloader(self.option)
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, '00001.jpg'), 'wb') as f:
+                f.write(b'1')
+            open(os.path.join(tmp, '00002.jpg'), 'wb').close()
+
+            self.assertTrue(downloader.image_exists(os.path.join(tmp, '00001.jpg')))
+            self.assertTrue(downloader.image_exists(os.path.join(tmp, '00002.jpg')))
+            self.assertFalse(downloader.image_exists(os.path.join(tmp, '00003.jpg')))
+
+            # 目录只扫描一次，之后的新文件通过 update_dir_index 加入
+            open(os.path.join(tmp, '00003.jpg'), 'wb').close()
+            self.assertFalse(downloader.image_exists(os.path.join(tmp, '00003.jpg')))
+            downloader.update_dir_index(os.path.join(tmp, '00003.jpg'))
+            self.assertTrue(downloader.image_exists(os.path.join(tmp, '00003.jpg')))
+
+            self.assertEqual(downloader.scan_dir(tmp, True), {'00001.jpg'})
+
+    def test_image_exists_normcase(self):
+        """Test the dir index matches paths that differ only in case where the OS ignores case"""
+        import os
+        import tempfile
+        from unittest import mock
+
+        downloader = JmDownloader(self.option)
+        with tempfile.TemporaryDirectory() as tmp:
+            open(os.path.join(tmp, '00001.JPG'), 'wb').close()
+
+            # 模拟Windows的 os.path.normcase
+            with mock.patch('os.path.normcase', lambda path: path.lower()):
+                self.assertTrue(downloader.image_exists(os.path.join(tmp, '00001.jpg')))
+                downloader.update_dir_index(os.path.join(tmp, '00002.JPG'))
+                self.assertTrue(downloader.image_exists(os.path.join(tmp, '00002.jpg')))
+                downloader.release_dir_index(tmp.upper())
+                self.assertEqual(downloader.dir_index, {})
+
+            # 区分大小写的系统上，大小写不同就是不同的文件
+            if os.path.normcase('A') == 'A':
+                self.assertFalse(downloader.image_exists(os.path.join(tmp, '00001.jpg')))
+
+    def test_photo_prefetcher_window(self):
+        """Test JmPhotoPrefetcher prepares photos in order within the lookahead window"""
+        photos = [JmPhotoDetail(str(500000 + i), 'name', '0', i + 1) for i in range(10)]
+        prepared = []
+
+        prefetcher = JmPhotoPrefetcher(photos, lambda photo: prepared.append(photo.photo_id), 2)
+        prefetcher.get(photos[0])
+        self.assertLessEqual(len(prefetcher.futures), 3)
+
+        prefetcher.get(photos[5])
+        self.assertEqual(len(prefetcher.futures), 8)
+        prefetcher.shutdown()
+
+        self.assertIn(photos[5].photo_id, prepared)
+        self.assertNotIn(photos[9].photo_id, prepared)
+
+        # shutdown时取消还没开始的预取任务
+        import time
+        prefetcher = JmPhotoPrefetcher(photos, lambda photo: time.sleep(0.2), 1)
+        prefetcher.fill(5)
+        prefetcher.shutdown()
+        self.assertTrue(all(f.cancelled() for f in prefetcher.futures[1:]))
+
+    def test_download_metrics(self):
+        """Test JmDownloadMetrics snapshot and Prometheus text output"""
+        metrics = JmDownloadMetrics()
+        metrics.inc('image_success_total')
+        metrics.inc('bytes_received_total', 1024)
+        metrics.inc('request_retries_total', domain='cdn.example')
+        metrics.observe('image_fetch_seconds', 0.3)
+        with metrics.time('image_fetch_seconds', 'image_fetch_inflight'):
+            self.assertEqual(metrics.snapshot()['gauges']['image_fetch_inflight'], 1)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['image_success_total'], 1)
+        self.assertEqual(snapshot['counters']['request_retries_total'], {'domain=cdn.example': 1})
+        self.assertEqual(snapshot['gauges']['image_fetch_inflight'], 0)
+        self.assertEqual(snapshot['histograms']['image_fetch_seconds']['count'], 2)
+        self.assertEqual(metrics.percentile('image_fetch_seconds', 1), 0.5)
+
+        # 分位数在桶内线性插值，而不是直接取桶的上界
+        latency = JmDownloadMetrics()
+        for value in (0.3, 0.3, 0.4, 0.45):
+            latency.observe('image_fetch_seconds', value)
+        self.assertAlmostEqual(latency.percentile('image_fetch_seconds', 0.5), 0.375)
+        self.assertAlmostEqual(latency.percentile('image_fetch_seconds', 0.95), 0.4875)
+        latency.observe('image_fetch_seconds', 100)
+        self.assertEqual(latency.percentile('image_fetch_seconds', 1), float('inf'))
+
+        text = metrics.to_prometheus_text()
+        self.assertIn('jmcomic_bytes_received_total 1024', text)
+        self.assertIn('jmcomic_request_retries_total{domain="cdn.example"} 1', text)
+        self.assertIn('jmcomic_image_fetch_seconds_count 2', text)
+
+    def test_adaptive_window_gauge_per_downloader(self):
+        """Test each downloader registers its own adaptive_window gauge and drops it on exit or collection"""
+        import gc
+
+        option = self.new_option()
+        option.download.threading['adaptive'] = True
+        metrics = option.decide_download_metrics()
+
+        first = JmDownloader(option)
+        second = JmDownloader(option)
+        self.assertEqual(len(metrics.snapshot()['gauges']['adaptive_window']), 2)
+
+        with first:
+            pass
+        self.assertEqual(len(metrics.collect_gauge_functions()['adaptive_window']), 1)
+        self.assertIn(f'jmcomic_adaptive_window{{downloader="{id(second):x}"}}', metrics.to_prometheus_text())
+
+        del second
+        gc.collect()
+        self.assertNotIn('adaptive_window', metrics.snapshot()['gauges'])
+
+
 
 class Test_DoNotDownloadImage(JmTestConfigurable):
 
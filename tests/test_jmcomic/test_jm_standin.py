@@ -0,0 +1,184 @@
+from test_jmcomic import *
+
+from jm_standin import JmStandinServer
+
+
+class Test_Standin(JmTestConfigurable):
+    """
+    使用离线的替身服务器测试完整的下载流程，不依赖禁漫网站
+    """
+    server: JmStandinServer = None
+
+    @classmethod
+    def setUpClass(cls):
+        # 其他测试可能通过 Downloader.use() 替换了全局的downloader，这里要用默认的下载流程
+        cls.downloader_class = JmModuleConfig.CLASS_DOWNLOADER
+        JmModuleConfig.CLASS_DOWNLOADER = None
+        cls.base_dir = os.path.abspath('./.standin_download')
+        cls.server = JmStandinServer(seed=1).start()
+        cls.server.install()
+        cls.server.add_album(500000, photo_count=2, image_count=3)
+        cls.server.add_album(500010, photo_count=1, image_count=4)
+        cls.option = cls.server.new_option(cls.base_dir, image={'suffix': '.png'})
+        cls.client = cls.option.build_jm_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        JmModuleConfig.CLASS_DOWNLOADER = cls.downloader_class
+        cls.server.uninstall()
+        cls.server.stop()
+        import shutil
+        shutil.rmtree(cls.base_dir, ignore_errors=True)
+
+    def assert_downloaded(self, album_id, option=None):
+        from PIL import Image
+        option = option or self.option
+        album = self.client.get_album_detail(album_id)
+        for photo in album:
+            photo = self.client.get_photo_detail(photo.photo_id)
+            for image in photo:
+                path = option.decide_image_filepath(image)
+                self.assertTrue(file_exists(path), path)
+                expected = self.server.original_image(int(photo.photo_id), image.img_file_name + image.img_file_suffix)
+                self.assertEqual(Image.open(path).convert('RGB').tobytes(), expected.tobytes())
+
+    def test_standin_download(self):
+        self.option.download_album(500000)
+        self.option.download_photo(500010)
+        self.assert_downloaded(500000)
+        self.assert_downloaded(500010)
+
+    def test_standin_html_client(self):
+        client = self.option.new_jm_client(impl='html')
+        album = client.get_album_detail(500000)
+        self.assertEqual(len(album), 2)
+        photo = client.get_photo_detail(album[1].photo_id, False)
+        self.assertEqual(photo.album_id, '500000')
+        self.assertEqual(len(photo), 3)
+
+        page = self.client.search_site('standin-album-50001')
+        self.assertEqual([aid for aid, _ in page], ['500010'])
+        self.assertEqual(self.client.search_site('500000').single_album.album_id, '500000')
+        with self.assertRaises(MissingAlbumPhotoException):
+            self.client.get_album_detail(400000)
+
+    def test_standin_image_resume(self):
+        from PIL import Image
+        server = self.server
+        mkdir_if_not_exists(self.base_dir)
+        img_name = '00001' + server.image_suffix
+        url = f'http://{server.domain}/media/photos/500010/{img_name}'
+        path = os.path.join(self.base_dir, 'resume.png')
+        data = server.scrambled_image_bytes(500010, img_name)
+        expected = server.original_image(500010, img_name).tobytes()
+
+        def download(part: bytes):
+            with open(f'{path}.part', 'wb') as f:
+                f.write(part)
+            server.stats.clear()
+            self.client.download_image(url, path, server.scramble_id, stream=True)
+            self.assertEqual(Image.open(path).convert('RGB').tobytes(), expected)
+            self.assertFalse(file_exists(f'{path}.part'))
+            os.remove(path)
+
+        # 从临时文件的末尾续传
+        download(data[:100])
+        self.assertEqual(server.stats.get('image_range', 0), 1)
+
+        # 临时文件已失效(416)，重新下载完整图片
+        download(data + b'stale')
+        self.assertEqual(server.stats.get('image', 0), 2)
+
+        # 服务器不支持Range，返回完整数据
+        server.range_support = False
+        try:
+            download(data[:100])
+            self.assertEqual(server.stats.get('image_range', 0), 0)
+        finally:
+            server.range_support = True
+
+        # 接收中断后在同一次下载中续传
+        server.truncate_rate = 1
+        try:
+            with open(f'{path}.part', 'wb') as f:
+                f.write(data[:len(data) - 4])
+            server.stats.clear()
+            self.client.download_image(url, path, server.scramble_id, stream=True)
+            self.assertGreater(server.stats.get('image_truncated', 0), 0)
+            self.assertEqual(Image.open(path).convert('RGB').tobytes(), expected)
+        finally:
+            server.truncate_rate = 0
+
+    def test_standin_error_injection(self):
+        server = JmStandinServer(error_rate=0.3, seed=7).start()
+        try:
+            server.install()
+            server.add_album(500020, photo_count=1, image_count=5)
+            option = server.new_option(self.base_dir)
+            option.client.retry_times = 5
+            option.download_album(500020)
+            self.assertGreater(server.stats.get('error_injected', 0), 0)
+        finally:
+            server.uninstall()
+            server.stop()
+            self.server.install()
+
+    def test_standin_deferred_decode(self):
+        from jmcomic.cl import JmDescrambleUI
+        base_dir = os.path.join(self.base_dir, 'deferred')
+        option = self.server.new_option(base_dir, cache=True,
+                                        image={'suffix': '.png', 'defer_decode': {'enable': True, 'workers': 0}})
+
+        # 下载时只保存原始图片和附属文件
+        option.download_album(500000)
+        filepath_list = JmImageTool.find_deferred(base_dir)
+        self.assertEqual(len(filepath_list), 6)
+        self.assertFalse(any(file_exists(f) for f in filepath_list))
+
+        # 重复下载不会重新请求图片
+        self.server.stats.clear()
+        option.download_album(500000)
+        self.assertEqual(self.server.stats.get('image', 0), 0)
+
+        # 还原时写入失败，不会留下不完整的最终图片
+        decode_raw_and_save = JmImageTool.decode_raw_and_save
+
+        def broken_decode(num, raw, path, *args):
+            with open(path, 'wb') as f:
+                f.write(b'partial')
+            raise OSError('disk full')
+
+        JmImageTool.decode_raw_and_save = broken_decode
+        try:
+            with self.assertRaises(OSError):
+                JmImageTool.decode_deferred(filepath_list[0])
+        finally:
+            JmImageTool.decode_raw_and_save = decode_raw_and_save
+        self.assertFalse(file_exists(filepath_list[0]))
+        self.assertIn(filepath_list[0], JmImageTool.find_deferred(base_dir))
+
+        # 模拟还原中断：最终图片已保存，原始图片已删除，附属文件还在
+        JmImageTool.decode_deferred(filepath_list[0])
+        with open(filepath_list[0] + JmImageTool.DEFERRED_SIDECAR_SUFFIX, 'w') as f:
+            f.write('{}')
+
+        JmDescrambleUI().main([base_dir, '--workers', '2'])
+        self.assertEqual(JmImageTool.find_deferred(base_dir), [])
+        self.assertFalse(JmImageTool.decode_deferred(filepath_list[0]))
+
+        # 附属文件还在时，最终图片已存在也不算已下载，重新下载时交给后台线程完成还原
+        with open(filepath_list[0] + JmImageTool.DEFERRED_SIDECAR_SUFFIX, 'w') as f:
+            f.write('{}')
+        option = self.server.new_option(base_dir, cache=True,
+                                        image={'suffix': '.png', 'defer_decode': {'enable': True}})
+        self.server.stats.clear()
+        option.download_album(500000)
+        self.assertEqual(self.server.stats.get('image', 0), 0)
+        self.assertEqual(JmImageTool.find_deferred(base_dir), [])
+
+        # 后台线程在下载期间还原
+        option = self.server.new_option(base_dir, image={'suffix': '.png', 'defer_decode': {'enable': True}})
+        option.download_album(500010)
+        self.assertEqual(JmImageTool.find_deferred(base_dir), [])
+        self.assert_downloaded(500000, option)
+        self.assert_downloaded(500010, option)